@@ -0,0 +1,194 @@
+import collections
+import functools
+import threading
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from . import settings as es_settings
+from .bulk import BulkSender, serialize_operation
+from .cache import invalidate_documents
+
+_local = threading.local()
+
+
+def _write_key(type_class, obj, index_name=''):
+    return (index_name or type_class.get_index_name(), type_class.get_type_name(), type_class.get_document_id(obj))
+
+
+class WriteBuffer(object):
+    """
+    Collects index and delete operations from `ElasticsearchTypeMixin` save
+    and delete handlers. Repeated writes of the same (index, type, id)
+    collapse into the last one, and `flush()` sends everything in a single
+    bulk request per Elasticsearch client (or queues it in the type class's
+    spool, if it has one).
+
+    Documents are built when the buffer is flushed, so they reflect the state
+    of the objects at that time. Deletes are resolved straight away, as Django
+    clears the primary key of deleted objects.
+    """
+
+    def __init__(self):
+        self.operations = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, type_class, obj, delete=False, index_name=''):
+        key = _write_key(type_class, obj, index_name)
+        operation = (type_class.get_bulk_action(obj, 'delete', index_name), None) if delete else None
+
+        # the latest write wins, and is sent in the order it was made
+        self.operations.pop(key, None)
+        self.operations[key] = (type_class, obj, index_name, operation)
+        return key
+
+    def flush(self):
+        operations, self.operations = self.operations, collections.OrderedDict()
+
+        requests = collections.OrderedDict()
+        spooled = collections.OrderedDict()
+        for type_class, obj, index_name, operation in operations.values():
+            if operation is None:
+                operation = type_class.get_bulk_operation(obj, index_name)
+                if operation is None:
+                    continue
+
+            es = type_class.get_es()
+            spool = type_class.get_spool()
+            (action, meta), = operation[0].items()
+            for name in type_class.get_write_index_names(index_name):
+                serialized = serialize_operation(es.transport.serializer, {action: dict(meta, _index=name)}, operation[1])
+                if spool is not None:
+                    spooled.setdefault((id(spool), type_class), (spool, type_class, []))[2].append(serialized)
+                else:
+                    requests.setdefault(id(es), (es, []))[1].append(serialized)
+
+        for spool, type_class, batch in spooled.values():
+            spool.put(type_class, batch)
+
+        for es, batch in requests.values():
+            BulkSender(
+                es,
+                max_retries=es_settings.ELASTICSEARCH_BULK_INDEX_MAX_RETRIES,
+                backoff=es_settings.ELASTICSEARCH_BULK_INDEX_RETRY_BACKOFF
+            ).send(batch)
+
+        for (name, type_name, pk), (type_class, obj, index_name, operation) in operations.items():
+            invalidate_documents([name] + type_class.get_write_index_names(index_name), type_name, [pk])
+
+
+class TransactionBuffer(WriteBuffer):
+    """
+    A `WriteBuffer` for the writes made at one level of a transaction (the
+    outermost atomic block, or a savepoint within it). Each write registers
+    an `on_commit` callback at that level, so that Django discards it along
+    with the write if the level is rolled back; the first callback that runs
+    sends the writes made since it was registered.
+    """
+
+    def __init__(self, using):
+        super(TransactionBuffer, self).__init__()
+        self.using = using
+        self.added = {}
+        self.count = 0
+
+    def add(self, type_class, obj, delete=False, index_name=''):
+        key = super(TransactionBuffer, self).add(type_class, obj, delete, index_name)
+        self.count += 1
+        self.added[key] = self.count
+        transaction.on_commit(functools.partial(self.commit, self.count), using=self.using)
+        return key
+
+    def discard(self, key):
+        self.operations.pop(key, None)
+        self.added.pop(key, None)
+
+    def commit(self, number):
+        # writes added before the first callback that runs belong to an
+        # earlier transaction that was rolled back
+        for key, added in list(self.added.items()):
+            if added < number:
+                self.discard(key)
+        self.added = {}
+
+        # the transaction is over: the buffers still to be flushed are
+        # referenced by their callbacks, the others were rolled back
+        buffers = getattr(_local, 'transactions', {})
+        for level in [level for level in buffers if level[0] == self.using]:
+            del buffers[level]
+
+        self.flush()
+
+
+def _transaction_buffer(using, key):
+    # one buffer per database connection and atomic block level (identified
+    # by the savepoints it is nested in), flushed when the transaction
+    # commits unless the level is rolled back; blocks without a savepoint
+    # can't be rolled back on their own, so they share their parent's level
+    if not hasattr(_local, 'transactions'):
+        _local.transactions = {}
+    buffers = _local.transactions
+    savepoints = tuple(sid for sid in transaction.get_connection(using).savepoint_ids if sid is not None)
+
+    # a later write supersedes the one made in a savepoint that has exited
+    for (alias, level), buffer in buffers.items():
+        if alias == using and len(level) > len(savepoints) and level[:len(savepoints)] == savepoints:
+            buffer.discard(key)
+
+    buffer = buffers.get((using, savepoints))
+    if buffer is None:
+        buffer = buffers[(using, savepoints)] = TransactionBuffer(using)
+    return buffer
+
+
+def buffer_write(type_class, obj, delete=False, index_name=''):
+    """
+    Adds a write to the active `buffered_writes()` buffer or, with
+    `ELASTICSEARCH_BUFFER_WRITES` enabled, to a buffer sent when the current
+    transaction commits. Returns `False` if the write should be sent
+    immediately instead.
+    """
+    if not obj:
+        return False
+
+    buffer = getattr(_local, 'context', None)
+    if buffer is None and es_settings.ELASTICSEARCH_BUFFER_WRITES and hasattr(transaction, 'on_commit'):
+        using = obj._state.db or DEFAULT_DB_ALIAS
+        if transaction.get_connection(using).in_atomic_block:
+            buffer = _transaction_buffer(using, _write_key(type_class, obj, index_name))
+
+    if buffer is None:
+        return False
+
+    buffer.add(type_class, obj, delete, index_name)
+    return True
+
+
+@contextmanager
+def buffered_writes():
+    """
+    Collects the save/delete handler writes made within the block and sends
+    them in a single bulk request when it exits; meant for code running
+    outside of transactions (ie. management commands or scripts). If the
+    block exits inside a transaction, the writes are sent when it commits.
+    Nested blocks share the outermost buffer.
+    """
+    buffer = getattr(_local, 'context', None)
+    if buffer is not None:
+        yield buffer
+        return
+
+    buffer = _local.context = WriteBuffer()
+    try:
+        yield buffer
+    finally:
+        _local.context = None
+
+        # writes made before an exception have still been saved to the
+        # database (outside of a transaction), so send them regardless
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(buffer.flush)
+        else:
+            buffer.flush()
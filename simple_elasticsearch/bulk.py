@@ -0,0 +1,502 @@
+import collections
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+from itertools import islice
+
+from django.db import connections, reset_queries
+from django.utils import six
+from elasticsearch import ConnectionTimeout, TransportError
+
+from .exceptions import MemoryLimitError
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+# marks the end of a pipeline queue
+_DONE = object()
+
+# statuses (for whole requests or single bulk items) meaning the cluster is
+# overloaded; these are retried after backing off
+RETRY_STATUSES = (429, 503)
+
+# the outcomes of single bulk operations, returned by `BulkSender.send_items()`
+SENT = 'sent'
+FAILED = 'failed'
+REJECTED = 'rejected'
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def memory_usage():
+    # the resident set size of this process in bytes, or its peak where the
+    # current size isn't available; `None` if neither is
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def guarded(items, chunksize, memory_limit=None, on_pressure=None):
+    """
+    Yields `items`, and after each `chunksize` of them resets Django's query
+    log (which keeps growing while `DEBUG` is on) and checks the memory use of
+    the process against `memory_limit` bytes. Past 80% of the limit, garbage
+    is collected and `on_pressure()` is called (ie. to shrink bulk batches);
+    past the limit, a `MemoryLimitError` is raised.
+    """
+    for i, item in enumerate(items, 1):
+        yield item
+
+        if i % chunksize:
+            continue
+        reset_queries()
+
+        if not memory_limit:
+            continue
+        usage = memory_usage()
+        if usage is None or usage < memory_limit * 0.8:
+            continue
+
+        gc.collect()
+        usage = memory_usage()
+        if usage >= memory_limit:
+            raise MemoryLimitError('Memory use of {0} bytes is over the limit of {1} bytes.'.format(usage, memory_limit))
+        if usage >= memory_limit * 0.8:
+            logger.warning('Memory use of %d bytes is close to the limit of %d bytes; reducing bulk batches.', usage, memory_limit)
+            if on_pressure is not None:
+                on_pressure()
+
+
+def serialize_operation(serializer, action, doc=None):
+    # a bulk operation is its action line followed by the document line for
+    # anything but deletes; `es.bulk()` joins operations with newlines.
+    if doc is None:
+        return serializer.dumps(action)
+    return serializer.dumps(action) + '\n' + serializer.dumps(doc)
+
+
+def byte_size(data):
+    if isinstance(data, six.text_type):
+        return len(data.encode('utf-8'))
+    return len(data)
+
+
+def batch_operations(operations, serializer, max_docs=None, max_bytes=None, limits=None):
+    """
+    Serializes `(action, document)` pairs and groups them into lists of bulk
+    operations holding at most `max_docs` operations and `max_bytes` bytes of
+    payload. An operation larger than `max_bytes` on its own is sent in a
+    request by itself rather than being split or merged with others.
+
+    `limits` is an optional object with `max_docs` and `max_bytes`
+    attributes (ie. a `BulkSender`), read before each operation so that the
+    batch size can change while batching.
+    """
+    if limits is not None:
+        max_docs, max_bytes = limits.max_docs, limits.max_bytes
+    if not max_docs and not max_bytes:
+        raise ValueError('Bulk batches need a document count and/or byte size limit.')
+
+    batch = []
+    batch_bytes = 0
+    for action, doc in operations:
+        if limits is not None:
+            max_docs, max_bytes = limits.max_docs, limits.max_bytes
+
+        operation = serialize_operation(serializer, action, doc)
+        # + 1 for the trailing newline
+        size = byte_size(operation) + 1
+
+        if max_bytes and batch and batch_bytes + size > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(operation)
+        batch_bytes += size
+
+        if (max_docs and len(batch) >= max_docs) or (max_bytes and batch_bytes >= max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+    if batch:
+        yield batch
+
+
+class BulkSender(object):
+    """
+    Sends batches of serialized bulk operations with `es.bulk()` and checks
+    the responses:
+
+    * items rejected because the cluster is overloaded (`429`/`503`) are
+      retried, as are whole requests that are rejected or time out, backing
+      off exponentially between attempts (`backoff` seconds, doubling up to
+      `max_backoff`, at most `max_retries` times), and the items still
+      rejected after that are counted in `stats['failed']` and returned by
+      `send()` (`send_items()` returns the outcome of every operation);
+    * requests that are too large (`413`) are split in half and retried,
+      down to single operations, which are counted in `stats['failed']`;
+    * version conflicts (`409`) mean the index already holds a newer version
+      of the document, and are only counted in `stats['conflicts']`;
+    * deletes of documents that aren't in the index (`404` without an error,
+      ie. sent without the routing they were indexed with) are counted in
+      `stats['not_found']`;
+    * any other failed items are counted in `stats['failed']` and logged.
+
+    The batch size (`max_docs`/`max_bytes`) and the number of requests
+    allowed in flight at once are tuned with AIMD: they are halved whenever
+    the cluster pushes back or a request takes longer than `target_latency`
+    seconds, and grow back (additively) towards the configured maximums
+    after each healthy response.
+    """
+
+    increase_step = 0.1
+    min_scale = 1.0 / 32
+
+    def __init__(self, es, max_docs=None, max_bytes=None, concurrency=1, max_retries=5,
+                 backoff=0.5, max_backoff=30, target_latency=None):
+        self.es = es
+        self.base_max_docs = max_docs
+        self.base_max_bytes = max_bytes
+        self.max_concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.target_latency = target_latency
+
+        self.scale = 1.0
+        self.concurrency = self.max_concurrency
+        self.in_flight = 0
+        self.stats = {'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0}
+        self.lock = threading.Condition()
+
+    @property
+    def max_docs(self):
+        if self.base_max_docs:
+            return max(1, int(self.base_max_docs * self.scale))
+        return self.base_max_docs
+
+    @property
+    def max_bytes(self):
+        if self.base_max_bytes:
+            return max(1, int(self.base_max_bytes * self.scale))
+        return self.base_max_bytes
+
+    def increase(self):
+        with self.lock:
+            self.scale = min(1.0, self.scale + self.increase_step)
+            if self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.lock.notify_all()
+
+    def decrease(self):
+        with self.lock:
+            self.scale = max(self.min_scale, self.scale / 2)
+            self.concurrency = max(1, self.concurrency // 2)
+
+    def count(self, key, value):
+        with self.lock:
+            self.stats[key] += value
+
+    def wait(self, attempt):
+        time.sleep(min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def send(self, batch):
+        # returns the operations of `batch` the cluster kept rejecting
+        return [operation for operation, outcome in zip(batch, self.send_items(batch)) if outcome == REJECTED]
+
+    def send_items(self, batch):
+        """
+        Sends `batch` and returns the outcome of each of its operations, in
+        order: `SENT` (including version conflicts and deletes of missing
+        documents), `FAILED` or `REJECTED` (the cluster kept rejecting it).
+        """
+        # block until fewer than `concurrency` requests are in flight
+        with self.lock:
+            while self.in_flight >= self.concurrency:
+                self.lock.wait()
+            self.in_flight += 1
+
+        try:
+            return self._send(batch)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.lock.notify_all()
+
+    def _send(self, batch):
+        outcomes = [SENT] * len(batch)
+        # positions in `batch` of the operations still to be sent
+        pending = list(range(len(batch)))
+        attempt = 0
+        while pending:
+            operations = [batch[i] for i in pending]
+            start = time.time()
+            try:
+                response = self.es.bulk(operations)
+            except TransportError as e:
+                self.decrease()
+                if e.status_code == 413:
+                    if len(operations) > 1:
+                        half = len(operations) // 2
+                        for i, outcome in zip(pending, self._send(operations[:half]) + self._send(operations[half:])):
+                            outcomes[i] = outcome
+                        return outcomes
+                    # a single operation that is too large can't be split
+                    self.count('failed', 1)
+                    logger.warning('Bulk operation too large for the cluster: %s', operations[0].split('\n', 1)[0])
+                    outcomes[pending[0]] = FAILED
+                    return outcomes
+                if (not isinstance(e, ConnectionTimeout) and e.status_code not in RETRY_STATUSES) \
+                        or attempt >= self.max_retries:
+                    raise
+                self.count('retried', len(operations))
+                self.wait(attempt)
+                attempt += 1
+                continue
+
+            retry = []
+            for i, item in zip(pending, (response or {}).get('items', [])):
+                result = list(item.values())[0]
+                status = result.get('status', 200)
+                if status in RETRY_STATUSES:
+                    retry.append(i)
+                elif status == 409:
+                    self.count('conflicts', 1)
+                elif status == 404 and 'error' not in result:
+                    self.count('not_found', 1)
+                elif status >= 400 and 'error' in result:
+                    self.count('failed', 1)
+                    outcomes[i] = FAILED
+                    logger.warning('Bulk operation failed: %s', result)
+
+            if retry or (self.target_latency and time.time() - start > self.target_latency):
+                self.decrease()
+            else:
+                self.increase()
+
+            if retry and attempt >= self.max_retries:
+                self.count('failed', len(retry))
+                logger.warning('Giving up on %d bulk operation(s) rejected by the cluster.', len(retry))
+                for i in retry:
+                    outcomes[i] = REJECTED
+                return outcomes
+
+            if retry:
+                self.count('retried', len(retry))
+                self.wait(attempt)
+                attempt += 1
+            pending = retry
+        return outcomes
+
+
+class Pipeline(object):
+    """
+    Overlaps database reads, document building and bulk requests:
+
+    * a reader thread iterates `objects` (ie. a `queryset_iterator()`) and
+      queues them up in chunks of `chunksize`;
+    * the calling thread passes the queued objects through `build`, which
+      must yield bulk request bodies;
+    * `senders` threads pass those bodies to `send` (ie. `es.bulk`), so up
+      to `senders` bulk requests are in flight at once.
+
+    The stages are joined by queues holding at most `queue_size` items, so
+    memory use stays bounded when one stage is slower than the others. The
+    first exception raised in any stage stops the pipeline and is re-raised
+    from `run()`.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, build, send, senders=1, queue_size=4, chunksize=100):
+        self.build = build
+        self.send = send
+        self.senders = max(1, senders)
+        self.chunksize = chunksize
+
+        self.objects = queue.Queue(queue_size)
+        self.batches = queue.Queue(queue_size)
+
+        self.failed = threading.Event()
+        self.exc_info = None
+        self.lock = threading.Lock()
+
+    def fail(self):
+        with self.lock:
+            if self.exc_info is None:
+                self.exc_info = sys.exc_info()
+        self.failed.set()
+
+    def put(self, q, item):
+        # a blocking `put` that gives up if another stage has failed
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def read(self, objects):
+        try:
+            for chunk in chunked(objects, self.chunksize):
+                if not self.put(self.objects, chunk):
+                    return
+        except Exception:
+            self.fail()
+        finally:
+            self.put(self.objects, _DONE)
+            # Django opens a database connection per thread
+            connections.close_all()
+
+    def queued_objects(self):
+        while True:
+            chunk = self.get(self.objects)
+            if chunk is _DONE:
+                return
+            for obj in chunk:
+                yield obj
+
+    def send_batches(self):
+        while True:
+            batch = self.get(self.batches)
+            if batch is _DONE:
+                return
+            try:
+                self.send(batch)
+            except Exception:
+                self.fail()
+                return
+
+    def run(self, objects):
+        threads = [threading.Thread(target=self.read, args=(objects,))]
+        threads.extend(threading.Thread(target=self.send_batches) for i in range(self.senders))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for batch in self.build(self.queued_objects()):
+                if not self.put(self.batches, batch):
+                    break
+        except Exception:
+            self.fail()
+        finally:
+            for i in range(self.senders):
+                self.put(self.batches, _DONE)
+            for thread in threads:
+                thread.join()
+
+        if self.exc_info is not None:
+            six.reraise(*self.exc_info)
+
+
+class NumberedBatch(list):
+    # a batch of operations, numbered in the order `BulkProgress` saw it
+    def __init__(self, operations, number):
+        super(NumberedBatch, self).__init__(operations)
+        self.number = number
+
+
+class BulkProgress(object):
+    """
+    Tracks how far through an ordered stream of objects every bulk operation
+    has been sent, when batches may be sent concurrently and complete out of
+    order. The operations are passed through `track()`, with a `mark(data)`
+    after the operations of each chunk of objects, the batches through
+    `batches()`, and `sent(batch)` is called once a batch has been sent;
+    `callback(data)` is then called with the latest mark that every operation
+    up to has been sent.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.lock = threading.Lock()
+        # operations tracked, batched and sent (in order) so far
+        self.count = 0
+        self.batched = 0
+        self.acknowledged = 0
+        # (operation count, data) of the marks not yet acknowledged
+        self.marks = collections.deque()
+        # batch number -> [operation count at its end, whether it was sent];
+        # batches are numbered rather than keyed by `id()`, which may be
+        # reused once a batch that was sent out of order is freed
+        self.pending = collections.OrderedDict()
+        self.numbered = 0
+
+    def track(self, operations):
+        for operation in operations:
+            self.count += 1
+            yield operation
+
+    def mark(self, data):
+        with self.lock:
+            self.marks.append((self.count, data))
+        self.advance()
+
+    def batches(self, batches):
+        # yields each batch as a `NumberedBatch`, to be passed to `sent()`
+        for batch in batches:
+            with self.lock:
+                self.numbered += 1
+                batch = NumberedBatch(batch, self.numbered)
+                self.batched += len(batch)
+                self.pending[batch.number] = [self.batched, False]
+            yield batch
+
+    def sent(self, batch):
+        with self.lock:
+            self.pending[batch.number][1] = True
+        self.advance()
+
+    def advance(self):
+        with self.lock:
+            while self.pending:
+                key, (end, sent) = next(iter(self.pending.items()))
+                if not sent:
+                    break
+                self.acknowledged = end
+                del self.pending[key]
+
+            data = _DONE
+            while self.marks and self.marks[0][0] <= self.acknowledged:
+                data = self.marks.popleft()[1]
+
+            # called with the lock held so that marks are reported in order
+            if data is not _DONE:
+                self.callback(data)
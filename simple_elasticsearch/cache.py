@@ -0,0 +1,276 @@
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.utils import six
+
+from . import settings as es_settings
+
+_local = threading.local()
+
+
+def get_request_cache():
+    # the cache of the active `request_cache()` block, or `None`
+    return getattr(_local, 'request_cache', None)
+
+
+@contextmanager
+def request_cache():
+    """
+    Caches the documents fetched by `get_from_es_or_None()`,
+    `get_from_es_or_404()` and `get_many_from_es()` within the block (misses
+    included), so repeated lookups of the same id don't reach Elasticsearch.
+    Meant to wrap a single request (see `RequestCacheMiddleware`); nested
+    blocks share the outermost cache.
+    """
+    cache = get_request_cache()
+    if cache is not None:
+        yield cache
+        return
+
+    cache = _local.request_cache = {}
+    try:
+        yield cache
+    finally:
+        _local.request_cache = None
+
+
+class RequestCacheMiddleware(object):
+    """
+    Wraps each request in a `request_cache()` block; add
+    `'simple_elasticsearch.cache.RequestCacheMiddleware'` to `MIDDLEWARE`
+    (or `MIDDLEWARE_CLASSES` before Django 1.10).
+    """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_cache():
+            return self.get_response(request)
+
+    # old-style middleware: the cache lasts from the request to its response
+    def process_request(self, request):
+        if get_request_cache() is None:
+            _local.request_cache = {}
+            request._request_cache_owner = True
+
+    def process_response(self, request, response):
+        if getattr(request, '_request_cache_owner', False):
+            _local.request_cache = None
+        return response
+
+
+class LocalCache(object):
+    """
+    A thread-safe, in-process LRU cache of at most `size` entries, each
+    expiring `timeout` seconds after it was set.
+    """
+
+    def __init__(self, size=1000, timeout=5):
+        self.size = size
+        self.timeout = timeout
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            # most recently used entries go last
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.timeout, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+class DocumentCache(object):
+    """
+    A two-tier read-through cache of the responses to document lookups: a
+    `LocalCache` in front of the Django cache `cache_alias` (if any), where
+    entries expire after `timeout` seconds. Each entry holds the responses for
+    one document by request parameters (ie. `_source` filtering or routing),
+    so that a write invalidates all of them at once.
+
+    Other processes keep their local copy of an invalidated document until it
+    expires, so keep `local_timeout` short.
+    """
+
+    prefix = 'simple_elasticsearch:document:'
+
+    def __init__(self, cache_alias=None, timeout=60, local_size=1000, local_timeout=5):
+        self.local = LocalCache(local_size, local_timeout)
+        self.shared = caches[cache_alias] if cache_alias else None
+        self.timeout = timeout
+
+    def key(self, index, type, id):
+        key = repr((index, type, six.text_type(id))).encode('utf-8')
+        return self.prefix + hashlib.md5(key).hexdigest()
+
+    def params_key(self, params):
+        return repr(sorted(params.items()))
+
+    def get_entry(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        return entry
+
+    def get(self, index, type, id, params):
+        # the cached response for the lookup, or `None`
+        entry = self.get_entry(self.key(index, type, id))
+        return entry.get(self.params_key(params)) if entry else None
+
+    def set(self, index, type, id, params, response):
+        key = self.key(index, type, id)
+        entry = dict(self.get_entry(key) or {})
+        entry[self.params_key(params)] = response
+
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry, self.timeout)
+
+    def invalidate(self, indices, type, ids):
+        keys = [self.key(index, type, id) for index in indices for id in ids]
+        self.local.delete_many(keys)
+        if self.shared is not None:
+            self.shared.delete_many(keys)
+
+
+_document_cache = None
+
+
+def get_document_cache():
+    # the `DocumentCache` configured by the `ELASTICSEARCH_DOCUMENT_CACHE*`
+    # settings, or `None` if it is disabled
+    global _document_cache
+    if not es_settings.ELASTICSEARCH_DOCUMENT_CACHE:
+        return None
+    if _document_cache is None:
+        _document_cache = DocumentCache(
+            cache_alias=es_settings.ELASTICSEARCH_DOCUMENT_CACHE_ALIAS,
+            timeout=es_settings.ELASTICSEARCH_DOCUMENT_CACHE_TIMEOUT,
+            local_size=es_settings.ELASTICSEARCH_DOCUMENT_CACHE_LOCAL_SIZE,
+            local_timeout=es_settings.ELASTICSEARCH_DOCUMENT_CACHE_LOCAL_TIMEOUT
+        )
+    return _document_cache
+
+
+def get_search_cache(enabled=None):
+    # the Django cache of `SimpleSearch` responses, or `None` if disabled;
+    # `enabled` overrides `ELASTICSEARCH_SEARCH_CACHE`, but no cache is used
+    # without an `ELASTICSEARCH_SEARCH_CACHE_ALIAS`
+    if enabled is None:
+        enabled = es_settings.ELASTICSEARCH_SEARCH_CACHE
+    if not enabled or not es_settings.ELASTICSEARCH_SEARCH_CACHE_ALIAS:
+        return None
+    return caches[es_settings.ELASTICSEARCH_SEARCH_CACHE_ALIAS]
+
+
+def _generation_key(index):
+    return 'simple_elasticsearch:generation:{0}'.format(index)
+
+
+def _search_indices(index):
+    # the indices a search of `index` depends on; searches of every index (or
+    # of wildcard patterns) depend on the generation shared by all of them
+    names = [name for name in index.split(',') if name] if index else []
+    if not names or any('*' in name or name == '_all' for name in names):
+        return ['']
+    return names
+
+
+def _new_generation():
+    return random.getrandbits(48)
+
+
+def get_generations(search_cache, indices):
+    """
+    Returns the current generation of each of `indices` (by name), starting
+    missing ones (ie. evicted from the cache) at a random number, so they
+    don't repeat a generation used before.
+    """
+    keys = dict((_generation_key(index), index) for index in indices)
+    generations = search_cache.get_many(list(keys))
+    for key in keys:
+        if key not in generations:
+            search_cache.add(key, _new_generation(), None)
+            generations[key] = search_cache.get(key)
+    return dict((keys[key], generation) for key, generation in generations.items())
+
+
+def bump_generations(indices):
+    # makes the cached searches of `indices` (and of every index) stale;
+    # regardless of `ELASTICSEARCH_SEARCH_CACHE`, as `SimpleSearch(cache=True)`
+    # may have cached them anyway
+    search_cache = get_search_cache(True)
+    if search_cache is None:
+        return
+    for index in set(indices) | set(['']):
+        key = _generation_key(index)
+        try:
+            search_cache.incr(key)
+        except ValueError:
+            # not set yet, or evicted
+            search_cache.add(key, _new_generation(), None)
+
+
+def search_cache_keys(search_cache, searches):
+    # the cache key of each `(header, query)` search of an `_msearch` body,
+    # a hash of both and of the generations of the indices searched
+    indices = [_search_indices(header.get('index')) for header, query in searches]
+    generations = get_generations(search_cache, set(sum(indices, [])))
+
+    keys = []
+    for (header, query), names in zip(searches, indices):
+        data = json.dumps(
+            [header, query, [generations[name] for name in names]],
+            sort_keys=True,
+            default=six.text_type
+        )
+        keys.append('simple_elasticsearch:search:' + hashlib.md5(data.encode('utf-8')).hexdigest())
+    return keys
+
+
+def invalidate_documents(indices, type, ids):
+    # drops the cached lookups of documents `ids` in any of `indices`, and
+    # the cached searches of `indices`
+    if not ids:
+        return
+    bump_generations(indices)
+    document_cache = get_document_cache()
+    if document_cache is not None:
+        document_cache.invalidate(set(indices), type, ids)
+
+
+def invalidate_operations(type_class, serializer, operations):
+    # drops the cached lookups of the documents written by serialized bulk
+    # `operations` (and searches of their indices), under the type class's
+    # index as well as their own
+    if get_document_cache() is None and get_search_cache(True) is None:
+        return
+    indices = set([type_class.get_index_name()])
+    ids = set()
+    for operation in operations:
+        (action, meta), = serializer.loads(operation.split('\n', 1)[0]).items()
+        indices.add(meta.get('_index') or type_class.get_index_name())
+        ids.add(meta['_id'])
+    invalidate_documents(indices, type_class.get_type_name(), ids)
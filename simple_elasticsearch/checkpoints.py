@@ -0,0 +1,64 @@
+from elasticsearch import ConflictError, NotFoundError
+
+from . import settings as es_settings
+from .clients import get_client
+
+
+class CheckpointStore(object):
+    """
+    Stores small progress documents (ie. the time of the last delta reindex of
+    a type class) by key in the `ELASTICSEARCH_CHECKPOINT_INDEX` index, so
+    that they are shared by every host running `es_manage`.
+    """
+
+    doc_type = 'checkpoint'
+
+    def __init__(self, es=None, index_name=None):
+        self.es = es or get_client()
+        self.index_name = index_name or es_settings.ELASTICSEARCH_CHECKPOINT_INDEX
+
+    def get(self, key):
+        try:
+            return self.es.get(self.index_name, key, self.doc_type)['_source']
+        except NotFoundError:
+            return None
+
+    def save(self, key, data):
+        self.es.index(self.index_name, self.doc_type, data, key)
+
+    def create(self, key, data):
+        # saves `data` unless `key` already exists; returns the stored data
+        try:
+            self.es.index(self.index_name, self.doc_type, data, key, op_type='create')
+        except ConflictError:
+            return self.get(key)
+        return data
+
+    def delete(self, key):
+        try:
+            self.es.delete(self.index_name, self.doc_type, key)
+        except NotFoundError:
+            pass
+
+
+def reindex_checkpoint_key(type_class):
+    return 'reindex:{0}:{1}'.format(type_class.get_index_name(), type_class.get_type_name())
+
+
+def dual_write_key(index_alias):
+    return 'dual-write:{0}'.format(index_alias)
+
+
+def rebuild_key(index_alias):
+    return 'rebuild:{0}'.format(index_alias)
+
+
+def rebuild_checkpoint_key(type_class, partition=None):
+    key = 'rebuild:{0}:{1}'.format(type_class.get_index_name(), type_class.get_type_name())
+    if partition is not None:
+        key = '{0}:{1}'.format(key, partition)
+    return key
+
+
+def partitions_key(type_class):
+    return 'partitions:{0}:{1}'.format(type_class.get_index_name(), type_class.get_type_name())
@@ -0,0 +1,106 @@
+import os
+import threading
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+
+from . import settings as es_settings
+from .serializers import get_serializer
+
+
+class _CompressingPool(object):
+    # wraps a urllib3 connection pool, gzipping request bodies
+    def __init__(self, pool, level):
+        self.pool = pool
+        self.level = level
+
+    def urlopen(self, method, url, body=None, headers=None, **kwargs):
+        if body:
+            if isinstance(body, six.text_type):
+                body = body.encode('utf-8')
+            # wbits of 16 + 15 writes a gzip header and trailer
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers = dict(headers or {}, **{'content-encoding': 'gzip'})
+        return self.pool.urlopen(method, url, body, headers=headers, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.pool, attr)
+
+
+class HttpConnection(Urllib3HttpConnection):
+    """
+    The default elasticsearch-py connection, plus `http_compress` to gzip
+    request bodies (at `compress_level`) and accept gzipped responses.
+    """
+
+    def __init__(self, http_compress=False, compress_level=6, **kwargs):
+        super(HttpConnection, self).__init__(**kwargs)
+        if http_compress:
+            self.headers['accept-encoding'] = 'gzip,deflate'
+            self.pool = _CompressingPool(self.pool, compress_level)
+
+
+_profile = None
+
+
+def activate_profile(name):
+    """
+    Makes clients created from now on in this process (and the processes it
+    starts) use the `ELASTICSEARCH_CONNECTION_PROFILES` entry `name` on top of
+    their connection settings; `None` goes back to the plain settings.
+    """
+    global _profile
+    if name is not None and name not in es_settings.ELASTICSEARCH_CONNECTION_PROFILES:
+        raise ImproperlyConfigured('Unknown Elasticsearch connection profile `{0}`.'.format(name))
+    _profile = name
+
+
+def get_connection_params(params=None):
+    # `params` (by default `ELASTICSEARCH_CONNECTION_PARAMS`) updated with the
+    # active profile and the `ELASTICSEARCH_HTTP_COMPRESS` setting
+    params = dict(params or es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
+    if _profile is not None:
+        params.update(es_settings.ELASTICSEARCH_CONNECTION_PROFILES[_profile])
+    params.setdefault('http_compress', es_settings.ELASTICSEARCH_HTTP_COMPRESS)
+    return params
+
+
+def create_client(**params):
+    # an `Elasticsearch` client for `params` (see `get_connection_params()`)
+    # using the `ELASTICSEARCH_SERIALIZER`, unless `params` include a
+    # serializer of their own
+    params = get_connection_params(params)
+    params.setdefault('serializer', get_serializer())
+    if params.pop('http_compress'):
+        params.setdefault('connection_class', HttpConnection)
+        params['http_compress'] = True
+    return Elasticsearch(**params)
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_client(**params):
+    """
+    Returns the shared client for `params` (see `create_client()`), creating
+    it on first use, so that its connection pools are reused by every caller
+    with the same connection settings. A forked process (ie. a gunicorn or
+    multiprocessing worker) must not use its parent's sockets, so the clients
+    are discarded and created anew when the process ID changes.
+    """
+    global _clients_pid
+    params = get_connection_params(params)
+    key = repr(sorted(params.items()))
+
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        if key not in _clients:
+            _clients[key] = create_client(**params)
+        return _clients[key]
@@ -1,3 +1,12 @@
-
 class MissingObjectError(Exception):
     pass
+
+
+class BulkIndexError(Exception):
+    def __init__(self, message, errors=None):
+        super(BulkIndexError, self).__init__(message)
+        self.errors = errors or []
+
+
+class MemoryLimitError(Exception):
+    pass
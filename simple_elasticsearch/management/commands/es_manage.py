@@ -1,8 +1,15 @@
 import sys
-from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand, CommandError
 
-from ...utils import get_indices, create_indices, rebuild_indices, delete_indices
+from ... import settings as es_settings
+from ...clients import activate_profile
+from ...exceptions import BulkIndexError, MemoryLimitError
+from ...spool import SpoolWorker, get_spool
+from ...utils import (
+    get_indices, create_indices, rebuild_indices, reindex_indices, delete_indices, parse_since, prepare_rebuild,
+    rebuild_partition, finalize_rebuild
+)
 
 try:
     raw_input
@@ -32,9 +39,22 @@ class Command(BaseCommand):
         parser.add_argument('--list', action='store_true', dest='list', default=False)
         parser.add_argument('--initialize', action='store_true', dest='initialize', default=False)
         parser.add_argument('--rebuild', action='store_true', dest='rebuild', default=False)
+        parser.add_argument('--prepare', action='store_true', dest='prepare', default=False)
+        parser.add_argument('--finalize', action='store_true', dest='finalize', default=False)
+        parser.add_argument('--rebuild-worker', '--rebuild_worker', action='store_true', dest='rebuild_worker', default=False)
+        parser.add_argument('--target', action='store', dest='target', default='')
+        parser.add_argument('--partition', action='store', dest='partition', default='1/1')
+        parser.add_argument('--reindex', action='store_true', dest='reindex', default=False)
         parser.add_argument('--cleanup', action='store_true', dest='cleanup', default=False)
+        parser.add_argument('--worker', action='store_true', dest='worker', default=False)
         parser.add_argument('--no_input', '--noinput', action='store_true', dest='no_input', default=False)
         parser.add_argument('--indexes', action='store', dest='indexes', default='')
+        parser.add_argument('--processes', action='store', dest='processes', type=int, default=1)
+        parser.add_argument('--jobs', action='store', dest='jobs', type=int, default=1)
+        parser.add_argument('--dual-write', '--dual_write', action='store_true', dest='dual_write', default=False)
+        parser.add_argument('--resume', action='store_true', dest='resume', default=False)
+        parser.add_argument('--since', action='store', dest='since', default='checkpoint')
+        parser.add_argument('--profile', action='store', dest='profile', default=None)
 
     def handle(self, *args, **options):
         no_input = options.get('no_input')
@@ -43,14 +63,40 @@ class Command(BaseCommand):
         if requested_indexes:
             requested_indexes = requested_indexes.split(',')
 
+        profile = options.get('profile')
+        if profile is None and (options.get('rebuild') or options.get('rebuild_worker') or options.get('reindex')):
+            profile = es_settings.ELASTICSEARCH_REBUILD_PROFILE
+        if profile:
+            try:
+                activate_profile(profile)
+            except ImproperlyConfigured as e:
+                raise ESCommandError(str(e))
+
         if options.get('list'):
             self.subcommand_list()
         elif options.get('initialize'):
             self.subcommand_initialize(requested_indexes, no_input)
+        elif options.get('rebuild') and options.get('prepare'):
+            self.subcommand_prepare(requested_indexes, no_input)
+        elif options.get('rebuild') and options.get('finalize'):
+            self.subcommand_finalize(requested_indexes)
         elif options.get('rebuild'):
-            self.subcommand_rebuild(requested_indexes, no_input)
+            self.subcommand_rebuild(
+                requested_indexes,
+                no_input,
+                options.get('processes') or 1,
+                options.get('jobs') or 1,
+                options.get('dual_write'),
+                options.get('resume')
+            )
+        elif options.get('rebuild_worker'):
+            self.subcommand_rebuild_worker(options.get('target'), options.get('partition'))
+        elif options.get('reindex'):
+            self.subcommand_reindex(requested_indexes, options.get('since') or 'checkpoint')
         elif options.get('cleanup'):
             self.subcommand_cleanup(requested_indexes, no_input)
+        elif options.get('worker'):
+            self.subcommand_worker()
 
     def subcommand_list(self):
         print("Available ES indexes:")
@@ -89,25 +135,132 @@ class Command(BaseCommand):
             else:
                 print("{0} removed.".format(len(indices)))
 
-    def subcommand_rebuild(self, indexes, no_input=False):
-        if getattr(settings, 'DEBUG', False):
-            import warnings
-            warnings.warn('Rebuilding with `settings.DEBUG = True` can result in out of memory crashes. See https://docs.djangoproject.com/en/stable/ref/settings/#debug', stacklevel=2)
+    def subcommand_worker(self):
+        spool = get_spool()
+        if spool is None:
+            raise ESCommandError('`ELASTICSEARCH_SPOOL_PATH` is not set in project `settings`.')
+
+        print("Sending spooled operations from '{0}' (Ctrl-C to stop).".format(spool.path))
+        worker = SpoolWorker(spool)
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            worker.stop()
+        print("{0} operation(s) sent, {1} failed.".format(worker.stats['sent'], worker.stats['failed']))
 
-            # make sure the user continues explicitly after seeing this warning
-            no_input = False
+    def subcommand_rebuild(self, indexes, no_input=False, processes=1, jobs=1, dual_write=False, resume=False):
+        if dual_write and not es_settings.ELASTICSEARCH_DUAL_WRITES:
+            raise ESCommandError('`--dual-write` requires `ELASTICSEARCH_DUAL_WRITES` to be on in project `settings`.')
 
         user_input = 'y' if no_input else ''
         while user_input != 'y':
-            user_input = raw_input('Are you sure you want to rebuild {0} index(es)? [y/N]: '.format('the ' + ', '.join(indexes) if indexes else '**ALL**')).lower()
+            user_input = raw_input('Are you sure you want to {0} {1} index(es)? [y/N]: '.format(
+                'resume rebuilding' if resume else 'rebuild',
+                'the ' + ', '.join(indexes) if indexes else '**ALL**'
+            )).lower()
             if user_input in ['n', '']:
                 break
 
         if user_input == 'y':
-            sys.stdout.write("Rebuilding ES indexes: ")
-            results, aliases = rebuild_indices(indices=indexes)
+            sys.stdout.write("Rebuilding ES indexes:\n")
+            try:
+                results, aliases = rebuild_indices(
+                    indices=indexes,
+                    processes=processes,
+                    callback=self.rebuild_progress,
+                    jobs=jobs,
+                    dual_write=dual_write,
+                    resume=resume
+                )
+            except BulkIndexError as e:
+                for error in e.errors:
+                    if error['partition'] is None:
+                        sys.stderr.write("{0}\n".format(error['error']))
+                    else:
+                        sys.stderr.write("Partition {0} failed in worker {1}:\n{2}\n".format(error['partition'], error['pid'], error['error']))
+                raise ESCommandError(str(e))
+            except MemoryLimitError as e:
+                raise ESCommandError('{0} Continue with `--resume`.'.format(e))
+            except ValueError as e:
+                raise ESCommandError(str(e))
             sys.stdout.write("complete.\n")
             for alias, index in aliases:
                 print("'{0}' rebuilt and aliased to '{1}'".format(alias, index))
         else:
             print("You chose not to rebuild indices.")
+
+    def subcommand_prepare(self, indexes, no_input=False):
+        user_input = 'y' if no_input else ''
+        while user_input != 'y':
+            user_input = raw_input('Are you sure you want to prepare a rebuild of {0} index(es)? [y/N]: '.format('the ' + ', '.join(indexes) if indexes else '**ALL**')).lower()
+            if user_input in ['n', '']:
+                break
+
+        if user_input == 'y':
+            sys.stdout.write("Preparing ES indexes for rebuilding: ")
+            results, aliases = prepare_rebuild(indices=indexes)
+            sys.stdout.write("complete.\n")
+            for alias, index in aliases:
+                print("'{0}' will be rebuilt as '{1}'; run `es_manage --rebuild-worker --target {1} --partition K/N`".format(alias, index))
+        else:
+            print("You chose not to prepare a rebuild.")
+
+    def subcommand_rebuild_worker(self, target, partition):
+        if not target:
+            raise ESCommandError('`--target` is required.')
+        try:
+            partition, partitions = [int(x) for x in partition.split('/')]
+        except ValueError:
+            raise ESCommandError('`--partition` must be given as K/N.')
+
+        sys.stdout.write("Rebuilding partition {0}/{1} of '{2}':\n".format(partition, partitions, target))
+        try:
+            results = rebuild_partition(index_name=target, partition=partition, partitions=partitions, callback=self.rebuild_progress)
+        except (MemoryLimitError, ValueError) as e:
+            raise ESCommandError(str(e))
+        if any(stats.get('failed') for type_class, stats in results):
+            raise ESCommandError('The partition is incomplete; run it again to retry the failed documents.')
+        sys.stdout.write("complete.\n")
+
+    def subcommand_finalize(self, indexes):
+        sys.stdout.write("Finalizing ES index rebuild: ")
+        try:
+            results, aliases = finalize_rebuild(indices=indexes)
+        except ValueError as e:
+            sys.stdout.write("incomplete.\n")
+            raise ESCommandError(str(e))
+        sys.stdout.write("complete.\n")
+        for alias, index in aliases:
+            print("'{0}' rebuilt and aliased to '{1}'".format(alias, index))
+
+    def subcommand_reindex(self, indexes, since='checkpoint'):
+        if since == 'checkpoint':
+            since = None
+        else:
+            try:
+                since = parse_since(since)
+            except ValueError as e:
+                raise ESCommandError(str(e))
+
+        sys.stdout.write("Reindexing changes since {0}:\n".format(since or 'the last checkpoint'))
+        results = reindex_indices(indices=indexes, since=since, callback=self.rebuild_progress)
+        sys.stdout.write("complete.\n")
+        print("{0} type(s) reindexed.".format(len(results)))
+
+    def rebuild_progress(self, type_class, result):
+        if result['error']:
+            summary = 'FAILED'
+        else:
+            summary = ', '.join('{0} {1}'.format(v, k) for k, v in sorted(result['stats'].items()))
+        if result['partition'] is None:
+            print(" - '{0}.{1}': {2}".format(type_class.get_index_name(), type_class.get_type_name(), summary))
+        else:
+            print(" - '{0}.{1}' partition {2} (worker {3}): {4}".format(
+                type_class.get_index_name(),
+                type_class.get_type_name(),
+                result['partition'],
+                result['pid'],
+                summary
+            ))
+        if result['stats'].get('failed'):
+            sys.stderr.write("   {0} document(s) were rejected by Elasticsearch; see the log for details.\n".format(result['stats']['failed']))
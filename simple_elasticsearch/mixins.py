@@ -1,20 +1,59 @@
-from elasticsearch import Elasticsearch, TransportError
+import calendar
+import datetime
+
+from django.db import connections
+from elasticsearch import ConflictError, TransportError
 
 from . import settings as es_settings
+from .buffer import buffer_write
+from .bulk import BulkProgress, BulkSender, Pipeline, batch_operations, chunked, guarded, serialize_operation
+from .cache import invalidate_documents, invalidate_operations
+from .clients import get_client
 from .exceptions import MissingObjectError
-from .utils import queryset_iterator
+from .spool import get_spool
+from .utils import (
+    RESUMABLE_STRATEGIES, get_dual_write_indices, keyset_position, parallel_bulk_index, queryset_iterator,
+    values_queryset
+)
+
+
+class Row(dict):
+    """
+    A database row fetched by `bulk_index` for a type class with document
+    fields. Its values can also be read as attributes (ie. `row.pk`), so that
+    `get_document_id()`, `get_request_params()` and `should_index()` work with
+    rows, as long as they only use the type's document fields.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+# the default of type class settings that fall back to a project setting
+# unless set, even to `None`
+_default = object()
 
 
 class ElasticsearchTypeMixin(object):
     queryset_ordering = 'pk'
     queryset_limit = 100
+    queryset_strategy = 'keyset'
     bulk_index_limit = 100
+    bulk_index_max_bytes = _default
+    bulk_index_senders = 0
+    bulk_index_queue_size = 4
+    changed_field = None
+    version_field = None
+    document_fields = None
 
     @classmethod
     def get_es(cls):
-        if not hasattr(cls, '_es'):
-            cls._es = Elasticsearch(**cls.get_es_connection_settings())
-        return cls._es
+        # shared by every type class with the same connection settings, and
+        # replaced in forked processes; see `clients.get_client()`
+        return get_client(**cls.get_es_connection_settings())
 
     @classmethod
     def get_es_connection_settings(cls):
@@ -24,6 +63,15 @@ class ElasticsearchTypeMixin(object):
     def get_index_name(cls):
         raise NotImplementedError
 
+    @classmethod
+    def get_write_index_names(cls, index_name=''):
+        # the indices a write goes to: `index_name` if given, otherwise the
+        # index alias along with any index being rebuilt for it with
+        # `rebuild_indices(dual_write=True)`
+        if index_name:
+            return [index_name]
+        return [cls.get_index_name()] + get_dual_write_indices(cls.get_index_name(), cls.get_es())
+
     @classmethod
     def get_type_name(cls):
         raise NotImplementedError
@@ -32,12 +80,50 @@ class ElasticsearchTypeMixin(object):
     def get_document(cls, obj):
         raise NotImplementedError
 
+    @classmethod
+    def get_document_fields(cls):
+        # the fields `bulk_index` fetches as plain rows (`Row`s) instead of
+        # model instances, building documents with `get_document_from_row()`;
+        # `None` to use model instances and `get_document()`.
+        return cls.document_fields
+
+    @classmethod
+    def get_document_from_row(cls, row):
+        raise NotImplementedError
+
+    @classmethod
+    def get_documents(cls, objs):
+        # builds the documents of a chunk of objects at once for `bulk_index`,
+        # returning a list in the same order (with a falsy value for objects
+        # that can't be indexed); override this to fetch related data for the
+        # whole chunk in a single query rather than once per object.
+        return [
+            cls.get_document_from_row(obj) if isinstance(obj, Row) else cls.get_document(obj)
+            for obj in objs
+        ]
+
     @classmethod
     def get_document_id(cls, obj):
         if not obj:
             raise MissingObjectError
         return obj.pk
 
+    @classmethod
+    def get_document_version(cls, obj):
+        # an optional version for the document of `obj`, which must increase
+        # whenever it changes (ie. a version column or "last modified" time;
+        # datetimes are converted to microseconds since the epoch). Versioned
+        # writes are sent with `version_type=external_gte`, so an older
+        # version never overwrites a newer one, while an equal one (ie. after
+        # a `QuerySet.update()`, which leaves `auto_now` fields alone) is
+        # still written; set `version_field` or override this.
+        if not cls.version_field:
+            return None
+        version = getattr(obj, cls.version_field)
+        if isinstance(version, datetime.datetime):
+            version = calendar.timegm(version.utctimetuple()) * 1000000 + version.microsecond
+        return version
+
     @classmethod
     def get_request_params(cls, obj):
         return {}
@@ -50,10 +136,55 @@ class ElasticsearchTypeMixin(object):
     def get_queryset(cls):
         raise NotImplementedError
 
+    @classmethod
+    def get_changed_queryset(cls, since):
+        # the objects added or modified since the `since` datetime, for delta
+        # reindexing; set `changed_field` to a "last modified" field (ie. one
+        # with `auto_now=True`) or override this.
+        if not cls.changed_field:
+            raise NotImplementedError
+        return cls.get_queryset().filter(**{'{0}__gte'.format(cls.changed_field): since})
+
+    @classmethod
+    def get_deleted_ids(cls, since):
+        # the ids of the documents whose objects were deleted since the `since`
+        # datetime (ie. from a tombstone table or soft-deleted rows), which
+        # delta reindexing removes from the index; see `delete_ids()`
+        return []
+
+    @classmethod
+    def get_delete_request_params(cls, pk):
+        # the request parameters (ie. routing) for deleting the document with
+        # id `pk` when its object isn't available; see `delete_ids()`
+        return {}
+
     @classmethod
     def get_bulk_index_limit(cls):
         return cls.bulk_index_limit
 
+    @classmethod
+    def get_bulk_index_max_bytes(cls):
+        # bulk requests are flushed when either this many bytes of payload or
+        # `get_bulk_index_limit()` documents are reached; either limit can be
+        # disabled by setting it to `None`. Unless set, this is
+        # `ELASTICSEARCH_BULK_INDEX_MAX_BYTES`.
+        if cls.bulk_index_max_bytes is _default:
+            return es_settings.ELASTICSEARCH_BULK_INDEX_MAX_BYTES
+        return cls.bulk_index_max_bytes
+
+    @classmethod
+    def get_bulk_index_senders(cls):
+        # the number of threads sending bulk requests; any positive number
+        # pipelines `bulk_index`, overlapping database reads, document
+        # building and up to this many in-flight bulk requests.
+        return cls.bulk_index_senders
+
+    @classmethod
+    def get_bulk_index_queue_size(cls):
+        # the maximum number of chunks/bulk requests waiting between the
+        # stages of a pipelined `bulk_index`
+        return cls.bulk_index_queue_size
+
     @classmethod
     def get_bulk_ordering(cls):
         return cls.queryset_ordering
@@ -62,55 +193,349 @@ class ElasticsearchTypeMixin(object):
     def get_query_limit(cls):
         return cls.queryset_limit
 
+    @classmethod
+    def get_queryset_strategy(cls):
+        # 'keyset' seeks past the last row seen (`WHERE ordering > last`),
+        # 'cursor' streams the queryset with a single (server-side cursor)
+        # query, while 'offset' uses LIMIT/OFFSET slicing, which slows down as
+        # it progresses but supports orderings on nullable fields.
+        return cls.queryset_strategy
+
     @classmethod
     def should_index(cls, obj):
         return True
 
     @classmethod
-    def bulk_index(cls, es=None, index_name='', queryset=None):
+    def get_bulk_operation(cls, obj, index_name=''):
+        # returns an `(action, document)` pair for `obj`, where `document` is
+        # `None` for a delete operation, or `None` if `obj` can't be indexed.
+        delete = not cls.should_index(obj)
+
+        doc = None
+        if not delete:
+            # allow for the case where a document cannot be indexed;
+            # the implementation of `get_document()` should return a
+            # falsy value.
+            doc = cls.get_document(obj)
+            if not doc:
+                return None
+
+        return cls.get_bulk_action(obj, 'delete' if delete else 'index', index_name), doc
+
+    @classmethod
+    def get_bulk_delete_action(cls, pk, index_name='', params=None):
+        # the action line deleting the document with id `pk`, with request
+        # `params` (by default `get_delete_request_params(pk)`)
+        data = {
+            '_index': index_name or cls.get_index_name(),
+            '_type': cls.get_type_name(),
+            '_id': pk
+        }
+        data.update(cls.get_delete_request_params(pk) if params is None else params)
+        return {'delete': data}
+
+    @classmethod
+    def get_bulk_action(cls, obj, action, index_name=''):
+        # the action/metadata line of a bulk operation on `obj`
+        data = {
+            '_index': index_name or cls.get_index_name(),
+            '_type': cls.get_type_name(),
+            '_id': cls.get_document_id(obj)
+        }
+        data.update(cls.get_request_params(obj))
+        if action == 'index':
+            version = cls.get_document_version(obj)
+            if version is not None:
+                data.update({'_version': version, '_version_type': 'external_gte'})
+        return {action: data}
+
+    @classmethod
+    def iter_bulk_operations(cls, objs, index_name='', stats=None):
+        # yields the bulk operations for `objs`, building the documents a chunk
+        # at a time with `get_documents()`; `stats` is updated with counts of
+        # the operations as they're generated.
+        stats = stats if stats is not None else {}
+        for key in ('indexed', 'deleted', 'skipped'):
+            stats.setdefault(key, 0)
+
+        for chunk in chunked(objs, cls.get_query_limit()):
+            flags = [cls.should_index(obj) for obj in chunk]
+            docs = iter(cls.get_documents([obj for obj, flag in zip(chunk, flags) if flag]))
+
+            for obj, flag in zip(chunk, flags):
+                if not flag:
+                    stats['deleted'] += 1
+                    yield cls.get_bulk_action(obj, 'delete', index_name), None
+                    continue
+
+                # allow for the case where a document cannot be indexed;
+                # `get_documents()` should return a falsy value for it.
+                doc = next(docs)
+                if not doc:
+                    stats['skipped'] += 1
+                    continue
+
+                stats['indexed'] += 1
+                yield cls.get_bulk_action(obj, 'index', index_name), doc
+
+    @classmethod
+    def iter_write_operations(cls, operations, index_name=''):
+        # yields the `(action, document)` pairs of `operations` for each of
+        # `get_write_index_names(index_name)`, so that without an explicit
+        # index, bulk writes also go to the indices being rebuilt with dual
+        # writes, like those of the save/delete handlers
+        names = cls.get_write_index_names(index_name)
+        for action, doc in operations:
+            if len(names) == 1:
+                yield action, doc
+                continue
+            (name, meta), = action.items()
+            for index in names:
+                yield {name: dict(meta, _index=index)}, doc
+
+    @classmethod
+    def get_bulk_sender(cls, es):
+        # the `BulkSender` used by `bulk_index` to send batches, retry rejected
+        # operations and adapt the batch size to the cluster's responses
+        return BulkSender(
+            es,
+            max_docs=cls.get_bulk_index_limit(),
+            max_bytes=cls.get_bulk_index_max_bytes(),
+            concurrency=max(1, cls.get_bulk_index_senders()),
+            max_retries=es_settings.ELASTICSEARCH_BULK_INDEX_MAX_RETRIES,
+            backoff=es_settings.ELASTICSEARCH_BULK_INDEX_RETRY_BACKOFF,
+            target_latency=es_settings.ELASTICSEARCH_BULK_INDEX_TARGET_LATENCY
+        )
+
+    @classmethod
+    def bulk_index(cls, es=None, index_name='', queryset=None, after=None, progress=None):
+        """
+        Indexes (or deletes) every object in `queryset`, by default
+        `get_queryset()`, with bulk requests and returns counts of the
+        operations sent.
+
+        `after` is a position to resume from, as passed to `progress(data)`:
+        `data['after']` is the position (with the keyset strategy) and
+        `data['stats']` the counts up to which every operation has been sent,
+        reported once per queryset chunk.
+        """
         es = es or cls.get_es()
 
-        tmp = []
+        stats = {'indexed': 0, 'deleted': 0, 'skipped': 0}
 
         if queryset is None:
             queryset = cls.get_queryset()
 
-        bulk_limit = cls.get_bulk_index_limit()
+        fields = cls.get_document_fields()
+        if fields:
+            # skip creating model instances; see `get_document_from_row()`
+            queryset = values_queryset(queryset, fields, cls.get_bulk_ordering())
 
         # this requires that `get_queryset` is implemented
-        for i, obj in enumerate(queryset_iterator(queryset, cls.get_query_limit(), cls.get_bulk_ordering())):
-            delete = not cls.should_index(obj)
+        strategy = cls.get_queryset_strategy()
+        iterator = queryset_iterator(
+            queryset,
+            cls.get_query_limit(),
+            cls.get_bulk_ordering(),
+            strategy=strategy,
+            after=after
+        )
+        if fields:
+            iterator = (Row(row) for row in iterator)
+
+        if progress is None:
+            tracker = None
+
+            def operations(objs):
+                return cls.iter_write_operations(cls.iter_bulk_operations(objs, index_name, stats), index_name)
+        else:
+            tracker = BulkProgress(progress)
+
+            def operations(objs):
+                for chunk in chunked(objs, cls.get_query_limit()):
+                    chunk_operations = cls.iter_bulk_operations(chunk, index_name, stats)
+                    for operation in tracker.track(cls.iter_write_operations(chunk_operations, index_name)):
+                        yield operation
+                    position = None
+                    if strategy in RESUMABLE_STRATEGIES:
+                        position = keyset_position(queryset, cls.get_bulk_ordering(), chunk[-1])
+                    tracker.mark({'after': position, 'stats': dict(stats)})
+
+        stats.update(cls.send_bulk(es, iterator, operations, tracker))
+        return stats
 
-            doc = {}
-            if not delete:
-                # allow for the case where a document cannot be indexed;
-                # the implementation of `get_document()` should return a
-                # falsy value.
-                doc = cls.get_document(obj)
-                if not doc:
-                    continue
+    @classmethod
+    def send_bulk(cls, es, items, operations, progress=None):
+        # sends the `(action, document)` pairs yielded by `operations(items)`
+        # in batches via `get_bulk_sender()`, returning the sender's stats.
+        # If the type class has bulk senders, `items` is iterated in a reader
+        # thread and the rest is pipelined; see `bulk.Pipeline`. Inside an
+        # atomic block, the reader thread's own database connection wouldn't
+        # see the transaction's changes, so the work isn't pipelined then.
+        # `progress` is an optional `bulk.BulkProgress` told about the
+        # batches sent. The query log and memory use are checked as `items`
+        # are read; see `bulk.guarded`.
+        sender = cls.get_bulk_sender(es)
+        senders = cls.get_bulk_index_senders()
+        if any(connection.in_atomic_block for connection in connections.all()):
+            senders = 0
+        items = guarded(
+            items,
+            cls.get_query_limit(),
+            es_settings.ELASTICSEARCH_BULK_INDEX_MEMORY_LIMIT,
+            sender.decrease
+        )
+
+        def build(items):
+            if senders:
+                # documents are built in this thread, outside of the reader
+                # thread, so its query log needs resetting too
+                items = guarded(items, cls.get_query_limit())
+            batches = batch_operations(operations(items), es.transport.serializer, limits=sender)
+            if progress is not None:
+                batches = progress.batches(batches)
+            return batches
+
+        def send(batch):
+            rejected = sender.send(batch)
+            invalidate_operations(cls, es.transport.serializer, batch)
+            # a batch with operations the cluster kept rejecting isn't
+            # acknowledged, so progress (ie. a resumable checkpoint) stops
+            # short of it
+            if progress is not None and not rejected:
+                progress.sent(batch)
+
+        if senders:
+            Pipeline(
+                build,
+                send,
+                senders=senders,
+                queue_size=cls.get_bulk_index_queue_size(),
+                chunksize=cls.get_query_limit()
+            ).run(items)
+        else:
+            for batch in build(items):
+                send(batch)
+
+        return sender.stats
 
-            data = {
-                '_index': index_name or cls.get_index_name(),
-                '_type': cls.get_type_name(),
-                '_id': cls.get_document_id(obj)
-            }
-            data.update(cls.get_request_params(obj))
-            data = {'delete' if delete else 'index': data}
+    @classmethod
+    def index_queryset(cls, queryset, es=None, index_name=''):
+        """
+        Reindexes the objects in `queryset`, ie. after a `QuerySet.update()` or
+        `bulk_create()`, which don't send the `post_save` signal. Primary keys
+        are read in chunks and each chunk is loaded through `get_queryset()`;
+        objects no longer returned by it are deleted from the index.
+        """
+        es = es or cls.get_es()
+        stats = {'indexed': 0, 'deleted': 0, 'skipped': 0}
+
+        def items():
+            pks = queryset_iterator(queryset.values('pk'), cls.get_query_limit(), 'pk', strategy='keyset')
+            for chunk in chunked((row['pk'] for row in pks), cls.get_query_limit()):
+                objs = dict((obj.pk, obj) for obj in cls.get_queryset().filter(pk__in=chunk))
+                # the rows `get_queryset()` leaves out, so their deletes are
+                # sent with their request parameters (ie. routing)
+                missing = [pk for pk in chunk if pk not in objs]
+                excluded = dict((obj.pk, obj) for obj in queryset.model._default_manager.filter(pk__in=missing)) \
+                    if missing else {}
+                for pk in chunk:
+                    yield pk, objs.get(pk), excluded.get(pk)
+
+        def operations(items):
+            return cls.iter_write_operations(index_operations(items), index_name)
+
+        def index_operations(items):
+            objs = []
+            for pk, obj, excluded in items:
+                if obj is None:
+                    stats['deleted'] += 1
+                    if excluded is not None:
+                        yield cls.get_bulk_action(excluded, 'delete', index_name), None
+                    else:
+                        yield cls.get_bulk_delete_action(pk, index_name), None
+                else:
+                    objs.append(obj)
+                    if len(objs) >= cls.get_query_limit():
+                        for operation in cls.iter_bulk_operations(objs, index_name, stats):
+                            yield operation
+                        objs = []
+            for operation in cls.iter_bulk_operations(objs, index_name, stats):
+                yield operation
+
+        stats.update(cls.send_bulk(es, items(), operations))
+        return stats
+
+    @classmethod
+    def delete_ids(cls, ids, es=None, index_name=''):
+        """
+        Deletes the documents with the given ids from the index in bulk, ie.
+        after a `QuerySet.delete()`; disconnect `delete_handler` around such
+        deletes to avoid a request per object. `get_request_params()` isn't
+        available without the objects, so routed types should pass
+        `(id, params)` pairs (ie. `(post.pk, {'routing': post.blog_id})`)
+        or override `get_delete_request_params()`. Deletes of documents that
+        weren't found (ie. sent without routing) are counted in `not_found`.
+        """
+        es = es or cls.get_es()
+        stats = {'deleted': 0}
 
-            # bulk operation instructions/details
-            tmp.append(data)
+        def operations(ids):
+            return cls.iter_write_operations(delete_operations(ids), index_name)
+
+        def delete_operations(ids):
+            for pk in ids:
+                params = None
+                if isinstance(pk, tuple):
+                    pk, params = pk
+                stats['deleted'] += 1
+                yield cls.get_bulk_delete_action(pk, index_name, params), None
+
+        stats.update(cls.send_bulk(es, ids, operations))
+        return stats
+
+    @classmethod
+    def reindex(cls, since, es=None, index_name=''):
+        """
+        Brings the index up to date with the changes made since the `since`
+        datetime: `bulk_index()`es `get_changed_queryset(since)` and deletes
+        `get_deleted_ids(since)`.
+        """
+        es = es or cls.get_es()
+        stats = cls.bulk_index(es, index_name, cls.get_changed_queryset(since))
+        for key, value in cls.delete_ids(cls.get_deleted_ids(since), es, index_name).items():
+            stats[key] = stats.get(key, 0) + value
+        return stats
 
-            # only append bulk operation data if it's not a delete operation
-            if not delete:
-                tmp.append(doc)
+    @classmethod
+    def parallel_bulk_index(cls, index_name='', queryset=None, processes=None, partitions=None, callback=None):
+        # splits the queryset into primary key ranges and runs `bulk_index` on
+        # each of them in a pool of worker processes; see `parallel_bulk_index`
+        # in `utils` for details.
+        return parallel_bulk_index(
+            cls,
+            index_name=index_name,
+            queryset=queryset,
+            processes=processes,
+            partitions=partitions,
+            callback=callback
+        )
 
-            if not i % bulk_limit:
-                es.bulk(tmp)
-                tmp = []
+    @classmethod
+    def get_spool(cls):
+        # the `spool.Spool` that `index_add`/`index_delete` queue operations
+        # in for a `SpoolWorker` to send, or `None` to send them directly
+        return get_spool()
 
-        if tmp:
-            es.bulk(tmp)
+    @classmethod
+    def spool_operation(cls, action, doc=None):
+        # queues a bulk operation in the spool, if there is one; returns
+        # whether it was spooled
+        spool = cls.get_spool()
+        if spool is None:
+            return False
+        spool.put(cls, [serialize_operation(cls.get_es().transport.serializer, action, doc)])
+        return True
 
     @classmethod
     def index_add(cls, obj, index_name=''):
@@ -119,29 +544,50 @@ class ElasticsearchTypeMixin(object):
             if not doc:
                 return False
 
-            cls.get_es().index(
-                index_name or cls.get_index_name(),
-                cls.get_type_name(),
-                doc,
-                cls.get_document_id(obj),
-                **cls.get_request_params(obj)
-            )
+            names = cls.get_write_index_names(index_name)
+            for name in names:
+                if cls.spool_operation(cls.get_bulk_action(obj, 'index', name), doc):
+                    continue
+
+                params = cls.get_request_params(obj)
+                version = cls.get_document_version(obj)
+                if version is not None:
+                    params = dict(params, version=version, version_type='external_gte')
+
+                try:
+                    cls.get_es().index(
+                        name,
+                        cls.get_type_name(),
+                        doc,
+                        cls.get_document_id(obj),
+                        **params
+                    )
+                except ConflictError:
+                    # the index already holds this or a newer version
+                    pass
+            invalidate_documents([cls.get_index_name()] + names, cls.get_type_name(), [cls.get_document_id(obj)])
             return True
         return False
 
     @classmethod
     def index_delete(cls, obj, index_name=''):
         if obj:
-            try:
-                cls.get_es().delete(
-                    index_name or cls.get_index_name(),
-                    cls.get_type_name(),
-                    cls.get_document_id(obj),
-                    **cls.get_request_params(obj)
-                )
-            except TransportError as e:
-                if e.status_code != 404:
-                    raise
+            names = cls.get_write_index_names(index_name)
+            for name in names:
+                if cls.spool_operation(cls.get_bulk_action(obj, 'delete', name)):
+                    continue
+
+                try:
+                    cls.get_es().delete(
+                        name,
+                        cls.get_type_name(),
+                        cls.get_document_id(obj),
+                        **cls.get_request_params(obj)
+                    )
+                except TransportError as e:
+                    if e.status_code != 404:
+                        raise
+            invalidate_documents([cls.get_index_name()] + names, cls.get_type_name(), [cls.get_document_id(obj)])
             return True
         return False
 
@@ -156,8 +602,12 @@ class ElasticsearchTypeMixin(object):
 
     @classmethod
     def save_handler(cls, sender, instance, **kwargs):
-        cls.index_add_or_delete(instance)
+        # inside a transaction (or `buffered_writes()`) the write may be
+        # deferred and sent together with others; see `buffer.buffer_write`
+        if not buffer_write(cls, instance):
+            cls.index_add_or_delete(instance)
 
     @classmethod
     def delete_handler(cls, sender, instance, **kwargs):
-        cls.index_delete(instance)
+        if not buffer_write(cls, instance, delete=True):
+            cls.index_delete(instance)
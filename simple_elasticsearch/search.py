@@ -1,4 +1,5 @@
 import warnings
+from multiprocessing.pool import ThreadPool
 
 try:
     from collections.abc import MutableMapping, MutableSequence
@@ -7,9 +8,10 @@ except:
 
 from django.core.paginator import Paginator as DjangoPaginator
 from django.utils.functional import cached_property
-from elasticsearch import Elasticsearch
 
 from . import settings as es_settings
+from .cache import get_search_cache, search_cache_keys
+from .clients import get_client
 
 
 class Paginator(DjangoPaginator):
@@ -124,8 +126,15 @@ class Result(MutableMapping, object):
 
 
 class SimpleSearch(object):
-    def __init__(self, es=None):
-        self.es = es or Elasticsearch(es_settings.ELASTICSEARCH_SERVER)
+    def __init__(self, es=None, cache=None, chunk_size=None, concurrency=None, max_concurrent_searches=None):
+        self.es = es or get_client(hosts=es_settings.ELASTICSEARCH_SERVER)
+        # whether to use the response cache (`ELASTICSEARCH_SEARCH_CACHE_ALIAS`);
+        # `None` for `ELASTICSEARCH_SEARCH_CACHE`
+        self.cache = cache
+        # see `msearch()`
+        self.chunk_size = chunk_size or es_settings.ELASTICSEARCH_MSEARCH_CHUNK_SIZE
+        self.concurrency = concurrency or es_settings.ELASTICSEARCH_MSEARCH_CONCURRENCY
+        self.max_concurrent_searches = max_concurrent_searches or es_settings.ELASTICSEARCH_MAX_CONCURRENT_SEARCHES
         self.bulk_search_data = []
         self.page_ranges = []
 
@@ -154,14 +163,67 @@ class SimpleSearch(object):
         self.bulk_search_data.append(data)
         self.bulk_search_data.append(query)
 
+    def msearch(self, searches):
+        """
+        Sends `(header, query)` searches with `msearch()` in requests of at
+        most `chunk_size` searches, up to `concurrency` of them at once, and
+        returns their responses in the same order (`None` for any that
+        Elasticsearch didn't respond to).
+        """
+        params = {}
+        if self.max_concurrent_searches:
+            params['max_concurrent_searches'] = self.max_concurrent_searches
+
+        size = self.chunk_size or len(searches)
+        chunks = [searches[i:i + size] for i in range(0, len(searches), size)]
+
+        def send(chunk):
+            data = self.es.msearch([item for search in chunk for item in search], **params)
+            responses = list((data or {}).get('responses', []))[:len(chunk)]
+            return responses + [None] * (len(chunk) - len(responses))
+
+        if self.concurrency > 1 and len(chunks) > 1:
+            pool = ThreadPool(min(self.concurrency, len(chunks)))
+            try:
+                results = pool.map(send, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [send(chunk) for chunk in chunks]
+
+        return [response for responses in results for response in responses]
+
     def search(self):
         responses = []
 
         if self.bulk_search_data:
-            # TODO: ES 5.x adds `max_concurrent_searches` as an option to `msearch()`
-            data = self.es.msearch(self.bulk_search_data)
-            for i, tmp in enumerate((data or {}).get('responses', [])):
-                responses.append(Response(tmp, *self.page_ranges[i]))
+            searches = list(zip(self.bulk_search_data[::2], self.bulk_search_data[1::2]))
+            results = [None] * len(searches)
+
+            search_cache = get_search_cache(self.cache)
+            if search_cache is not None:
+                keys = search_cache_keys(search_cache, searches)
+                cached = search_cache.get_many(keys)
+                results = [cached.get(key) for key in keys]
+
+            # only searches missing from the cache are sent
+            missing = [i for i, result in enumerate(results) if result is None]
+            if missing:
+                for i, tmp in zip(missing, self.msearch([searches[i] for i in missing])):
+                    results[i] = tmp
+
+                if search_cache is not None:
+                    # set before `Response` takes the hits out of them
+                    search_cache.set_many(
+                        dict((keys[i], results[i]) for i in missing if results[i] is not None and 'error' not in results[i]),
+                        es_settings.ELASTICSEARCH_SEARCH_CACHE_TIMEOUT
+                    )
+
+            # `None` for searches Elasticsearch didn't respond to, so the
+            # responses line up with the `add_search()` calls
+            for i, tmp in enumerate(results):
+                responses.append(Response(tmp, *self.page_ranges[i]) if tmp is not None else None)
 
         self.reset()
 
@@ -0,0 +1,51 @@
+from django.utils import six
+from django.utils.module_loading import import_string
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+from . import settings as es_settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    A `JSONSerializer` that encodes and decodes with orjson when it is
+    installed, and with the standard library's `json` otherwise (or for
+    anything orjson can't handle, ie. integers over 64 bits). Dates,
+    datetimes and times are passed to `default()`, so they - like decimals
+    and UUIDs - are encoded exactly as `JSONSerializer` encodes them.
+    """
+
+    if orjson is not None:
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def loads(self, s):
+        if orjson is None:
+            return super(FastJSONSerializer, self).loads(s)
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if orjson is None or isinstance(data, six.string_types):
+            return super(FastJSONSerializer, self).dumps(data)
+        try:
+            return orjson.dumps(data, default=self.default, option=self.options).decode('utf-8')
+        except TypeError:
+            return super(FastJSONSerializer, self).dumps(data)
+
+
+_serializer = None
+
+
+def get_serializer():
+    # the `ELASTICSEARCH_SERIALIZER` instance shared by the package's clients
+    global _serializer
+    if _serializer is None:
+        _serializer = import_string(es_settings.ELASTICSEARCH_SERIALIZER)()
+    return _serializer
@@ -63,3 +63,114 @@ ELASTICSEARCH_CUSTOM_INDEX_SETTINGS = getattr(settings, 'ELASTICSEARCH_CUSTOM_IN
 # created, and the alias is switched to the new one from the old, leaving
 # old ones on the ES cluster.
 ELASTICSEARCH_DELETE_OLD_INDEXES = getattr(settings, 'ELASTICSEARCH_DELETE_OLD_INDEXES', False)
+
+# Override this to flush `bulk_index` requests once their payload reaches
+# this many bytes (in addition to the per type class document count limit).
+# Keep it well below the cluster's `http.max_content_length` (100mb by
+# default). Type classes can set their own `bulk_index_max_bytes`.
+ELASTICSEARCH_BULK_INDEX_MAX_BYTES = getattr(settings, 'ELASTICSEARCH_BULK_INDEX_MAX_BYTES', None)
+
+# `bulk_index` retries bulk requests and operations that the cluster rejects
+# because it is overloaded (HTTP 429/503), backing off exponentially from
+# ELASTICSEARCH_BULK_INDEX_RETRY_BACKOFF seconds, at most
+# ELASTICSEARCH_BULK_INDEX_MAX_RETRIES times. The batch size and number of
+# in-flight requests are reduced whenever that happens, or whenever a bulk
+# request takes longer than ELASTICSEARCH_BULK_INDEX_TARGET_LATENCY seconds
+# (if set), and grow back once the cluster keeps up again.
+ELASTICSEARCH_BULK_INDEX_MAX_RETRIES = getattr(settings, 'ELASTICSEARCH_BULK_INDEX_MAX_RETRIES', 5)
+ELASTICSEARCH_BULK_INDEX_RETRY_BACKOFF = getattr(settings, 'ELASTICSEARCH_BULK_INDEX_RETRY_BACKOFF', 0.5)
+ELASTICSEARCH_BULK_INDEX_TARGET_LATENCY = getattr(settings, 'ELASTICSEARCH_BULK_INDEX_TARGET_LATENCY', None)
+
+# Override this in your project settings, setting it to True, to have the
+# `ElasticsearchTypeMixin` save/delete handlers collect writes made inside a
+# transaction and send them in a single bulk request once it commits (nothing
+# is sent if it is rolled back). Repeated writes of the same document are
+# sent once. See also `simple_elasticsearch.buffer.buffered_writes()`.
+ELASTICSEARCH_BUFFER_WRITES = getattr(settings, 'ELASTICSEARCH_BUFFER_WRITES', False)
+
+# Override this with a file path to have `ElasticsearchTypeMixin.index_add`
+# and `index_delete` (and so the save/delete handlers) queue operations in a
+# local SQLite spool instead of sending them to Elasticsearch. Run
+# `es_manage --worker` (or `spool.start_spool_worker()`) to send them on.
+ELASTICSEARCH_SPOOL_PATH = getattr(settings, 'ELASTICSEARCH_SPOOL_PATH', None)
+
+# The index holding `es_manage` progress checkpoints, ie. the time each type
+# class was last brought up to date by `es_manage --reindex`.
+ELASTICSEARCH_CHECKPOINT_INDEX = getattr(settings, 'ELASTICSEARCH_CHECKPOINT_INDEX', '.simple_elasticsearch')
+
+# Override this in your project settings, setting it to True, to have live
+# writes (`index_add`, `index_delete` and the save/delete handlers) also sent
+# to any new index that `rebuild_indices(dual_write=True)` (`es_manage
+# --rebuild --dual-write`) is building for the same alias. Each process
+# checks for such rebuilds at most every ELASTICSEARCH_DUAL_WRITES_TTL
+# seconds.
+ELASTICSEARCH_DUAL_WRITES = getattr(settings, 'ELASTICSEARCH_DUAL_WRITES', False)
+ELASTICSEARCH_DUAL_WRITES_TTL = getattr(settings, 'ELASTICSEARCH_DUAL_WRITES_TTL', 10)
+
+# `rebuild_indices` saves a checkpoint of each type class's progress at most
+# every this many seconds, which `es_manage --rebuild --resume` carries on
+# from if the rebuild fails part way.
+ELASTICSEARCH_REBUILD_CHECKPOINT_INTERVAL = getattr(settings, 'ELASTICSEARCH_REBUILD_CHECKPOINT_INTERVAL', 10)
+
+# Override this with a number of bytes to cap the memory use (resident set
+# size) of processes bulk indexing. Bulk batches are shrunk once 80% of it is
+# reached, and `bulk_index` stops with a `MemoryLimitError` beyond it; rebuilds
+# can then be continued with `es_manage --rebuild --resume`.
+ELASTICSEARCH_BULK_INDEX_MEMORY_LIMIT = getattr(settings, 'ELASTICSEARCH_BULK_INDEX_MEMORY_LIMIT', None)
+
+# The serializer class (as a dotted path) of the Elasticsearch clients created
+# by this package. The default encodes with orjson when it is installed, and
+# produces the same documents as elasticsearch-py's `JSONSerializer`.
+ELASTICSEARCH_SERIALIZER = getattr(settings, 'ELASTICSEARCH_SERIALIZER', 'simple_elasticsearch.serializers.FastJSONSerializer')
+
+# Set this to `True` to gzip the bodies of requests (and accept gzipped
+# responses) from the clients created by this package; worthwhile for bulk
+# requests to a remote cluster. It can also be set per profile (see below), or
+# as `http_compress` in `ELASTICSEARCH_CONNECTION_PARAMS`.
+ELASTICSEARCH_HTTP_COMPRESS = getattr(settings, 'ELASTICSEARCH_HTTP_COMPRESS', False)
+
+# Named sets of client settings applied on top of the connection settings
+# once activated with `clients.activate_profile()` or `es_manage --profile`.
+# Eg. larger connection pools (`maxsize`, per host) and timeouts for rebuilds
+# ELASTICSEARCH_CONNECTION_PROFILES = {
+#     'rebuild': {
+#         'maxsize': 25,
+#         'timeout': 120,
+#         'http_compress': True,
+#     }
+# }
+ELASTICSEARCH_CONNECTION_PROFILES = getattr(settings, 'ELASTICSEARCH_CONNECTION_PROFILES', {})
+
+# The profile used by `es_manage --rebuild`, `--rebuild-worker` and `--reindex`
+# unless `--profile` is given.
+ELASTICSEARCH_REBUILD_PROFILE = getattr(settings, 'ELASTICSEARCH_REBUILD_PROFILE', None)
+
+# Set this to `True` to cache document lookups (`get_from_es_or_None()`,
+# `get_from_es_or_404()` and `get_many_from_es()`) across requests: in each
+# process for `..._LOCAL_TIMEOUT` seconds (up to `..._LOCAL_SIZE` documents),
+# and in the Django cache `..._ALIAS` (if not `None`) for `..._TIMEOUT`
+# seconds. Writes by the type classes invalidate the cached documents.
+ELASTICSEARCH_DOCUMENT_CACHE = getattr(settings, 'ELASTICSEARCH_DOCUMENT_CACHE', False)
+ELASTICSEARCH_DOCUMENT_CACHE_ALIAS = getattr(settings, 'ELASTICSEARCH_DOCUMENT_CACHE_ALIAS', 'default')
+ELASTICSEARCH_DOCUMENT_CACHE_TIMEOUT = getattr(settings, 'ELASTICSEARCH_DOCUMENT_CACHE_TIMEOUT', 60)
+ELASTICSEARCH_DOCUMENT_CACHE_LOCAL_SIZE = getattr(settings, 'ELASTICSEARCH_DOCUMENT_CACHE_LOCAL_SIZE', 1000)
+ELASTICSEARCH_DOCUMENT_CACHE_LOCAL_TIMEOUT = getattr(settings, 'ELASTICSEARCH_DOCUMENT_CACHE_LOCAL_TIMEOUT', 5)
+
+# Set this to `True` to cache `SimpleSearch` responses in the Django cache
+# `..._ALIAS` for `..._TIMEOUT` seconds (`SimpleSearch(cache=True)` uses the
+# cache regardless). Writes by the type classes (and alias changes) make the
+# cached searches of their indices stale straight away, so they update the
+# cache whenever `..._ALIAS` is set; set it to `None` to disable search caching
+# altogether.
+ELASTICSEARCH_SEARCH_CACHE = getattr(settings, 'ELASTICSEARCH_SEARCH_CACHE', False)
+ELASTICSEARCH_SEARCH_CACHE_ALIAS = getattr(settings, 'ELASTICSEARCH_SEARCH_CACHE_ALIAS', 'default')
+ELASTICSEARCH_SEARCH_CACHE_TIMEOUT = getattr(settings, 'ELASTICSEARCH_SEARCH_CACHE_TIMEOUT', 60)
+
+# `SimpleSearch.search()` sends its searches in `msearch` requests of at most
+# `ELASTICSEARCH_MSEARCH_CHUNK_SIZE` searches (all in one if `None`), up to
+# `ELASTICSEARCH_MSEARCH_CONCURRENCY` requests at once. Elasticsearch runs at
+# most `ELASTICSEARCH_MAX_CONCURRENT_SEARCHES` of a request's searches at once
+# (Elasticsearch's default if `None`).
+ELASTICSEARCH_MSEARCH_CHUNK_SIZE = getattr(settings, 'ELASTICSEARCH_MSEARCH_CHUNK_SIZE', None)
+ELASTICSEARCH_MSEARCH_CONCURRENCY = getattr(settings, 'ELASTICSEARCH_MSEARCH_CONCURRENCY', 1)
+ELASTICSEARCH_MAX_CONCURRENT_SEARCHES = getattr(settings, 'ELASTICSEARCH_MAX_CONCURRENT_SEARCHES', None)
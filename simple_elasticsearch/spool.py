@@ -0,0 +1,214 @@
+import collections
+import logging
+import sqlite3
+import threading
+
+from django.utils.module_loading import import_string
+from elasticsearch import TransportError
+
+from . import settings as es_settings
+from .bulk import FAILED, REJECTED, RETRY_STATUSES, BulkSender
+from .cache import invalidate_operations
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """
+    A durable, append-only queue of serialized bulk operations stored in a
+    local SQLite database. Web processes `put()` operations into it instead
+    of sending them to Elasticsearch, and a `SpoolWorker` sends them on in
+    bulk. Each call opens its own SQLite connection, so a spool is safe to use
+    from any thread or (forked) process.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._created = False
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        if not self._created:
+            # WAL allows the worker to read while web processes write
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS operations ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'type_class TEXT NOT NULL, '
+                'operation TEXT NOT NULL)'
+            )
+            connection.commit()
+            self._created = True
+        return connection
+
+    def put(self, type_class, operations):
+        path = '{0}.{1}'.format(type_class.__module__, type_class.__name__)
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT INTO operations (type_class, operation) VALUES (?, ?)',
+                    [(path, operation) for operation in operations]
+                )
+        finally:
+            connection.close()
+
+    def get(self, limit=500):
+        # the oldest `limit` operations as `(id, type class path, operation)`
+        connection = self.connect()
+        try:
+            return connection.execute(
+                'SELECT id, type_class, operation FROM operations ORDER BY id LIMIT ?', (limit,)
+            ).fetchall()
+        finally:
+            connection.close()
+
+    def remove(self, ids):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany('DELETE FROM operations WHERE id = ?', [(i,) for i in ids])
+        finally:
+            connection.close()
+
+    def __len__(self):
+        connection = self.connect()
+        try:
+            return connection.execute('SELECT COUNT(*) FROM operations').fetchone()[0]
+        finally:
+            connection.close()
+
+
+_spools = {}
+
+
+def get_spool(path=None):
+    # the spool at `path` (by default `ELASTICSEARCH_SPOOL_PATH`), or `None`
+    # if spooling isn't configured
+    path = path or es_settings.ELASTICSEARCH_SPOOL_PATH
+    if not path:
+        return None
+    if path not in _spools:
+        _spools[path] = Spool(path)
+    return _spools[path]
+
+
+class SpoolWorker(object):
+    """
+    Drains a `Spool`, sending its operations to Elasticsearch in bulk, in the
+    order they were spooled. While Elasticsearch is unavailable (or rejecting
+    requests) operations stay in the spool and are retried, backing off
+    exponentially up to `max_backoff` seconds. Operations that Elasticsearch
+    fails for any other reason are logged and dropped. Run a single worker
+    per spool.
+    """
+
+    def __init__(self, spool, batch_size=500, interval=1.0, backoff=0.5, max_backoff=60):
+        self.spool = spool
+        self.batch_size = batch_size
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {'sent': 0, 'failed': 0}
+        self.stopped = threading.Event()
+
+    def send(self, rows):
+        # sends `rows`, removing them from the spool once Elasticsearch has
+        # acknowledged (or permanently failed) them; returns the number of
+        # rows left spooled because Elasticsearch kept rejecting them
+        groups = collections.OrderedDict()
+        for pk, path, operation in rows:
+            groups.setdefault(path, []).append((pk, operation))
+
+        removed = 0
+        for path, operations in groups.items():
+            type_class = import_string(path)
+            es = type_class.get_es()
+            sender = BulkSender(
+                es,
+                max_retries=es_settings.ELASTICSEARCH_BULK_INDEX_MAX_RETRIES,
+                backoff=es_settings.ELASTICSEARCH_BULK_INDEX_RETRY_BACKOFF
+            )
+            try:
+                outcomes = sender.send_items([operation for pk, operation in operations])
+            except TransportError as e:
+                if isinstance(e.status_code, int) and e.status_code < 500 and e.status_code not in RETRY_STATUSES:
+                    # the request itself is bad; retrying won't help
+                    logger.error('Dropping %d spooled operation(s) for `%s`: %s', len(operations), path, e)
+                    self.stats['failed'] += len(operations)
+                    self.spool.remove([pk for pk, operation in operations])
+                    removed += len(operations)
+                    continue
+                raise
+
+            rejected = REJECTED in outcomes
+            if rejected:
+                # keep everything from the first rejected operation on (and
+                # the groups after it), so a document's writes are still
+                # applied in the order they were spooled; resending the
+                # operations that were acknowledged is harmless
+                done = outcomes.index(REJECTED)
+                kept = len(rows) - removed - done
+                operations = operations[:done]
+                outcomes = outcomes[:done]
+            failed = outcomes.count(FAILED)
+
+            invalidate_operations(type_class, es.transport.serializer, [operation for pk, operation in operations])
+            self.stats['sent'] += len(operations) - failed
+            self.stats['failed'] += failed
+            self.spool.remove([pk for pk, operation in operations])
+            if rejected:
+                return kept
+            removed += len(operations)
+        return 0
+
+    def drain(self):
+        """
+        Sends everything currently in the spool, waiting for Elasticsearch to
+        become available if required. Returns the number of operations sent.
+        """
+        attempt = 0
+        count = 0
+        while not self.stopped.is_set():
+            rows = self.spool.get(self.batch_size)
+            if not rows:
+                break
+
+            try:
+                kept = self.send(rows)
+            except TransportError as e:
+                kept, error = len(rows), e
+            else:
+                error = '{0} operation(s) rejected'.format(kept)
+            count += len(rows) - kept
+
+            if kept:
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                logger.warning('Elasticsearch unavailable (%s); retrying spooled operations in %ss.', error, delay)
+                self.stopped.wait(delay)
+                attempt += 1
+                continue
+            attempt = 0
+        return count
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.drain():
+                self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_spool_worker(spool=None, **kwargs):
+    """
+    Runs a `SpoolWorker` in a daemon thread of the current process and
+    returns it. Start it after forking (ie. in a gunicorn `post_fork` hook),
+    and in a single process per spool.
+    """
+    worker = SpoolWorker(spool or get_spool(), **kwargs)
+    thread = threading.Thread(target=worker.run)
+    thread.daemon = True
+    thread.start()
+    return worker
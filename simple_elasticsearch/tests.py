@@ -1,8 +1,26 @@
+import calendar
+import collections
 import copy
+import datetime
+import decimal
+import gzip
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import threading
+import uuid
 from datadiff import tools as ddtools
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
 from django.core.paginator import Page
-from django.test import TestCase
-from elasticsearch import Elasticsearch
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import six, timezone
+from elasticsearch import ConflictError, ConnectionError, Elasticsearch, NotFoundError, TransportError
+from elasticsearch.serializer import JSONSerializer
 import mock
 
 try:
@@ -12,9 +30,22 @@ except NameError:
     from imp import reload
 
 from . import settings as es_settings
+from .exceptions import BulkIndexError, MemoryLimitError
+from . import serializers, utils
+from .buffer import buffered_writes
+from . import cache
+from .cache import LocalCache, RequestCacheMiddleware, request_cache
+from . import clients
+from .clients import create_client
+from .bulk import BulkProgress, BulkSender, Pipeline, batch_operations, chunked, guarded
 from .search import SimpleSearch
+from .spool import Spool, SpoolWorker
 from .mixins import ElasticsearchTypeMixin
 from .models import Blog, BlogPost
+from .utils import (
+    filter_partition, finalize_rebuild, parse_since, partition_queryset, prepare_rebuild, queryset_iterator,
+    rebuild_indices, rebuild_partition, reindex_indices
+)
 
 
 class ElasticsearchTypeMixinClass(ElasticsearchTypeMixin):
@@ -27,8 +58,8 @@ class ElasticsearchTypeMixinTestCase(TestCase):
     def latest_post(self):
         return BlogPost.objects.select_related('blog').latest('id')
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.delete')
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
     def setUp(self, mock_index, mock_delete):
         self.blog = Blog.objects.create(
             name='test blog name',
@@ -62,8 +93,6 @@ class ElasticsearchTypeMixinTestCase(TestCase):
         self.assertEqual(result.transport.hosts[0]['port'], 9200)
 
     def test__get_es__with_custom_server(self):
-        # include a custom class here as the internal `_es` is cached, so can't reuse the
-        # `ElasticsearchIndexClassDefaults` global class (see above).
         class ElasticsearchIndexClassCustomSettings(ElasticsearchTypeMixin):
             pass
 
@@ -77,8 +106,6 @@ class ElasticsearchTypeMixinTestCase(TestCase):
         reload(es_settings)
 
     def test__get_es__with_custom_connection_settings(self):
-        # include a custom class here as the internal `_es` is cached, so can't reuse the
-        # `ElasticsearchIndexClassDefaults` global class (see above).
         class ElasticsearchIndexClassCustomSettings(ElasticsearchTypeMixin):
             pass
 
@@ -113,7 +140,7 @@ class ElasticsearchTypeMixinTestCase(TestCase):
         post.delete()
         mock_index_delete.assert_called_with(post)
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.index')
     def test__index_add(self, mock_index):
         post = self.latest_post
         mock_index.return_value = {}
@@ -140,7 +167,33 @@ class ElasticsearchTypeMixinTestCase(TestCase):
         result = BlogPost.index_add(post)
         self.assertFalse(result)
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__index_add_versioned(self, mock_index):
+        post = self.latest_post
+        version = BlogPost.get_document_version(post)
+        self.assertIsNone(version)
+
+        BlogPost.version_field = 'created_at'
+        self.addCleanup(setattr, BlogPost, 'version_field', None)
+
+        version = BlogPost.get_document_version(post)
+        self.assertEqual(version // 1000000, calendar.timegm(post.created_at.utctimetuple()))
+        self.assertEqual(version % 1000000, post.created_at.microsecond)
+
+        BlogPost.index_add(post)
+        mock_index.assert_called_with(
+            'blog', 'posts', BlogPost.get_document(post), post.pk,
+            routing=1, version=version, version_type='external_gte'
+        )
+        self.assertEqual(BlogPost.get_bulk_action(post, 'index')['index']['_version'], version)
+        self.assertEqual(BlogPost.get_bulk_action(post, 'index')['index']['_version_type'], 'external_gte')
+        self.assertNotIn('_version', BlogPost.get_bulk_action(post, 'delete')['delete'])
+
+        # a newer version already in the index isn't an error
+        mock_index.side_effect = ConflictError(409, 'version_conflict_engine_exception')
+        self.assertTrue(BlogPost.index_add(post))
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
     def test__index_delete(self, mock_delete):
         post = self.latest_post
         mock_delete.return_value = {
@@ -292,7 +345,7 @@ class ElasticsearchTypeMixinTestCase(TestCase):
         with self.assertRaises(NotImplementedError):
             ElasticsearchTypeMixinClass.get_document(1)
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.index')
     def test__should_index(self, mock_index):
         post = self.latest_post
         self.assertTrue(BlogPost.should_index(post))
@@ -308,7 +361,7 @@ class ElasticsearchTypeMixinTestCase(TestCase):
     def test__bulk_index_queryset(self, mock_queryset_iterator):
         queryset = BlogPost.get_queryset().exclude(slug='DO-NOT-INDEX')
         BlogPost.bulk_index(queryset=queryset)
-        mock_queryset_iterator.assert_called_with(queryset, BlogPost.get_query_limit(), 'pk')
+        mock_queryset_iterator.assert_called_with(queryset, BlogPost.get_query_limit(), 'pk', strategy='keyset', after=None)
 
         mock_queryset_iterator.reset_mock()
 
@@ -322,25 +375,35 @@ class ElasticsearchTypeMixinTestCase(TestCase):
         # hack in a test for ensuring the proper bulk ordering is used
         BlogPost.bulk_ordering = 'created_at'
         BlogPost.bulk_index(queryset=queryset)
-        mock_queryset_iterator.assert_called_with(queryset, BlogPost.get_query_limit(), 'created_at')
+        mock_queryset_iterator.assert_called_with(queryset, BlogPost.get_query_limit(), 'created_at', strategy='keyset', after=None)
         BlogPost.bulk_ordering = 'pk'
 
+        mock_queryset_iterator.reset_mock()
+
+        # the old LIMIT/OFFSET behaviour is still available per type class
+        BlogPost.queryset_strategy = 'offset'
+        BlogPost.bulk_index(queryset=queryset)
+        mock_queryset_iterator.assert_called_with(queryset, BlogPost.get_query_limit(), 'pk', strategy='offset', after=None)
+        BlogPost.queryset_strategy = 'keyset'
+
 
     @mock.patch('simple_elasticsearch.models.BlogPost.get_document')
     @mock.patch('simple_elasticsearch.models.BlogPost.should_index')
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.bulk')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
     def test__bulk_index_should_index(self, mock_bulk, mock_should_index, mock_get_document):
         # hack the return value to ensure we save some BlogPosts here;
         # without this mock, the post_save handler indexing blows up
         # as there is no real ES instance running
         mock_bulk.return_value = {}
+        # documents are serialized before being handed to `es.bulk()`
+        mock_get_document.return_value = {'title': 'foo'}
 
         queryset_count = BlogPost.get_queryset().count()
         BlogPost.bulk_index()
         self.assertTrue(mock_should_index.call_count == queryset_count)
 
     @mock.patch('simple_elasticsearch.models.BlogPost.get_document')
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.bulk')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
     def test__bulk_index_get_document(self, mock_bulk, mock_get_document):
         mock_bulk.return_value = mock_get_document.return_value = {}
 
@@ -351,7 +414,50 @@ class ElasticsearchTypeMixinTestCase(TestCase):
         # get_document function will get called one less time due to this.
         self.assertTrue(mock_get_document.call_count == (queryset_count - 1))
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.bulk')
+    @mock.patch('simple_elasticsearch.models.BlogPost.get_document')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_get_documents(self, mock_bulk, mock_get_document):
+        mock_bulk.return_value = {}
+
+        def get_documents(objs):
+            # skip every other document
+            return [{'title': obj.title} if i % 2 else None for i, obj in enumerate(objs)]
+
+        with mock.patch.object(BlogPost, 'get_documents', side_effect=get_documents) as mock_get_documents:
+            with mock.patch.object(BlogPost, 'get_query_limit', return_value=4):
+                stats = BlogPost.bulk_index()
+
+        # documents are built a chunk at a time, for the objects to be indexed
+        self.assertEqual([len(c[0][0]) for c in mock_get_documents.call_args_list], [3, 4, 2])
+        self.assertFalse(mock_get_document.called)
+        self.assertEqual(stats['indexed'], 4)
+        self.assertEqual(stats['skipped'], 5)
+        self.assertEqual(stats['deleted'], 1)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_document_fields(self, mock_bulk):
+        mock_bulk.return_value = {}
+
+        def get_document_from_row(row):
+            return {'title': row['title'], 'slug': row.slug, 'blog': {'name': row['blog__name']}}
+
+        BlogPost.document_fields = ('title', 'slug', 'blog_id', 'blog__name')
+        self.addCleanup(setattr, BlogPost, 'document_fields', None)
+        with mock.patch.object(BlogPost, 'get_document_from_row', side_effect=get_document_from_row):
+            with self.assertNumQueries(1):
+                stats = BlogPost.bulk_index()
+        self.assertEqual(stats['indexed'], 9)
+        self.assertEqual(stats['deleted'], 1)
+
+        operations = [op.split('\n') for c in mock_bulk.call_args_list for op in c[0][0]]
+        post = self.latest_post
+        self.assertEqual(json.loads(operations[-1][0]), {'index': {'_index': 'blog', '_type': 'posts', '_id': post.pk, 'routing': self.blog.pk}})
+        self.assertEqual(json.loads(operations[-1][1]), {'title': post.title, 'slug': post.slug, 'blog': {'name': self.blog.name}})
+
+    def test__get_document_from_row_notimplemented(self):
+        self.assertRaises(NotImplementedError, BlogPost.get_document_from_row, {})
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
     def test__bulk_index_bulk(self, mock_bulk):
         mock_bulk.return_value = {}
 
@@ -360,9 +466,1462 @@ class ElasticsearchTypeMixinTestCase(TestCase):
 
         # figure out how many times es.bulk() should get called in the
         # .bulk_index() method and verify it's the same
-        bulk_times = int(queryset_count / BlogPost.get_bulk_index_limit()) + 1
+        bulk_times = int(math.ceil(queryset_count / float(BlogPost.get_bulk_index_limit())))
         self.assertTrue(mock_bulk.call_count == bulk_times)
 
+        # each request holds at most `get_bulk_index_limit()` operations
+        for c in mock_bulk.call_args_list:
+            self.assertTrue(len(c[0][0]) <= BlogPost.get_bulk_index_limit())
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_max_bytes(self, mock_bulk):
+        mock_bulk.return_value = {}
+
+        with mock.patch.object(BlogPost, 'bulk_index_max_bytes', 300):
+            with mock.patch.object(BlogPost, 'get_bulk_index_limit', return_value=None):
+                BlogPost.bulk_index()
+
+        operations = []
+        for c in mock_bulk.call_args_list:
+            body = c[0][0]
+            operations.extend(body)
+            if len(body) > 1:
+                self.assertTrue(len('\n'.join(body)) + 1 <= 300)
+        self.assertEqual(len(operations), BlogPost.get_queryset().count())
+        self.assertTrue(mock_bulk.call_count > 1)
+
+    def test__bulk_index_max_bytes_setting(self):
+        # the setting applies unless the type class sets its own limit, or
+        # disables it with `None`
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_BULK_INDEX_MAX_BYTES', 1000):
+            self.assertEqual(BlogPost.get_bulk_index_max_bytes(), 1000)
+            with mock.patch.object(BlogPost, 'bulk_index_max_bytes', 300):
+                self.assertEqual(BlogPost.get_bulk_index_max_bytes(), 300)
+            with mock.patch.object(BlogPost, 'bulk_index_max_bytes', None):
+                self.assertEqual(BlogPost.get_bulk_index_max_bytes(), None)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_stats(self, mock_bulk):
+        mock_bulk.return_value = {}
+        stats = BlogPost.bulk_index()
+        self.assertEqual(stats, {'indexed': 9, 'deleted': 1, 'skipped': 0, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0})
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_progress(self, mock_bulk):
+        mock_bulk.return_value = {}
+        pks = list(BlogPost.objects.order_by('pk').values_list('pk', flat=True))
+
+        progress = mock.Mock()
+        with mock.patch.object(BlogPost, 'get_query_limit', return_value=4):
+            BlogPost.bulk_index(progress=progress)
+        self.assertEqual([c[0][0]['after'] for c in progress.call_args_list], [[pks[3]], [pks[7]], [pks[9]]])
+        self.assertEqual(progress.call_args_list[1][0][0]['stats'], {'indexed': 7, 'deleted': 1, 'skipped': 0})
+
+        # resuming after a position only sends what follows it
+        mock_bulk.reset_mock()
+        stats = BlogPost.bulk_index(after=[pks[3]])
+        self.assertEqual(stats['indexed'], 6)
+        self.assertEqual(mock_bulk.call_count, 3)
+
+        # batches with operations the cluster kept rejecting aren't
+        # acknowledged, so progress stops short of them
+        mock_bulk.return_value = {'errors': True, 'items': [{'index': {'status': 429}}]}
+        progress.reset_mock()
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_BULK_INDEX_MAX_RETRIES', 0), \
+                mock.patch('simple_elasticsearch.bulk.logger'):
+            stats = BlogPost.bulk_index(progress=progress)
+        self.assertEqual(stats['failed'], mock_bulk.call_count - 3)
+        self.assertFalse(progress.called)
+
+        with mock.patch.object(BlogPost, 'get_queryset_strategy', return_value='offset'):
+            with self.assertRaises(ValueError):
+                BlogPost.bulk_index(after=[pks[3]])
+
+    def test__partition_queryset(self):
+        queryset = BlogPost.objects.all()
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+
+        partitions = partition_queryset(queryset, 4)
+        self.assertEqual(len(partitions), 4)
+        self.assertIsNone(partitions[0][0])
+        self.assertIsNone(partitions[-1][1])
+
+        # ranges are contiguous and cover every row exactly once
+        result = []
+        for lower, upper in partitions:
+            result.extend(filter_partition(queryset, lower, upper).order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(result, pks)
+
+        # never more partitions than rows
+        self.assertEqual(len(partition_queryset(queryset, 100)), len(pks))
+        self.assertEqual(partition_queryset(queryset.none(), 4), [(None, None)])
+
+    @mock.patch('simple_elasticsearch.utils.multiprocessing.Pool')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__parallel_bulk_index(self, mock_bulk, mock_pool):
+        mock_bulk.return_value = {}
+        # run the workers inline; forking isn't needed to test the plumbing
+        mock_pool.return_value.imap_unordered.side_effect = lambda func, tasks: map(func, tasks)
+
+        callback = mock.Mock()
+        stats = BlogPost.parallel_bulk_index(processes=2, callback=callback)
+        mock_pool.assert_called_with(2)
+        self.assertEqual(callback.call_count, 8)
+        self.assertEqual(stats, {'indexed': 9, 'deleted': 1, 'skipped': 0, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0, 'errors': []})
+
+        # a custom queryset is sent to the workers as its query
+        queryset = BlogPost.get_queryset().exclude(slug='DO-NOT-INDEX')
+        stats = BlogPost.parallel_bulk_index(queryset=queryset, processes=2)
+        self.assertEqual(stats['indexed'], 9)
+        self.assertEqual(stats['deleted'], 0)
+
+        # failures are reported per partition rather than aborting the others
+        mock_bulk.side_effect = [Exception('boom')] + [{}] * 10
+        stats = BlogPost.parallel_bulk_index(processes=2, partitions=2)
+        self.assertEqual(len(stats['errors']), 1)
+        self.assertIn('boom', stats['errors'][0]['error'])
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__index_queryset_versioned(self, mock_bulk):
+        # `update()` leaves the version field alone, so the documents are
+        # resent with the version they were indexed with, which
+        # `external_gte` accepts
+        mock_bulk.return_value = {}
+        BlogPost.version_field = 'created_at'
+        self.addCleanup(setattr, BlogPost, 'version_field', None)
+
+        queryset = BlogPost.objects.filter(title__startswith='blog post title')
+        versions = dict((post.pk, BlogPost.get_document_version(post)) for post in queryset)
+        queryset.update(body='updated')
+        BlogPost.index_queryset(queryset)
+
+        operations = [[json.loads(line) for line in op.split('\n')] for c in mock_bulk.call_args_list for op in c[0][0]]
+        self.assertEqual(len(operations), len(versions))
+        for (action, doc) in operations:
+            self.assertEqual(action['index']['_version'], versions[action['index']['_id']])
+            self.assertEqual(action['index']['_version_type'], 'external_gte')
+            self.assertEqual(doc['body'], 'updated')
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__index_queryset(self, mock_bulk):
+        mock_bulk.return_value = {}
+
+        # `update()` doesn't send `post_save`
+        queryset = BlogPost.objects.filter(title__startswith='blog post title')
+        queryset.update(body='updated')
+
+        with mock.patch.object(BlogPost, 'get_query_limit', return_value=4):
+            stats = BlogPost.index_queryset(queryset)
+        self.assertEqual(stats, {'indexed': 9, 'deleted': 0, 'skipped': 0, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0})
+        self.assertEqual(mock_bulk.call_count, 5)
+
+        docs = [json.loads(op.split('\n')[1]) for c in mock_bulk.call_args_list for op in c[0][0]]
+        self.assertEqual(set(doc['body'] for doc in docs), set(['updated']))
+
+        # rows that shouldn't be indexed, or that `get_queryset()` no longer
+        # returns, are deleted
+        mock_bulk.reset_mock()
+        with mock.patch.object(BlogPost, 'get_queryset', return_value=BlogPost.objects.exclude(pk=self.latest_post.pk)):
+            stats = BlogPost.index_queryset(BlogPost.objects.all())
+        self.assertEqual(stats['indexed'], 8)
+        self.assertEqual(stats['deleted'], 2)
+
+        # with the routing of the objects that are still in the database
+        deletes = [json.loads(op) for c in mock_bulk.call_args_list for op in c[0][0] if '\n' not in op]
+        self.assertEqual(len(deletes), 2)
+        for op in deletes:
+            self.assertEqual(op['delete']['routing'], self.blog.pk)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__reindex(self, mock_bulk):
+        mock_bulk.return_value = {}
+
+        with self.assertRaises(NotImplementedError):
+            BlogPost.get_changed_queryset(timezone.now())
+
+        BlogPost.changed_field = 'created_at'
+        self.addCleanup(setattr, BlogPost, 'changed_field', None)
+
+        stats = BlogPost.reindex(timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(stats, {'indexed': 9, 'deleted': 1, 'skipped': 0, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0})
+
+        # nothing has changed since now, but deletions come from the tombstone hook
+        mock_bulk.reset_mock()
+        with mock.patch.object(BlogPost, 'get_deleted_ids', return_value=[42]) as mock_get_deleted_ids:
+            since = timezone.now()
+            stats = BlogPost.reindex(since)
+        mock_get_deleted_ids.assert_called_with(since)
+        self.assertEqual(stats, {'indexed': 0, 'deleted': 1, 'skipped': 0, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0})
+        self.assertEqual(json.loads(mock_bulk.call_args[0][0][0]), {'delete': {'_index': 'blog', '_type': 'posts', '_id': 42}})
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    @mock.patch('simple_elasticsearch.utils.CheckpointStore.get')
+    def test__dual_writes(self, mock_get, mock_index, mock_delete):
+        mock_get.return_value = {'index': 'blog-new'}
+        self.addCleanup(utils._dual_write_indices.clear)
+
+        # off unless enabled
+        BlogPost.index_add(self.latest_post)
+        self.assertEqual([c[0][0] for c in mock_index.call_args_list], ['blog'])
+        self.assertFalse(mock_get.called)
+
+        mock_index.reset_mock()
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_DUAL_WRITES', True):
+            BlogPost.index_add(self.latest_post)
+            BlogPost.index_delete(self.latest_post)
+            BlogPost.index_add(self.latest_post, 'foo')
+        self.assertEqual([c[0][0] for c in mock_index.call_args_list], ['blog', 'blog-new', 'foo'])
+        self.assertEqual([c[0][0] for c in mock_delete.call_args_list], ['blog', 'blog-new'])
+
+        # the rebuild state is cached
+        self.assertEqual(mock_get.call_count, 1)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    @mock.patch('simple_elasticsearch.utils.CheckpointStore.get')
+    def test__dual_writes_bulk(self, mock_get, mock_bulk):
+        mock_get.return_value = {'index': 'blog-new'}
+        mock_bulk.return_value = {}
+        self.addCleanup(utils._dual_write_indices.clear)
+
+        # bulk writes without an explicit index go to the rebuilt index too
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_DUAL_WRITES', True):
+            BlogPost.index_queryset(BlogPost.objects.filter(pk=self.latest_post.pk))
+            BlogPost.delete_ids([1])
+            BlogPost.delete_ids([2], index_name='foo')
+            BlogPost.bulk_index(queryset=BlogPost.objects.filter(pk=self.latest_post.pk))
+        actions = [json.loads(op.split('\n')[0]) for c in mock_bulk.call_args_list for op in c[0][0]]
+        self.assertEqual(
+            [(list(action)[0], list(action.values())[0]['_index']) for action in actions],
+            [('index', 'blog'), ('index', 'blog-new'), ('delete', 'blog'), ('delete', 'blog-new'), ('delete', 'foo'),
+             ('index', 'blog'), ('index', 'blog-new')]
+        )
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__delete_ids(self, mock_bulk):
+        mock_bulk.return_value = {}
+
+        stats = BlogPost.delete_ids(range(1, 6))
+        self.assertEqual(stats, {'deleted': 5, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0})
+        self.assertEqual(mock_bulk.call_count, 3)
+
+        ops = [json.loads(op) for c in mock_bulk.call_args_list for op in c[0][0]]
+        self.assertEqual(ops[0], {'delete': {'_index': 'blog', '_type': 'posts', '_id': 1}})
+        self.assertEqual([op['delete']['_id'] for op in ops], [1, 2, 3, 4, 5])
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__delete_ids_routed(self, mock_bulk):
+        # deletes of documents that weren't found are counted
+        mock_bulk.return_value = {'items': [
+            {'delete': {'_id': 1, 'status': 200, 'found': True}},
+            {'delete': {'_id': 2, 'status': 404, 'found': False, 'result': 'not_found'}},
+        ]}
+        stats = BlogPost.delete_ids([(1, {'routing': 3}), 2])
+        self.assertEqual(stats, {'deleted': 2, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 1})
+
+        ops = [json.loads(op) for op in mock_bulk.call_args[0][0]]
+        self.assertEqual(ops, [
+            {'delete': {'_index': 'blog', '_type': 'posts', '_id': 1, 'routing': 3}},
+            {'delete': {'_index': 'blog', '_type': 'posts', '_id': 2}},
+        ])
+
+        # or routed by `get_delete_request_params()`
+        with mock.patch.object(BlogPost, 'get_delete_request_params', return_value={'routing': 5}):
+            BlogPost.delete_ids([2])
+        self.assertEqual(json.loads(mock_bulk.call_args[0][0][0])['delete']['routing'], 5)
+
+
+class QuerysetIteratorTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index):
+        mock_index.return_value = {}
+        self.blogs = [
+            Blog.objects.create(name='blog {0}'.format(x), description='') for x in range(3)
+        ]
+        for x in range(10):
+            BlogPost.objects.create(
+                blog=self.blogs[x % 3],
+                title="blog post title {0}".format(x),
+                slug="blog-post-title-{0}".format(x),
+                body="blog post body {0}".format(x)
+            )
+
+    def test__keyset(self):
+        queryset = BlogPost.objects.all()
+        expected = list(queryset.order_by('pk'))
+        for chunksize in (1, 3, 10, 100):
+            result = list(queryset_iterator(queryset, chunksize, 'pk', strategy='keyset'))
+            self.assertEqual(result, expected)
+
+    def test__keyset_non_unique_ordering(self):
+        # ordering on a non-unique field gets the pk added as a tie-breaker so
+        # that no rows are skipped or repeated on chunk boundaries
+        queryset = BlogPost.objects.all()
+        expected = list(queryset.order_by('-blog', 'pk'))
+        result = list(queryset_iterator(queryset, 2, ['-blog'], strategy='keyset'))
+        self.assertEqual(result, expected)
+
+        expected = list(queryset.order_by('blog__name', '-pk'))
+        result = list(queryset_iterator(queryset, 4, ('blog__name', '-pk'), strategy='keyset'))
+        self.assertEqual(result, expected)
+
+    def test__keyset_query_count(self):
+        # one query per full chunk plus a final (short) one
+        with self.assertNumQueries(4):
+            list(queryset_iterator(BlogPost.objects.all(), 3, 'pk', strategy='keyset'))
+
+    def test__offset(self):
+        queryset = BlogPost.objects.all()
+        result = list(queryset_iterator(queryset, 3, 'pk', strategy='offset'))
+        self.assertEqual(result, list(queryset.order_by('pk')))
+
+    def test__cursor(self):
+        queryset = BlogPost.objects.all()
+        expected = list(queryset.order_by('-blog', 'pk'))
+        with self.assertNumQueries(1):
+            result = list(queryset_iterator(queryset, 3, ['-blog'], strategy='cursor'))
+        self.assertEqual(result, expected)
+
+        # it can start part way through, like keyset iteration
+        after = [expected[4].blog_id, expected[4].pk]
+        result = list(queryset_iterator(queryset, 3, ['-blog'], strategy='cursor', after=after))
+        self.assertEqual(result, expected[5:])
+
+        with self.assertRaises(ValueError):
+            queryset_iterator(queryset, 3, 'pk', strategy='offset', after=after)
+
+    def test__unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            list(queryset_iterator(BlogPost.objects.all(), 3, 'pk', strategy='foo'))
+
+
+class BatchOperationsTestCase(TestCase):
+
+    def setUp(self):
+        self.serializer = JSONSerializer()
+
+    def operations(self, sizes):
+        # index operations whose documents are roughly `size` bytes long
+        return [
+            ({'index': {'_id': i}}, {'body': 'x' * size}) for i, size in enumerate(sizes)
+        ]
+
+    def test__max_docs(self):
+        batches = list(batch_operations(self.operations([10] * 5), self.serializer, max_docs=2))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+    def test__max_bytes(self):
+        operations = self.operations([50, 50, 50, 200, 50])
+        batches = list(batch_operations(operations, self.serializer, max_bytes=200))
+        self.assertEqual([len(b) for b in batches], [2, 1, 1, 1])
+        for batch in batches:
+            if len(batch) > 1:
+                self.assertTrue(sum(len(o) + 1 for o in batch) <= 200)
+
+    def test__max_docs_and_bytes(self):
+        operations = self.operations([10, 10, 10, 150, 10])
+        batches = list(batch_operations(operations, self.serializer, max_docs=2, max_bytes=200))
+        self.assertEqual([len(b) for b in batches], [2, 1, 1, 1])
+
+    def test__oversized_operation(self):
+        # a single operation larger than the limit is sent on its own
+        operations = self.operations([10, 1000, 10])
+        batches = list(batch_operations(operations, self.serializer, max_bytes=100))
+        self.assertEqual([len(b) for b in batches], [1, 1, 1])
+        self.assertIn('x' * 1000, batches[1][0])
+
+    def test__deletes(self):
+        batch = list(batch_operations([({'delete': {'_id': 1}}, None)], self.serializer, max_docs=10))[0]
+        self.assertEqual(json.loads(batch[0]), {'delete': {'_id': 1}})
+
+    def test__no_limits(self):
+        with self.assertRaises(ValueError):
+            list(batch_operations(self.operations([10]), self.serializer))
+
+
+class BulkProgressTestCase(TestCase):
+    def test__out_of_order_sends(self):
+        marks = []
+        progress = BulkProgress(marks.append)
+
+        def chunks():
+            # one mark after each batch of two operations
+            for name in ['z', 'a', 'b', 'c']:
+                for operation in progress.track([name, name]):
+                    yield operation
+                progress.mark(name)
+        operations = chunks()
+
+        def source():
+            batch = [next(operations), next(operations)]
+            yield batch
+            a = [next(operations), next(operations)]
+            yield a
+            yield [next(operations), next(operations)]
+            # `a` has been sent by now; reuse its list, as CPython may reuse
+            # the `id()` of a freed one
+            a[:] = [next(operations), next(operations)]
+            yield a
+            self.assertEqual(list(operations), [])
+
+        batches = progress.batches(source())
+        z, a, b = next(batches), next(batches), next(batches)
+        progress.sent(a)
+        c = next(batches)
+        progress.sent(z)
+        progress.sent(c)
+        # only the latest mark that everything up to has been sent is reported
+        self.assertEqual(marks, ['a'])
+
+        progress.sent(b)
+        self.assertEqual(list(batches), [])
+        self.assertEqual(marks, ['a', 'b', 'c'])
+
+
+@mock.patch('simple_elasticsearch.bulk.time.sleep')
+class BulkSenderTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.Mock()
+
+        patcher = mock.patch('simple_elasticsearch.bulk.logger')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def response(self, *statuses):
+        items = []
+        for status in statuses:
+            item = {'_id': len(items), 'status': status}
+            if status >= 400:
+                item['error'] = {'type': 'es_rejected_execution_exception' if status == 429 else 'mapper_parsing_exception'}
+            items.append({'index': item})
+        return {'errors': any(s >= 400 for s in statuses), 'items': items}
+
+    def test__send(self, mock_sleep):
+        self.es.bulk.return_value = self.response(201, 201)
+        sender = BulkSender(self.es, max_docs=10)
+        sender.send(['a', 'b'])
+        self.es.bulk.assert_called_once_with(['a', 'b'])
+        self.assertEqual(sender.stats, {'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0})
+        self.assertFalse(mock_sleep.called)
+
+    def test__version_conflicts(self, mock_sleep):
+        self.es.bulk.return_value = self.response(201, 409, 201)
+        sender = BulkSender(self.es, max_docs=10)
+        sender.send(['a', 'b', 'c'])
+        self.assertEqual(sender.stats, {'failed': 0, 'retried': 0, 'conflicts': 1, 'not_found': 0})
+        self.assertEqual(self.es.bulk.call_count, 1)
+
+    def test__retry_rejected_items(self, mock_sleep):
+        # only the rejected items are retried, with exponential backoff
+        self.es.bulk.side_effect = [
+            self.response(201, 429, 400, 429),
+            self.response(429, 201),
+            self.response(201),
+        ]
+        sender = BulkSender(self.es, max_docs=10, backoff=1)
+        sender.send(['a', 'b', 'c', 'd'])
+
+        self.assertEqual([c[0][0] for c in self.es.bulk.call_args_list], [['a', 'b', 'c', 'd'], ['b', 'd'], ['b']])
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [1, 2])
+        self.assertEqual(sender.stats, {'failed': 1, 'retried': 3, 'conflicts': 0, 'not_found': 0})
+
+    def test__send_items(self, mock_sleep):
+        # the outcome of each operation, in the order of the batch
+        self.es.bulk.return_value = self.response(201, 429, 400, 409)
+        sender = BulkSender(self.es, max_docs=10, max_retries=0)
+        self.assertEqual(sender.send_items(['a', 'b', 'c', 'd']), ['sent', 'rejected', 'failed', 'sent'])
+        self.assertEqual(sender.stats, {'failed': 2, 'retried': 0, 'conflicts': 1, 'not_found': 0})
+
+        # also once requests that are too large are split
+        self.es.bulk.side_effect = [TransportError(413, 'too large'), self.response(400), self.response(201, 429)]
+        self.assertEqual(sender.send_items(['a', 'b', 'c']), ['failed', 'sent', 'rejected'])
+
+        # `send()` only returns the rejected operations
+        self.es.bulk.side_effect = None
+        self.es.bulk.return_value = self.response(201, 429)
+        self.assertEqual(sender.send(['a', 'b']), ['b'])
+
+    def test__retry_rejected_request(self, mock_sleep):
+        self.es.bulk.side_effect = [TransportError(429, 'es_rejected_execution_exception'), self.response(201)]
+        sender = BulkSender(self.es, max_docs=10)
+        sender.send(['a'])
+        self.assertEqual(self.es.bulk.call_count, 2)
+        self.assertEqual(sender.stats['retried'], 1)
+
+        # other errors are raised as before
+        self.es.bulk.side_effect = TransportError(400, 'bad request')
+        with self.assertRaises(TransportError):
+            sender.send(['a'])
+
+    def test__max_retries(self, mock_sleep):
+        self.es.bulk.return_value = self.response(429)
+        sender = BulkSender(self.es, max_docs=10, max_retries=2)
+        sender.send(['a'])
+        self.assertEqual(self.es.bulk.call_count, 3)
+        self.assertEqual(sender.stats, {'failed': 1, 'retried': 2, 'conflicts': 0, 'not_found': 0})
+
+        self.es.bulk.side_effect = TransportError(429, 'es_rejected_execution_exception')
+        with self.assertRaises(TransportError):
+            sender.send(['a'])
+
+    def test__request_too_large(self, mock_sleep):
+        self.es.bulk.side_effect = [TransportError(413, 'too large'), self.response(201), self.response(201, 201)]
+        sender = BulkSender(self.es, max_docs=10)
+        sender.send(['a', 'b', 'c'])
+        self.assertEqual([c[0][0] for c in self.es.bulk.call_args_list[1:]], [['a'], ['b', 'c']])
+
+        # a single operation that is still too large fails on its own
+        self.es.bulk.side_effect = [TransportError(413, 'too large'), TransportError(413, 'too large'), self.response(201)]
+        with mock.patch('simple_elasticsearch.bulk.logger') as mock_logger:
+            sender.send(['a', 'b'])
+        self.assertEqual(sender.stats['failed'], 1)
+        self.assertIn('a', mock_logger.warning.call_args[0])
+        self.assertEqual(self.es.bulk.call_args[0][0], ['b'])
+
+    def test__aimd(self, mock_sleep):
+        sender = BulkSender(self.es, max_docs=100, max_bytes=1000, concurrency=4)
+
+        # rejections halve the batch size and concurrency...
+        self.es.bulk.return_value = self.response(429)
+        sender.max_retries = 0
+        sender.send(['a'])
+        self.assertEqual((sender.max_docs, sender.max_bytes, sender.concurrency), (50, 500, 2))
+
+        # ...and healthy responses grow them back additively
+        self.es.bulk.return_value = self.response(201)
+        sender.send(['a'])
+        sender.send(['a'])
+        self.assertEqual((sender.max_docs, sender.concurrency), (70, 4))
+        for i in range(10):
+            sender.send(['a'])
+        self.assertEqual((sender.max_docs, sender.concurrency), (100, 4))
+
+        # slow responses count as pushback too
+        sender.target_latency = 0.5
+        with mock.patch('simple_elasticsearch.bulk.time.time', side_effect=[0, 1]):
+            sender.send(['a'])
+        self.assertEqual(sender.max_docs, 50)
+
+    def test__adaptive_batches(self, mock_sleep):
+        sender = BulkSender(self.es, max_docs=4)
+        operations = [({'index': {'_id': i}}, {'i': i}) for i in range(10)]
+
+        batches = batch_operations(operations, JSONSerializer(), limits=sender)
+        sizes = [len(next(batches))]
+        sender.decrease()
+        sizes.extend(len(b) for b in batches)
+        self.assertEqual(sizes, [4, 2, 2, 2])
+
+
+class SerializerTestCase(TestCase):
+    data = {
+        'created_at': datetime.datetime(2017, 11, 15, 10, 30, 0, 123456, tzinfo=timezone.utc),
+        'day': datetime.date(2017, 11, 15),
+        'price': decimal.Decimal('9.99'),
+        'uuid': uuid.UUID('c62b8a2e-3d2f-4f4e-9b47-3cf0a5f0b1ad'),
+        'title': u'caf\xe9',
+        1: 'int key',
+    }
+
+    def test__dumps_matches_json_serializer(self):
+        serializer = serializers.FastJSONSerializer()
+        self.assertEqual(json.loads(serializer.dumps(self.data)), json.loads(JSONSerializer().dumps(self.data)))
+        self.assertEqual(serializer.dumps('already serialized'), 'already serialized')
+        self.assertEqual(serializer.loads('{"a": [1, 2.5]}'), {'a': [1, 2.5]})
+
+    @mock.patch('simple_elasticsearch.serializers.orjson', None)
+    def test__dumps_without_orjson(self):
+        serializer = serializers.FastJSONSerializer()
+        self.assertEqual(serializer.dumps(self.data), JSONSerializer().dumps(self.data))
+
+    def test__create_client(self):
+        es = create_client()
+        self.assertIs(es.transport.serializer, serializers.get_serializer())
+
+        serializer = JSONSerializer()
+        es = create_client(hosts=['localhost:9200'], serializer=serializer)
+        self.assertIs(es.transport.serializer, serializer)
+
+
+class ClientsTestCase(TestCase):
+    def tearDown(self):
+        clients.activate_profile(None)
+
+    def test__http_compress(self):
+        es = create_client(hosts=['localhost:9200'], http_compress=True)
+        connection = es.transport.get_connection()
+        self.assertIsInstance(connection, clients.HttpConnection)
+        self.assertEqual(connection.headers['accept-encoding'], 'gzip,deflate')
+
+        connection.pool.pool = mock.Mock()
+        connection.pool.urlopen('POST', '/_bulk', u'{"index": {}}\n{"title": "caf\xe9"}\n', headers={'a': 'b'})
+        args, kwargs = connection.pool.pool.urlopen.call_args
+        self.assertEqual(gzip.GzipFile(fileobj=six.BytesIO(args[2])).read().decode('utf-8'), u'{"index": {}}\n{"title": "caf\xe9"}\n')
+        self.assertEqual(kwargs['headers'], {'a': 'b', 'content-encoding': 'gzip'})
+
+        connection.pool.urlopen('GET', '/', None, headers={'a': 'b'})
+        self.assertEqual(connection.pool.pool.urlopen.call_args, mock.call('GET', '/', None, headers={'a': 'b'}))
+
+        es = create_client(hosts=['localhost:9200'])
+        self.assertNotIsInstance(es.transport.get_connection(), clients.HttpConnection)
+
+    @mock.patch.object(es_settings, 'ELASTICSEARCH_CONNECTION_PROFILES', {'rebuild': {'maxsize': 25, 'timeout': 120}})
+    def test__profiles(self):
+        self.assertRaises(ImproperlyConfigured, clients.activate_profile, 'missing')
+
+        params = {'hosts': ['localhost:9200'], 'timeout': 10}
+        self.assertEqual(clients.get_connection_params(params), dict(params, http_compress=False))
+
+        clients.activate_profile('rebuild')
+        self.assertEqual(
+            clients.get_connection_params(params),
+            {'hosts': ['localhost:9200'], 'timeout': 120, 'maxsize': 25, 'http_compress': False}
+        )
+        es = create_client(**params)
+        self.assertEqual(es.transport.get_connection().pool.pool.maxsize, 25)
+
+
+class ClientRegistryTestCase(TestCase):
+    def test__get_client_is_shared(self):
+        es = clients.get_client(hosts=['shared.example.com:9200'])
+        self.assertIs(clients.get_client(hosts=['shared.example.com:9200']), es)
+        self.assertIsNot(clients.get_client(hosts=['other.example.com:9200']), es)
+        self.assertIs(BlogPost.get_es(), clients.get_client())
+
+    def test__get_client_after_fork(self):
+        es = clients.get_client(hosts=['shared.example.com:9200'])
+        with mock.patch('simple_elasticsearch.clients.os.getpid', return_value=-1):
+            forked = clients.get_client(hosts=['shared.example.com:9200'])
+            self.assertIsNot(forked, es)
+            self.assertIs(clients.get_client(hosts=['shared.example.com:9200']), forked)
+
+    @mock.patch('simple_elasticsearch.utils.get_client')
+    def test__get_from_es_or_None_with_client(self, mock_get_client):
+        es = mock.Mock()
+        es.get.side_effect = NotFoundError(404, 'not found')
+        self.assertIsNone(utils.get_from_es_or_None('blog', 'posts', 1, es=es))
+        self.assertFalse(mock_get_client.called)
+
+
+class GetFromEsTestCase(TestCase):
+    def setUp(self):
+        self.es = mock.Mock()
+        self.es.mget.side_effect = lambda body, **kwargs: {'docs': [
+            {'_id': str(id), '_source': {'id': id}, 'found': True} if id != 3 else {'_id': '3', 'found': False}
+            for id in body['ids']
+        ]}
+        self.es.get.side_effect = lambda **kwargs: {'_id': str(kwargs['id']), '_source': {'id': kwargs['id']}, 'found': True}
+
+    def test__get_many_from_es(self):
+        results = utils.get_many_from_es('blog', 'posts', [2, 3, 1, 2], es=self.es, _source=True)
+        self.assertEqual([r and r['id'] for r in results], [2, None, 1, 2])
+        self.es.mget.assert_called_once_with(body={'ids': [2, 3, 1]}, index='blog', doc_type='posts', _source=True)
+
+    def test__request_cache(self):
+        with request_cache():
+            self.assertEqual(utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)['id'], 1)
+            results = utils.get_many_from_es('blog', 'posts', ['1', 2, 3], es=self.es)
+            self.assertEqual([r and r['id'] for r in results], [1, 2, None])
+            self.es.mget.assert_called_once_with(body={'ids': [2, 3]}, index='blog', doc_type='posts')
+
+            with request_cache():
+                self.assertIsNone(utils.get_from_es_or_None('blog', 'posts', 3, es=self.es))
+                utils.get_many_from_es('blog', 'posts', [1, 2, 3], es=self.es)
+            self.assertEqual(self.es.get.call_count, 1)
+            self.assertEqual(self.es.mget.call_count, 1)
+
+        utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)
+        self.assertEqual(self.es.get.call_count, 2)
+
+    def test__request_cache_middleware(self):
+        def view(request):
+            utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)
+            return utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)
+
+        self.assertEqual(RequestCacheMiddleware(view)(None)['id'], 1)
+        self.assertEqual(self.es.get.call_count, 1)
+
+    def test__old_style_middleware(self):
+        # as listed in `MIDDLEWARE_CLASSES`
+        middleware = RequestCacheMiddleware()
+        request = mock.Mock(spec=[])
+        middleware.process_request(request)
+        utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)
+        utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)
+        self.assertEqual(self.es.get.call_count, 1)
+
+        response = object()
+        self.assertIs(middleware.process_response(request, response), response)
+        self.assertIsNone(cache.get_request_cache())
+
+
+class LocalCacheTestCase(TestCase):
+    def test__lru(self):
+        local = LocalCache(size=2, timeout=60)
+        local.set('a', 1)
+        local.set('b', 2)
+        self.assertEqual(local.get('a'), 1)
+        local.set('c', 3)
+        self.assertIsNone(local.get('b'))
+        self.assertEqual((local.get('a'), local.get('c')), (1, 3))
+
+        local.delete_many(['a'])
+        self.assertIsNone(local.get('a'))
+
+    @mock.patch('simple_elasticsearch.cache.time.time', return_value=1000)
+    def test__timeout(self, mock_time):
+        local = LocalCache(size=2, timeout=5)
+        local.set('a', 1)
+        mock_time.return_value = 1004
+        self.assertEqual(local.get('a'), 1)
+        mock_time.return_value = 1006
+        self.assertIsNone(local.get('a'))
+
+
+@mock.patch.object(es_settings, 'ELASTICSEARCH_DOCUMENT_CACHE', True)
+class DocumentCacheTestCase(TestCase):
+    def setUp(self):
+        cache._document_cache = None
+        caches['default'].clear()
+        self.es = mock.Mock()
+        self.es.get.side_effect = lambda **kwargs: {
+            '_index': 'blog', '_type': 'posts', '_id': str(kwargs['id']), '_version': 1, 'found': True,
+            '_source': {'id': kwargs['id'], 'title': 'title'}
+        }
+        self.es.mget.side_effect = lambda body, **kwargs: {'docs': [
+            {'_index': 'blog', '_type': 'posts', '_id': str(id), 'found': False} for id in body['ids']
+        ]}
+
+    def tearDown(self):
+        cache._document_cache = None
+
+    def test__read_through(self):
+        result = utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)
+        cached = utils.get_from_es_or_None('blog', 'posts', 1, es=self.es)
+        self.assertEqual(self.es.get.call_count, 1)
+        self.assertIsNot(cached, result)
+        self.assertEqual((dict(cached), cached.meta), (dict(result), result.meta))
+
+        # other request parameters are cached separately
+        utils.get_from_es_or_None('blog', 'posts', 1, es=self.es, _source_include='title')
+        utils.get_from_es_or_None('blog', 'posts', 1, es=self.es, routing=2)
+        self.assertEqual(self.es.get.call_count, 3)
+
+        # the shared tier outlives the local one
+        cache.get_document_cache().local.entries.clear()
+        utils.get_from_es_or_None('blog', 'posts', 1, es=self.es, routing=2)
+        self.assertEqual(self.es.get.call_count, 3)
+
+        # misses are cached too
+        self.assertEqual(utils.get_many_from_es('blog', 'posts', [1, 2], es=self.es)[1], None)
+        self.assertEqual(utils.get_many_from_es('blog', 'posts', [1, 2], es=self.es)[0]['id'], 1)
+        self.assertEqual(self.es.mget.call_count, 1)
+        self.assertEqual(self.es.get.call_count, 3)
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__writes_invalidate(self, mock_index, mock_delete):
+        blog = Blog.objects.create(name='test blog', description='')
+        post = BlogPost.objects.create(blog=blog, title='title', slug='slug', body='body')
+
+        utils.get_from_es_or_None('blog', 'posts', post.pk, es=self.es)
+        BlogPost.index_add(post)
+        utils.get_from_es_or_None('blog', 'posts', post.pk, es=self.es)
+        self.assertEqual(self.es.get.call_count, 2)
+
+        BlogPost.index_delete(post)
+        utils.get_from_es_or_None('blog', 'posts', post.pk, es=self.es)
+        self.assertEqual(self.es.get.call_count, 3)
+
+        serializer = JSONSerializer()
+        cache.invalidate_operations(BlogPost, serializer, [
+            serializer.dumps({'index': {'_index': 'blog-1', '_type': 'posts', '_id': post.pk}}) + '\n{}'
+        ])
+        utils.get_from_es_or_None('blog', 'posts', post.pk, es=self.es)
+        self.assertEqual(self.es.get.call_count, 4)
+
+
+class GuardedTestCase(TestCase):
+    @mock.patch('simple_elasticsearch.bulk.reset_queries')
+    def test__guarded_resets_query_log(self, mock_reset):
+        self.assertEqual(list(guarded(range(5), 2)), [0, 1, 2, 3, 4])
+        self.assertEqual(mock_reset.call_count, 2)
+
+    @mock.patch('simple_elasticsearch.bulk.memory_usage', return_value=850)
+    def test__guarded_shrinks_batches_near_limit(self, mock_usage):
+        on_pressure = mock.Mock()
+        self.assertEqual(list(guarded(range(4), 2, 1000, on_pressure)), [0, 1, 2, 3])
+        self.assertEqual(on_pressure.call_count, 2)
+
+        on_pressure.reset_mock()
+        mock_usage.return_value = 500
+        list(guarded(range(4), 2, 1000, on_pressure))
+        self.assertFalse(on_pressure.called)
+
+    @mock.patch('simple_elasticsearch.bulk.memory_usage', return_value=1500)
+    def test__guarded_aborts_over_limit(self, mock_usage):
+        items = guarded(range(4), 2, 1000)
+        self.assertEqual([next(items), next(items)], [0, 1])
+        self.assertRaises(MemoryLimitError, next, items)
+
+
+class PipelinedBulkIndexTestCase(TransactionTestCase):
+    # the pipeline's reader thread uses its own database connection, so the
+    # test data has to be committed
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        for x in range(25):
+            BlogPost.objects.create(
+                blog=blog,
+                title="blog post title {0}".format(x),
+                slug="DO-NOT-INDEX" if x == 3 else "blog-post-title-{0}".format(x),
+                body="blog post body {0}".format(x)
+            )
+
+        BlogPost.bulk_index_senders = 3
+        BlogPost.queryset_limit = 4
+
+    def tearDown(self):
+        BlogPost.bulk_index_senders = 0
+        BlogPost.queryset_limit = 100
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_pipelined(self, mock_bulk):
+        mock_bulk.return_value = {}
+
+        stats = BlogPost.bulk_index()
+        self.assertEqual(stats, {'indexed': 24, 'deleted': 1, 'skipped': 0, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0})
+
+        ids = []
+        for c in mock_bulk.call_args_list:
+            for op in c[0][0]:
+                action = json.loads(op.split('\n')[0])
+                ids.append(list(action.values())[0]['_id'])
+        self.assertEqual(sorted(ids), sorted(BlogPost.objects.values_list('pk', flat=True)))
+
+    @mock.patch('simple_elasticsearch.bulk.reset_queries')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_pipelined_query_log(self, mock_bulk, mock_reset):
+        # the query log is reset in the reader thread and the building one
+        mock_bulk.return_value = {}
+        threads = set()
+        mock_reset.side_effect = lambda: threads.add(threading.current_thread())
+        BlogPost.bulk_index()
+        self.assertIn(threading.current_thread(), threads)
+        self.assertEqual(len(threads), 2)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__index_queryset_in_transaction(self, mock_bulk):
+        # a reader thread wouldn't see the transaction's changes
+        mock_bulk.return_value = {}
+        with transaction.atomic():
+            BlogPost.objects.update(body='updated')
+            with mock.patch('simple_elasticsearch.mixins.Pipeline') as mock_pipeline:
+                stats = BlogPost.index_queryset(BlogPost.objects.all())
+        self.assertFalse(mock_pipeline.called)
+        self.assertEqual(stats['indexed'], 24)
+
+        docs = [json.loads(op.split('\n')[1]) for c in mock_bulk.call_args_list for op in c[0][0] if '\n' in op]
+        self.assertEqual(set(doc['body'] for doc in docs), set(['updated']))
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_pipelined_send_error(self, mock_bulk):
+        mock_bulk.side_effect = [{}, {}, TransportError(500, 'boom')] + [{}] * 20
+        with self.assertRaises(TransportError):
+            BlogPost.bulk_index()
+
+    @mock.patch('simple_elasticsearch.models.BlogPost.get_document')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_pipelined_build_error(self, mock_bulk, mock_get_document):
+        mock_bulk.return_value = {}
+        mock_get_document.side_effect = ValueError('boom')
+        with self.assertRaises(ValueError):
+            BlogPost.bulk_index()
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_pipelined_progress(self, mock_bulk):
+        sent = []
+
+        def bulk(body):
+            # complete requests out of order
+            time.sleep(0.01 * (len(sent) % 3))
+            sent.extend(json.loads(op.split('\n')[0])['index']['_id'] for op in body if op.startswith('{"index"'))
+            return {}
+        mock_bulk.side_effect = bulk
+
+        positions = []
+
+        def progress(data):
+            # every operation up to the position has been sent
+            pks = BlogPost.objects.filter(pk__lte=data['after'][0]).exclude(slug='DO-NOT-INDEX')
+            self.assertTrue(set(pks.values_list('pk', flat=True)) <= set(sent))
+            positions.append(data['after'][0])
+
+        BlogPost.bulk_index(progress=progress)
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(positions[-1], BlogPost.objects.latest('pk').pk)
+
+    def test__pipeline_read_error(self):
+        def objects():
+            yield 1
+            raise ValueError('boom')
+
+        send = mock.Mock()
+        with self.assertRaises(ValueError):
+            Pipeline(lambda objs: ([obj] for obj in objs), send, senders=2).run(objects())
+
+
+@mock.patch('elasticsearch.Elasticsearch.delete')
+@mock.patch('elasticsearch.Elasticsearch.index')
+@mock.patch('elasticsearch.Elasticsearch.bulk')
+class WriteBufferTestCase(TransactionTestCase):
+    # `on_commit` callbacks only run when a transaction really commits
+
+    def setUp(self):
+        patcher = mock.patch.object(es_settings, 'ELASTICSEARCH_BUFFER_WRITES', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with mock.patch('elasticsearch.Elasticsearch.index'):
+            self.blog = Blog.objects.create(name='test blog name', description='test blog description')
+            self.post = BlogPost.objects.create(blog=self.blog, title='title', slug='slug', body='body')
+
+    def bulk_operations(self, mock_bulk):
+        return [
+            [json.loads(line) for line in op.split('\n')]
+            for c in mock_bulk.call_args_list for op in c[0][0]
+        ]
+
+    def test__commit(self, mock_bulk, mock_index, mock_delete):
+        mock_bulk.return_value = {}
+        with transaction.atomic():
+            posts = [
+                BlogPost.objects.create(blog=self.blog, title='title {0}'.format(x), slug='slug', body='body')
+                for x in range(3)
+            ]
+            for x in range(5):
+                self.post.title = 'title {0}'.format(x)
+                self.post.save()
+            deleted_pk = posts[0].pk
+            posts[0].delete()
+            self.assertFalse(mock_bulk.called)
+
+        # a single bulk request, with repeated writes collapsed into the last
+        # one, in the order of the last writes
+        self.assertFalse(mock_index.called)
+        self.assertFalse(mock_delete.called)
+        self.assertEqual(mock_bulk.call_count, 1)
+        operations = self.bulk_operations(mock_bulk)
+        self.assertEqual([list(op[0])[0] for op in operations], ['index', 'index', 'index', 'delete'])
+        self.assertEqual(operations[2][0]['index']['_id'], self.post.pk)
+        self.assertEqual(operations[2][1]['title'], 'title 4')
+        self.assertEqual(operations[3][0]['delete']['_id'], deleted_pk)
+
+    def test__rollback(self, mock_bulk, mock_index, mock_delete):
+        try:
+            with transaction.atomic():
+                self.post.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(mock_bulk.called)
+
+        # a new transaction doesn't pick up the rolled back writes
+        mock_bulk.return_value = {}
+        with transaction.atomic():
+            BlogPost.objects.create(blog=self.blog, title='title', slug='slug', body='body')
+        self.assertEqual(len(self.bulk_operations(mock_bulk)), 1)
+
+    def test__savepoint_rollback(self, mock_bulk, mock_index, mock_delete):
+        mock_bulk.return_value = {}
+        with transaction.atomic():
+            BlogPost.objects.create(blog=self.blog, title='kept', slug='slug', body='body')
+            try:
+                with transaction.atomic():
+                    BlogPost.objects.create(blog=self.blog, title='rolledback', slug='slug', body='body')
+                    self.post.title = 'rolledback'
+                    self.post.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction.atomic():
+                BlogPost.objects.create(blog=self.blog, title='released', slug='slug', body='body')
+
+        self.assertEqual([op[1]['title'] for op in self.bulk_operations(mock_bulk)], ['kept', 'released'])
+
+    def test__savepoint_superseded(self, mock_bulk, mock_index, mock_delete):
+        mock_bulk.return_value = {}
+        with transaction.atomic():
+            with transaction.atomic():
+                self.post.title = 'inner'
+                self.post.save()
+            self.post.title = 'outer'
+            self.post.save()
+
+        operations = self.bulk_operations(mock_bulk)
+        self.assertEqual([op[1]['title'] for op in operations], ['outer'])
+
+    def test__disabled(self, mock_bulk, mock_index, mock_delete):
+        mock_index.return_value = {}
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_BUFFER_WRITES', False):
+            with transaction.atomic():
+                self.post.save()
+                self.assertTrue(mock_index.called)
+        self.assertFalse(mock_bulk.called)
+
+    def test__buffered_writes(self, mock_bulk, mock_index, mock_delete):
+        mock_bulk.return_value = {}
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_BUFFER_WRITES', False):
+            with buffered_writes():
+                for x in range(3):
+                    self.post.save()
+                    BlogPost.objects.create(blog=self.blog, title='title', slug='slug', body='body')
+                with buffered_writes():
+                    self.post.delete()
+                self.assertFalse(mock_bulk.called)
+
+        self.assertFalse(mock_index.called)
+        self.assertEqual(mock_bulk.call_count, 1)
+        operations = self.bulk_operations(mock_bulk)
+        self.assertEqual(len(operations), 4)
+        self.assertEqual(list(operations[-1][0]), ['delete'])
+
+
+class SpoolTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index):
+        mock_index.return_value = {}
+        self.blog = Blog.objects.create(name='test blog name', description='test blog description')
+        self.post = BlogPost.objects.create(blog=self.blog, title='title', slug='slug', body='body')
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.spool = Spool(os.path.join(self.tmpdir, 'spool.db'))
+
+        patcher = mock.patch.object(BlogPost, 'get_spool', return_value=self.spool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test__spool(self):
+        self.spool.put(BlogPost, ['a', 'b'])
+        self.spool.put(BlogPost, ['c'])
+        self.assertEqual(len(self.spool), 3)
+
+        rows = self.spool.get(2)
+        self.assertEqual([(path, op) for pk, path, op in rows], [
+            ('simple_elasticsearch.models.BlogPost', 'a'),
+            ('simple_elasticsearch.models.BlogPost', 'b'),
+        ])
+        self.spool.remove([pk for pk, path, op in rows])
+        self.assertEqual([op for pk, path, op in self.spool.get()], ['c'])
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__index_add_or_delete(self, mock_index, mock_delete):
+        self.assertTrue(BlogPost.index_add_or_delete(self.post))
+        self.assertTrue(BlogPost.index_delete(self.post, 'foo'))
+        self.assertFalse(mock_index.called)
+        self.assertFalse(mock_delete.called)
+
+        operations = [op.split('\n') for pk, path, op in self.spool.get()]
+        self.assertEqual(json.loads(operations[0][0]), {'index': {'_index': 'blog', '_type': 'posts', '_id': self.post.pk, 'routing': self.blog.pk}})
+        self.assertEqual(json.loads(operations[0][1])['title'], 'title')
+        self.assertEqual(json.loads(operations[1][0]), {'delete': {'_index': 'foo', '_type': 'posts', '_id': self.post.pk, 'routing': self.blog.pk}})
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__worker(self, mock_bulk):
+        mock_bulk.return_value = {}
+        BlogPost.index_add(self.post)
+        BlogPost.index_delete(self.post)
+
+        worker = SpoolWorker(self.spool)
+        self.assertEqual(worker.drain(), 2)
+        self.assertEqual(mock_bulk.call_count, 1)
+        self.assertEqual(len(mock_bulk.call_args[0][0]), 2)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(worker.stats, {'sent': 2, 'failed': 0})
+
+    @mock.patch('simple_elasticsearch.spool.logger')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__worker_unavailable(self, mock_bulk, mock_logger):
+        BlogPost.index_add(self.post)
+        worker = SpoolWorker(self.spool, backoff=1)
+
+        # operations stay spooled until Elasticsearch comes back
+        error = ConnectionError('N/A', 'refused', Exception('refused'))
+        mock_bulk.side_effect = [error, error, {}]
+        with mock.patch.object(worker.stopped, 'wait') as mock_wait:
+            self.assertEqual(worker.drain(), 1)
+        self.assertEqual([c[0][0] for c in mock_wait.call_args_list], [1, 2])
+        self.assertEqual(mock_bulk.call_count, 3)
+        self.assertEqual(len(self.spool), 0)
+
+        # a bad request is dropped rather than retried forever
+        BlogPost.index_add(self.post)
+        mock_bulk.side_effect = TransportError(400, 'bad request')
+        self.assertEqual(worker.drain(), 1)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(worker.stats['failed'], 1)
+
+    @mock.patch('simple_elasticsearch.spool.logger')
+    @mock.patch('simple_elasticsearch.bulk.time.sleep')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__worker_rejected(self, mock_bulk, mock_sleep, mock_logger):
+        operations = ['{{"index": {{"_id": {0}}}}}\n{{}}'.format(pk) for pk in range(3)]
+        self.spool.put(BlogPost, operations)
+        worker = SpoolWorker(self.spool, backoff=1)
+
+        def items(*statuses):
+            return {'items': [{'index': {'status': status}} for status in statuses]}
+
+        # operations the cluster keeps rejecting stay spooled, along with
+        # those after them, until it accepts them
+        mock_bulk.side_effect = [items(201, 429, 201), items(429, 201), items(201, 201)]
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_BULK_INDEX_MAX_RETRIES', 0):
+            with mock.patch.object(worker.stopped, 'wait') as mock_wait:
+                self.assertEqual(worker.drain(), 3)
+        self.assertEqual([c[0][0] for c in mock_bulk.call_args_list], [operations, operations[1:], operations[1:]])
+        self.assertEqual([c[0][0] for c in mock_wait.call_args_list], [1, 2])
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(worker.stats, {'sent': 3, 'failed': 0})
+
+    @mock.patch('simple_elasticsearch.spool.logger')
+    @mock.patch('simple_elasticsearch.bulk.logger')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__worker_mixed_batch(self, mock_bulk, mock_bulk_logger, mock_logger):
+        operations = ['{{"index": {{"_id": {0}}}}}\n{{}}'.format(pk) for pk in range(3)]
+        self.spool.put(BlogPost, operations)
+        worker = SpoolWorker(self.spool, backoff=1)
+
+        def items(*statuses):
+            return {'items': [
+                {'index': {'status': status, 'error': 'bad'} if status == 400 else {'status': status}}
+                for status in statuses
+            ]}
+
+        # only the operations before the first rejected one are done with,
+        # and failures after it are counted once they're resent
+        mock_bulk.side_effect = [items(201, 429, 400), items(201, 400)]
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_BULK_INDEX_MAX_RETRIES', 0):
+            self.assertEqual(worker.send(self.spool.get(10)), 2)
+            self.assertEqual(worker.stats, {'sent': 1, 'failed': 0})
+            self.assertEqual(len(self.spool), 2)
+
+            self.assertEqual(worker.send(self.spool.get(10)), 0)
+        self.assertEqual(mock_bulk.call_args[0][0], operations[1:])
+        self.assertEqual(worker.stats, {'sent': 2, 'failed': 1})
+        self.assertEqual(len(self.spool), 0)
+
+
+def fake_checkpoints(es):
+    # backs the checkpoint store used with the mocked `es` client with a dict
+    checkpoints = {}
+
+    def get(index, id, doc_type):
+        if id not in checkpoints:
+            raise NotFoundError(404, 'not found')
+        return {'_source': checkpoints[id]}
+
+    def index(index, doc_type, body, id, op_type=None):
+        if op_type == 'create' and id in checkpoints:
+            raise ConflictError(409, 'document_already_exists_exception')
+        checkpoints[id] = body
+
+    es.get.side_effect = get
+    es.index.side_effect = index
+    es.delete.side_effect = lambda index, doc_type, id: checkpoints.pop(id, None)
+    return checkpoints
+
+
+class RebuildIndicesTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.Mock()
+        self.es.indices.get_alias.return_value = {}
+        self.es.indices.get_settings.return_value = {}
+        self.checkpoints = fake_checkpoints(self.es)
+
+        self.type_classes = collections.OrderedDict()
+        for name in ('one', 'two', 'three'):
+            type_class = mock.Mock()
+            type_class.get_index_name.return_value = name
+            type_class.get_type_name.return_value = 'items'
+            type_class.get_type_mapping.return_value = {}
+            type_class.bulk_index.return_value = {'indexed': 1}
+            self.type_classes[name] = [type_class]
+
+        patcher = mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.type_classes)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restored_indices(self):
+        return [
+            c[0][1] for c in self.es.indices.put_settings.call_args_list
+            if c[0][0]['index']['refresh_interval'] == '1s'
+        ]
+
+    def saved_checkpoints(self, prefix):
+        return [c[0] for c in self.es.index.call_args_list if c[0][3].startswith(prefix)]
+
+    def test__rebuild_indices(self):
+        for jobs in (1, 3):
+            self.es.reset_mock()
+            created, aliases = rebuild_indices(self.es, jobs=jobs)
+            self.assertEqual(len(created), 3)
+
+            for index_alias, index_name in aliases:
+                self.type_classes[index_alias][0].bulk_index.assert_called_with(
+                    self.es, index_name, after=None, progress=mock.ANY
+                )
+            self.assertEqual(sorted(self.restored_indices()), sorted(i for a, i in aliases))
+
+            # all aliases are swapped together in one request
+            self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+            self.assertEqual(len(self.es.indices.update_aliases.call_args[0][0]['actions']), 3)
+
+            # delta reindexing carries on from the start of the rebuild, and
+            # there's nothing left to resume
+            self.assertEqual(len(self.saved_checkpoints('reindex:')), 3)
+            self.assertEqual([key for key in self.checkpoints if key.startswith('rebuild:')], [])
+
+    @mock.patch('simple_elasticsearch.utils.sys.stderr')
+    @mock.patch('simple_elasticsearch.utils.time.sleep')
+    def test__rebuild_indices_dual_write(self, mock_sleep, mock_stderr):
+        # live writes only look for the new indices with the setting on
+        with self.assertRaises(ImproperlyConfigured):
+            rebuild_indices(self.es, dual_write=True)
+        self.assertFalse(self.es.indices.create.called)
+
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_DUAL_WRITES', True):
+            self.type_classes['three'][0].reindex.side_effect = NotImplementedError
+            created, aliases = rebuild_indices(self.es, dual_write=True)
+
+        # the new indices are registered for live writes during the rebuild
+        states = self.saved_checkpoints('dual-write:')
+        self.assertEqual([(body['index'], key) for index, doc_type, body, key in states], [
+            (index_name, 'dual-write:{0}'.format(index_alias)) for index_alias, index_name in aliases
+        ])
+        self.assertTrue(mock_sleep.called)
+        self.assertEqual([key for key in self.checkpoints if key.startswith('dual-write:')], [])
+
+        # and changes made meanwhile are caught up before the aliases are swapped
+        for index_alias, index_name in aliases:
+            since = parse_since(states[0][2]['started'])
+            self.type_classes[index_alias][0].reindex.assert_called_with(since, self.es, index_name)
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+
+        # type classes that can't catch up are reported
+        self.assertEqual(mock_stderr.write.call_count, 1)
+        self.assertIn('not caught up', mock_stderr.write.call_args[0][0])
+
+    def test__rebuild_indices_failure(self):
+        self.type_classes['two'][0].bulk_index.side_effect = ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            rebuild_indices(self.es, jobs=3)
+
+        # every index gets its settings restored, but no aliases are swapped
+        self.assertEqual(len(self.restored_indices()), 3)
+        self.assertFalse(self.es.indices.update_aliases.called)
+        self.type_classes['three'][0].bulk_index.assert_called_with(self.es, mock.ANY, after=None, progress=mock.ANY)
+
+    def test__rebuild_indices_resume(self):
+        with self.assertRaises(ValueError):
+            rebuild_indices(self.es, resume=True)
+
+        self.type_classes['two'][0].bulk_index.side_effect = ValueError('boom')
+        with self.assertRaises(ValueError):
+            rebuild_indices(self.es)
+        index_names = dict((alias, self.checkpoints['rebuild:' + alias]['index']) for alias in self.type_classes)
+        self.assertTrue(self.checkpoints['rebuild:one:items']['done'])
+
+        # the interrupted type class carries on from its last checkpoint
+        self.checkpoints['rebuild:two:items'] = {
+            'index': index_names['two'],
+            'after': [5],
+            'stats': {'indexed': 5},
+            'done': False
+        }
+        self.type_classes['two'][0].bulk_index.side_effect = None
+        self.es.reset_mock()
+
+        callback = mock.Mock()
+        created, aliases = rebuild_indices(self.es, resume=True, callback=callback)
+        self.assertFalse(self.es.indices.create.called)
+        self.assertEqual(dict(aliases), index_names)
+
+        self.assertEqual(self.type_classes['one'][0].bulk_index.call_count, 1)
+        self.type_classes['two'][0].bulk_index.assert_called_with(
+            self.es, index_names['two'], after=[5], progress=mock.ANY
+        )
+        self.assertEqual(
+            [c[0][1]['stats'] for c in callback.call_args_list],
+            [{'indexed': 1}, {'indexed': 6}, {'indexed': 1}]
+        )
+
+        # the original settings are restored, and the aliases swapped
+        self.assertEqual(len(self.restored_indices()), 3)
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+        self.assertEqual([key for key in self.checkpoints if key.startswith('rebuild:')], [])
+
+
+    def test__rebuild_indices_failed_documents(self):
+        self.type_classes['two'][0].bulk_index.return_value = {'indexed': 1, 'failed': 1}
+
+        with self.assertRaises(BulkIndexError) as cm:
+            rebuild_indices(self.es)
+        self.assertEqual(len(cm.exception.errors), 1)
+        self.assertEqual(cm.exception.errors[0]['stats'], {'indexed': 1, 'failed': 1})
+
+        # the indices are left out of the aliases, and the type class with
+        # failed documents starts over if resumed
+        self.assertEqual(len(self.restored_indices()), 3)
+        self.assertFalse(self.es.indices.update_aliases.called)
+        self.assertTrue(self.checkpoints['rebuild:one:items']['done'])
+        self.assertFalse(self.checkpoints['rebuild:two:items']['done'])
+        self.assertEqual(self.checkpoints['rebuild:two:items']['after'], None)
+
+
+class DistributedRebuildTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index):
+        mock_index.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        for x in range(10):
+            BlogPost.objects.create(
+                blog=blog,
+                title="blog post title {0}".format(x),
+                slug="blog-post-title-{0}".format(x),
+                body="blog post body {0}".format(x)
+            )
+
+        self.es = mock.Mock()
+        self.es.transport.serializer = JSONSerializer()
+        self.es.bulk.return_value = {}
+        self.es.indices.get_alias.return_value = {}
+        self.es.indices.get_settings.return_value = {}
+        self.checkpoints = fake_checkpoints(self.es)
+
+        patcher = mock.patch('simple_elasticsearch.utils.get_indices', return_value={'blog': [BlogPost]})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def indexed_ids(self):
+        return sorted(
+            json.loads(op.split('\n')[0])['index']['_id']
+            for c in self.es.bulk.call_args_list for op in c[0][0]
+        )
+
+    def test__distributed_rebuild(self):
+        created, aliases = prepare_rebuild(self.es)
+        index_name = aliases[0][1]
+        self.es.indices.put_settings.assert_called_with({'index': {'number_of_replicas': 0, 'refresh_interval': '-1'}}, index=index_name)
+        self.assertFalse(self.es.indices.update_aliases.called)
+
+        with self.assertRaises(ValueError):
+            rebuild_partition(self.es, 'foo', 1, 2)
+        with self.assertRaises(ValueError):
+            finalize_rebuild(self.es)
+
+        results = rebuild_partition(self.es, index_name, 1, 2)
+        self.assertEqual(results[0][1]['indexed'], 5)
+
+        # every worker has to split the work the same way
+        with self.assertRaises(ValueError):
+            rebuild_partition(self.es, index_name, 2, 3)
+        with self.assertRaises(ValueError):
+            finalize_rebuild(self.es)
+
+        rebuild_partition(self.es, index_name, 2, 2)
+        self.assertEqual(self.indexed_ids(), sorted(BlogPost.objects.values_list('pk', flat=True)))
+
+        # partitions that are done aren't indexed again
+        self.es.bulk.reset_mock()
+        rebuild_partition(self.es, index_name, 2, 2)
+        self.assertFalse(self.es.bulk.called)
+
+        finalize_rebuild(self.es)
+        self.es.indices.put_settings.assert_called_with({'index': {'number_of_replicas': 1, 'refresh_interval': '1s'}}, index_name)
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+        self.assertEqual(list(self.checkpoints.keys()), ['reindex:blog:posts'])
+
+    @mock.patch('simple_elasticsearch.bulk.logger')
+    def test__distributed_rebuild_failed_documents(self, mock_logger):
+        created, aliases = prepare_rebuild(self.es)
+        index_name = aliases[0][1]
+
+        # a partition with documents that failed to index isn't done
+        self.es.bulk.return_value = {'errors': True, 'items': [{'index': {'status': 400, 'error': 'bad'}}]}
+        results = rebuild_partition(self.es, index_name, 1, 1)
+        self.assertEqual(results[0][1]['failed'], self.es.bulk.call_count)
+        with self.assertRaises(ValueError):
+            finalize_rebuild(self.es)
+        self.assertFalse(self.es.indices.update_aliases.called)
+
+        # and is indexed again from the start when run again
+        self.es.bulk.reset_mock()
+        self.es.bulk.return_value = {}
+        results = rebuild_partition(self.es, index_name, 1, 1)
+        self.assertEqual(results[0][1]['failed'], 0)
+        self.assertEqual(self.indexed_ids(), sorted(BlogPost.objects.values_list('pk', flat=True)))
+        finalize_rebuild(self.es)
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+
+
+class ReindexIndicesTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.Mock()
+        self.checkpoints = fake_checkpoints(self.es)
+
+        self.type_class = mock.Mock()
+        self.type_class.get_index_name.return_value = 'blog'
+        self.type_class.get_type_name.return_value = 'posts'
+        self.type_class.reindex.return_value = {'indexed': 1, 'deleted': 0, 'skipped': 0, 'failed': 0, 'retried': 0, 'conflicts': 0, 'not_found': 0}
+
+        patcher = mock.patch('simple_elasticsearch.utils.get_indices', return_value={'blog': [self.type_class]})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('simple_elasticsearch.utils.sys.stderr')
+    def test__reindex_indices(self, mock_stderr):
+        # without a checkpoint, the first run needs a timestamp
+        self.assertEqual(reindex_indices(self.es), [])
+        self.assertFalse(self.type_class.reindex.called)
+
+        since = parse_since('2017-11-15')
+        callback = mock.Mock()
+        results = reindex_indices(self.es, since=since, callback=callback)
+        self.assertEqual(results, [(self.type_class, self.type_class.reindex.return_value)])
+        self.type_class.reindex.assert_called_with(since, self.es)
+        self.assertEqual(callback.call_count, 1)
+
+        # the next run carries on from the start of the previous one
+        checkpoint = parse_since(self.checkpoints['reindex:blog:posts']['since'])
+        self.assertTrue(checkpoint > since)
+        reindex_indices(self.es)
+        self.type_class.reindex.assert_called_with(checkpoint, self.es)
+
+        # the checkpoint isn't moved on if any documents failed
+        checkpoint = self.checkpoints['reindex:blog:posts']
+        self.type_class.reindex.return_value = dict(self.type_class.reindex.return_value, failed=1)
+        reindex_indices(self.es)
+        self.assertEqual(self.checkpoints['reindex:blog:posts'], checkpoint)
+
+    def test__parse_since(self):
+        self.assertEqual(parse_since('2017-11-15T02:30:00Z'), datetime.datetime(2017, 11, 15, 2, 30, tzinfo=timezone.utc))
+        self.assertEqual(parse_since('2017-11-15').date(), datetime.date(2017, 11, 15))
+        with self.assertRaises(ValueError):
+            parse_since('yesterday')
+
 
 class SimpleSearchTestCase(TestCase):
 
@@ -427,7 +1986,7 @@ class SimpleSearchTestCase(TestCase):
         ddtools.assert_equal(esp.bulk_search_data[0], {'index': 'blog', 'type': 'posts'})
         ddtools.assert_equal(esp.bulk_search_data[1], query_with_size)
 
-    @mock.patch('simple_elasticsearch.search.Elasticsearch.msearch')
+    @mock.patch('elasticsearch.Elasticsearch.msearch')
     def test__esp_search(self, mock_msearch):
         mock_msearch.return_value = {
             "responses": [
@@ -478,7 +2037,7 @@ class SimpleSearchTestCase(TestCase):
         self.assertTrue(page.has_previous())
         self.assertEqual(len(list(page)), 2)  # 2 items on the page
 
-    @mock.patch('simple_elasticsearch.search.Elasticsearch.msearch')
+    @mock.patch('elasticsearch.Elasticsearch.msearch')
     def test__esp_search2(self, mock_msearch):
         mock_msearch.return_value = {
             "responses": [
@@ -511,3 +2070,122 @@ class SimpleSearchTestCase(TestCase):
         page = responses[0].page
         self.assertTrue(page.has_next())
         self.assertFalse(page.has_previous())
+
+
+@mock.patch.object(es_settings, 'ELASTICSEARCH_SEARCH_CACHE', True)
+class SearchCacheTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.es = mock.Mock()
+        self.es.msearch.side_effect = lambda body: {'responses': [
+            {'hits': {'total': 1, 'hits': [{'_id': '1', '_source': {'q': query['query']}}]}} for query in body[1::2]
+        ]}
+
+    def search(self, *queries, **kwargs):
+        esp = SimpleSearch(es=self.es, **kwargs)
+        for index, query in queries:
+            esp.add_search({'query': query}, index=index, query_params={'routing': 1})
+        return esp.search()
+
+    def test__search_cache(self):
+        responses = self.search(('blog', 'a'), ('blog', 'b'))
+        self.assertEqual([response[0]['q'] for response in responses], ['a', 'b'])
+        self.assertEqual(self.es.msearch.call_count, 1)
+
+        # only the searches missing from the cache are sent
+        responses = self.search(('blog', 'b'), ('blog', 'c'), ('blog', 'a'))
+        self.assertEqual([response[0]['q'] for response in responses], ['b', 'c', 'a'])
+        self.assertEqual([response.total for response in responses], [1, 1, 1])
+        self.es.msearch.assert_called_with([{'index': 'blog', 'routing': 1}, {'query': 'c', 'from': 0, 'size': 20}])
+
+        self.search(('blog', 'a'), ('blog', 'b'), ('blog', 'c'))
+        self.assertEqual(self.es.msearch.call_count, 2)
+
+        self.search(('blog', 'a'), cache=False)
+        self.assertEqual(self.es.msearch.call_count, 3)
+
+    def test__per_instance(self):
+        # `cache=True` caches responses even with the setting off
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_SEARCH_CACHE', False):
+            self.search(('blog', 'a'))
+            self.search(('blog', 'a'))
+            self.assertEqual(self.es.msearch.call_count, 2)
+
+            self.search(('blog', 'a'), cache=True)
+            self.search(('blog', 'a'), cache=True)
+            self.assertEqual(self.es.msearch.call_count, 3)
+
+            # and writes still make its cached searches stale
+            cache.invalidate_documents(['blog'], 'posts', [1])
+            self.search(('blog', 'a'), cache=True)
+            self.assertEqual(self.es.msearch.call_count, 4)
+
+            # unless there is no search cache at all
+            with mock.patch.object(es_settings, 'ELASTICSEARCH_SEARCH_CACHE_ALIAS', None):
+                self.search(('blog', 'a'), cache=True)
+                self.search(('blog', 'a'), cache=True)
+            self.assertEqual(self.es.msearch.call_count, 6)
+
+    def test__generations(self):
+        self.search(('blog', 'a'), ('other', 'a'), ('', 'a'))
+        self.assertEqual(self.es.msearch.call_count, 1)
+
+        # writes to `blog` make its searches, and those of every index, stale
+        cache.invalidate_documents(['blog'], 'posts', [1])
+        self.search(('blog', 'a'), ('other', 'a'), ('', 'a'))
+        self.assertEqual(self.es.msearch.call_count, 2)
+        self.es.msearch.assert_called_with([
+            {'index': 'blog', 'routing': 1}, {'query': 'a', 'from': 0, 'size': 20},
+            {'routing': 1}, {'query': 'a', 'from': 0, 'size': 20}
+        ])
+
+        # as do alias changes, and evicted generations
+        es = mock.Mock()
+        es.indices.get_alias.return_value = {}
+        utils.create_aliases(es, [('other', 'other-1')])
+        caches['default'].delete('simple_elasticsearch:generation:blog')
+        self.search(('blog', 'a'), ('other', 'a'))
+        self.es.msearch.assert_called_with([
+            {'index': 'blog', 'routing': 1}, {'query': 'a', 'from': 0, 'size': 20},
+            {'index': 'other', 'routing': 1}, {'query': 'a', 'from': 0, 'size': 20}
+        ])
+
+
+class MsearchChunkingTestCase(TestCase):
+    def setUp(self):
+        self.es = mock.Mock()
+        # drop the response to the search for 'missing'
+        self.es.msearch.side_effect = lambda body, **kwargs: {'responses': [
+            {'hits': {'total': 1, 'hits': [{'_id': '1', '_source': {'q': query['query']}}]}}
+            for query in body[1::2] if query['query'] != 'missing'
+        ]}
+
+    def search(self, queries, **kwargs):
+        esp = SimpleSearch(es=self.es, cache=False, **kwargs)
+        for i, query in enumerate(queries):
+            esp.add_search({'query': query}, page=i + 1, page_size=10)
+        return esp.search()
+
+    def test__chunks(self):
+        queries = ['a', 'b', 'c', 'd', 'e']
+        responses = self.search(queries, chunk_size=2)
+        self.assertEqual([response[0]['q'] for response in responses], queries)
+        self.assertEqual([response._page_num for response in responses], [1, 2, 3, 4, 5])
+        self.assertEqual(self.es.msearch.call_count, 3)
+        self.es.msearch.assert_called_with([{}, {'query': 'e', 'from': 40, 'size': 10}])
+
+    def test__parallel_chunks(self):
+        queries = [str(i) for i in range(20)]
+        responses = self.search(queries, chunk_size=3, concurrency=4, max_concurrent_searches=2)
+        self.assertEqual([response[0]['q'] for response in responses], queries)
+        self.assertEqual([response._page_num for response in responses], list(range(1, 21)))
+        self.assertEqual(self.es.msearch.call_count, 7)
+        for args, kwargs in self.es.msearch.call_args_list:
+            self.assertEqual(kwargs, {'max_concurrent_searches': 2})
+
+    def test__missing_responses(self):
+        responses = self.search(['a', 'missing', 'c'], chunk_size=2)
+        self.assertEqual(len(responses), 3)
+        self.assertIsNone(responses[1])
+        self.assertEqual([responses[0][0]['q'], responses[2][0]['q']], ['a', 'c'])
+        self.assertEqual([responses[0]._page_num, responses[2]._page_num], [1, 3])
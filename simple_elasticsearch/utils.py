@@ -1,13 +1,30 @@
 import collections
+import copy
 import datetime
 import gc
+import multiprocessing
+import os
 import sys
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import Q
 from django.http import Http404
-from elasticsearch import Elasticsearch, NotFoundError
+from django.utils import six, timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from elasticsearch import NotFoundError
 
 from simple_elasticsearch.search import Result
 from . import settings as es_settings
+from .cache import bump_generations, get_document_cache, get_request_cache
+from .checkpoints import (
+    CheckpointStore, dual_write_key, partitions_key, rebuild_checkpoint_key, rebuild_key, reindex_checkpoint_key
+)
+from .clients import get_client
+from .exceptions import BulkIndexError
 from .signals import post_indices_create, post_indices_rebuild
 
 try:
@@ -17,6 +34,9 @@ except ImportError:
 
 _elasticsearch_indices = collections.defaultdict(lambda: [])
 
+# index alias -> (expiry time, names of the indices being rebuilt for it)
+_dual_write_indices = {}
+
 
 def get_indices(indices=[]):
     if not _elasticsearch_indices:
@@ -45,7 +65,7 @@ def get_indices(indices=[]):
 
 
 def create_aliases(es=None, indices=[]):
-    es = es or Elasticsearch(**es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
+    es = es or get_client()
 
     current_aliases = es.indices.get_alias()
     aliases_for_removal = collections.defaultdict(lambda: [])
@@ -70,10 +90,11 @@ def create_aliases(es=None, indices=[]):
         })
 
     es.indices.update_aliases({'actions': actions})
+    bump_generations([index_alias for index_alias, index_name in indices])
 
 
 def create_indices(es=None, indices=[], set_aliases=True):
-    es = es or Elasticsearch(**es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
+    es = es or get_client()
 
     result = []
     aliases = []
@@ -117,68 +138,487 @@ def create_indices(es=None, indices=[], set_aliases=True):
     return result, aliases
 
 
-def rebuild_indices(es=None, indices=[], set_aliases=True):
-    es = es or Elasticsearch(**es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
-
-    created_indices, aliases = create_indices(es, indices, False)
+def rebuild_index(es, index_name, type_classes, processes=1, callback=None, resume=False):
+    """
+    Bulk indexes `type_classes` into the (already created) `index_name`. The
+    index settings are modified to speed up bulk indexing while this runs, and
+    are restored afterwards, even if indexing fails. Returns a list of failed
+    `parallel_bulk_index` partitions, and of type classes some documents of
+    which failed to index (which start over if resumed).
 
-    # kludge to avoid OOM due to Django's query logging
-    # db_logger = logging.getLogger('django.db.backends')
-    # oldlevel = db_logger.level
-    # db_logger.setLevel(logging.ERROR)
-
-    current_index_name = None
-    current_index_settings = {}
-
-    def change_index():
-        if current_index_name:
-            # restore the original (or their ES defaults) settings back into
-            # the index to restore desired elasticsearch functionality
-            settings = {
-                'number_of_replicas': current_index_settings.get('index', {}).get('number_of_replicas', 1),
-                'refresh_interval': current_index_settings.get('index', {}).get('refresh_interval', '1s'),
-            }
-            es.indices.put_settings({'index': settings}, current_index_name)
-            es.indices.refresh(current_index_name)
+    Progress is saved in checkpoints as it's made; with `resume`, type classes
+    that were completed are skipped and the others carry on from their last
+    checkpoint (or start over, if they were indexed in parallel).
+    """
+    errors = []
+    checkpoints = CheckpointStore(es)
+    state = start_bulk_indexing(es, type_classes[0].get_index_name(), index_name)
 
-    for type_class, index_alias, index_name in created_indices:
-        if index_name != current_index_name:
-            change_index()
+    try:
+        for type_class in type_classes:
+            key = rebuild_checkpoint_key(type_class)
+            checkpoint = checkpoints.get(key) if resume else None
+            if checkpoint is None or checkpoint['index'] != index_name:
+                checkpoint = {'index': index_name, 'after': None, 'stats': {}, 'done': False}
+            elif checkpoint['done']:
+                if callback:
+                    callback(type_class, {'pid': os.getpid(), 'partition': None, 'stats': checkpoint['stats'], 'error': None})
+                continue
 
-            # save the current index's settings locally so that we can restore them after
-            current_index_settings = es.indices.get_settings(index_name).get(index_name, {}).get('settings', {})
-            current_index_name = index_name
+            try:
+                if processes > 1:
+                    # `callback` gets called with per-partition progress as each
+                    # worker finishes a primary key range (or once per type class
+                    # when indexing in this process)
+                    stats = type_class.parallel_bulk_index(index_name, processes=processes, callback=callback)
+                    errors.extend(stats['errors'])
+                    if stats['errors']:
+                        continue
+                else:
+                    stats = type_class.bulk_index(
+                        es,
+                        index_name,
+                        after=checkpoint['after'],
+                        progress=_checkpoint_saver(checkpoints, key, checkpoint)
+                    )
+                    for k, v in checkpoint['stats'].items():
+                        stats[k] = stats.get(k, 0) + v
+                    if callback:
+                        callback(type_class, {'pid': os.getpid(), 'partition': None, 'stats': stats, 'error': None})
+            except NotImplementedError:
+                sys.stderr.write('`bulk_index` not implemented on `{}`.\n'.format(type_class.get_index_name()))
+                continue
 
-            # modify index settings to speed up bulk indexing and then restore them after
-            es.indices.put_settings({'index': {
-                'number_of_replicas': 0,
-                'refresh_interval': '-1',
-            }}, index=index_name)
+            if stats.get('failed'):
+                # the index is missing documents, so it isn't done; the failed
+                # ones are behind the last checkpoint, so it starts over
+                checkpoints.save(key, {'index': index_name, 'after': None, 'stats': {}, 'done': False})
+                errors.append({
+                    'pid': os.getpid(),
+                    'partition': None,
+                    'stats': stats,
+                    'error': '{0} document(s) of `{1}.{2}` failed to index into `{3}`; see the log for details.'.format(
+                        stats['failed'], type_class.get_index_name(), type_class.get_type_name(), index_name)
+                })
+                continue
 
+            checkpoints.save(key, {'index': index_name, 'after': None, 'stats': stats, 'done': True})
+    finally:
+        finish_bulk_indexing(es, index_name, state)
+
+    return errors
+
+
+def start_bulk_indexing(es, index_alias, index_name):
+    # saves the settings of the index `index_name` in its rebuild state (so
+    # they can be restored after, even if the rebuild is resumed) and
+    # modifies them to speed up bulk indexing; returns the rebuild state
+    checkpoints = CheckpointStore(es)
+    state = checkpoints.get(rebuild_key(index_alias)) or {'index': index_name}
+    if 'settings' not in state:
+        index_settings = es.indices.get_settings(index_name).get(index_name, {}).get('settings', {})
+        state['settings'] = {
+            'number_of_replicas': index_settings.get('index', {}).get('number_of_replicas', 1),
+            'refresh_interval': index_settings.get('index', {}).get('refresh_interval', '1s'),
+        }
+        checkpoints.save(rebuild_key(index_alias), state)
+
+    es.indices.put_settings({'index': {
+        'number_of_replicas': 0,
+        'refresh_interval': '-1',
+    }}, index=index_name)
+    return state
+
+
+def finish_bulk_indexing(es, index_name, state):
+    # restore the original (or their ES defaults) settings back into
+    # the index to restore desired elasticsearch functionality
+    es.indices.put_settings({'index': state['settings']}, index_name)
+    es.indices.refresh(index_name)
+
+
+def _checkpoint_saver(checkpoints, key, checkpoint):
+    # a `bulk_index` progress callback saving `key`'s checkpoint at most every
+    # `ELASTICSEARCH_REBUILD_CHECKPOINT_INTERVAL` seconds
+    saved = [time.time()]
+
+    def progress(data):
+        if time.time() - saved[0] < es_settings.ELASTICSEARCH_REBUILD_CHECKPOINT_INTERVAL:
+            return
+        stats = dict(checkpoint['stats'])
+        for k, v in data['stats'].items():
+            stats[k] = stats.get(k, 0) + v
+        checkpoints.save(key, dict(checkpoint, after=data['after'] or checkpoint['after'], stats=stats))
+        saved[0] = time.time()
+    return progress
+
+
+def _rebuild_index_job(args):
+    # runs `rebuild_index` in a `ThreadPool` thread, returning any exception
+    # rather than raising it so that the other indices still complete
+    try:
+        return rebuild_index(*args), None
+    except Exception:
+        return [], sys.exc_info()
+    finally:
+        # Django opens a database connection per thread
+        connections.close_all()
+
+
+def get_dual_write_indices(index_alias, es=None):
+    """
+    Returns the names of the indices being rebuilt for `index_alias` by
+    `rebuild_indices(dual_write=True)`, which live writes should also go to.
+    Always empty unless `ELASTICSEARCH_DUAL_WRITES` is on; the result is cached
+    for `ELASTICSEARCH_DUAL_WRITES_TTL` seconds.
+    """
+    if not es_settings.ELASTICSEARCH_DUAL_WRITES:
+        return []
+
+    now = time.time()
+    expires, index_names = _dual_write_indices.get(index_alias, (0, []))
+    if expires <= now:
+        state = CheckpointStore(es).get(dual_write_key(index_alias))
+        index_names = [state['index']] if state else []
+        _dual_write_indices[index_alias] = (now + es_settings.ELASTICSEARCH_DUAL_WRITES_TTL, index_names)
+    return index_names
+
+
+def catch_up_index(es, index_name, type_classes, since, callback=None):
+    # delta reindexes the changes made since `since` into `index_name`, for
+    # the type classes that implement `get_changed_queryset`
+    for type_class in type_classes:
         try:
-            type_class.bulk_index(es, index_name)
+            stats = type_class.reindex(since, es, index_name)
         except NotImplementedError:
-            sys.stderr.write('`bulk_index` not implemented on `{}`.\n'.format(type_class.get_index_name()))
+            sys.stderr.write('`get_changed_queryset` not implemented on `{0}.{1}`; changes made during the rebuild '
+                             'are not caught up.\n'.format(index_name, type_class.get_type_name()))
             continue
-    else:
-        change_index()
+        if callback:
+            callback(type_class, {'pid': os.getpid(), 'partition': 'catch-up', 'stats': stats, 'error': None})
+
+
+def get_rebuilding_indices(es=None, indices=[]):
+    """
+    Returns the indices of an unfinished `rebuild_indices()`, from their
+    checkpoints, as `(created indices, aliases, start time)` like
+    `create_indices()`. Raises a `ValueError` if any of `indices` isn't
+    being rebuilt.
+    """
+    checkpoints = CheckpointStore(es)
 
-    # return to the norm for db query logging
-    # db_logger.setLevel(oldlevel)
+    created_indices = []
+    aliases = []
+    started = None
+    for index_alias, type_classes in get_indices(indices).items():
+        state = checkpoints.get(rebuild_key(index_alias))
+        if state is None:
+            raise ValueError('No rebuild of `{0}` to resume.'.format(index_alias))
+
+        aliases.append((index_alias, state['index']))
+        for type_class in type_classes:
+            created_indices.append((type_class, index_alias, state['index']))
+
+        index_started = parse_since(state['started'])
+        if started is None or index_started < started:
+            started = index_started
+
+    return created_indices, aliases, started
+
+
+def complete_rebuild(es, created_indices, aliases, started, set_aliases=True):
+    # points the aliases at the rebuilt indices and removes the rebuild's
+    # checkpoints, as there's nothing left to resume
+    checkpoints = CheckpointStore(es)
 
     if set_aliases:
         create_aliases(es, aliases)
         if es_settings.ELASTICSEARCH_DELETE_OLD_INDEXES:
             delete_indices(es, [a for a, i in aliases])
 
+        # the new indices hold everything changed before the rebuild started,
+        # so delta reindexing can carry on from there
+        for type_class, index_alias, index_name in created_indices:
+            checkpoints.save(reindex_checkpoint_key(type_class), {'since': started.isoformat()})
+
+    for type_class, index_alias, index_name in created_indices:
+        checkpoints.delete(rebuild_checkpoint_key(type_class))
+        plan = checkpoints.get(partitions_key(type_class))
+        if plan is not None:
+            for partition in range(1, plan['count'] + 1):
+                checkpoints.delete(rebuild_checkpoint_key(type_class, '{0}/{1}'.format(partition, plan['count'])))
+            checkpoints.delete(partitions_key(type_class))
+    for index_alias, index_name in aliases:
+        checkpoints.delete(rebuild_key(index_alias))
+
+
+def prepare_rebuild(es=None, indices=[]):
+    """
+    Creates new indices for a rebuild spread across `rebuild_partition()`
+    workers, possibly on several hosts, and prepares them for bulk indexing.
+    Once every partition is done, `finalize_rebuild()` points the aliases at
+    them. Returns the same as `create_indices()`.
+    """
+    es = es or get_client()
+    checkpoints = CheckpointStore(es)
+
+    started = timezone.now()
+    created_indices, aliases = create_indices(es, indices, False)
+    for index_alias, index_name in aliases:
+        checkpoints.save(rebuild_key(index_alias), {'index': index_name, 'started': started.isoformat()})
+        start_bulk_indexing(es, index_alias, index_name)
+
+    return created_indices, aliases
+
+
+def rebuild_partition(es=None, index_name='', partition=1, partitions=1, callback=None):
+    """
+    Bulk indexes primary key partition `partition` (1 to `partitions`) of each
+    type class into `index_name`, an index created by `prepare_rebuild()`.
+    The partition boundaries are decided by the first worker to start and
+    shared through checkpoints, so every worker must use the same number of
+    `partitions`. Partitions are resumed from their last checkpoint if run
+    again, or start over if some of their documents failed to index. Returns a list of `(type_class, stats)`.
+    """
+    es = es or get_client()
+    checkpoints = CheckpointStore(es)
+
+    type_classes = None
+    for index_alias, alias_type_classes in get_indices().items():
+        state = checkpoints.get(rebuild_key(index_alias))
+        if state is not None and state['index'] == index_name:
+            type_classes = alias_type_classes
+    if type_classes is None:
+        raise ValueError('`{0}` is not being rebuilt.'.format(index_name))
+    if not 1 <= partition <= partitions:
+        raise ValueError('Invalid partition {0}/{1}.'.format(partition, partitions))
+
+    results = []
+    for type_class in type_classes:
+        plan = checkpoints.get(partitions_key(type_class))
+        if plan is None:
+            plan = checkpoints.create(partitions_key(type_class), {
+                'count': partitions,
+                'bounds': partition_queryset(type_class.get_queryset(), partitions),
+            })
+        if plan['count'] != partitions:
+            raise ValueError('`{0}` is being rebuilt in {1} partitions.'.format(index_name, plan['count']))
+
+        name = '{0}/{1}'.format(partition, partitions)
+        key = rebuild_checkpoint_key(type_class, name)
+        checkpoint = checkpoints.get(key) or {'index': index_name, 'after': None, 'stats': {}, 'done': False}
+        if not checkpoint['done']:
+            stats = {}
+            # there may be fewer partitions than requested for small querysets
+            if partition <= len(plan['bounds']):
+                stats = type_class.bulk_index(
+                    es,
+                    index_name,
+                    queryset=filter_partition(type_class.get_queryset(), *plan['bounds'][partition - 1]),
+                    after=checkpoint['after'],
+                    progress=_checkpoint_saver(checkpoints, key, checkpoint)
+                )
+            for k, v in checkpoint['stats'].items():
+                stats[k] = stats.get(k, 0) + v
+            if stats.get('failed'):
+                # not done, so `finalize_rebuild()` won't swap the aliases
+                # until the partition is run again (from the start, as the
+                # failed documents are behind the last checkpoint)
+                checkpoints.save(key, {'index': index_name, 'after': None, 'stats': {}, 'done': False})
+                if callback:
+                    callback(type_class, {'pid': os.getpid(), 'partition': name, 'stats': stats, 'error': (
+                        '{0} document(s) failed to index; see the log for details.'.format(stats['failed']))})
+                results.append((type_class, stats))
+                continue
+            checkpoint = {'index': index_name, 'after': None, 'stats': stats, 'done': True}
+            checkpoints.save(key, checkpoint)
+
+        if callback:
+            callback(type_class, {'pid': os.getpid(), 'partition': name, 'stats': checkpoint['stats'], 'error': None})
+        results.append((type_class, checkpoint['stats']))
+
+    return results
+
+
+def finalize_rebuild(es=None, indices=[], set_aliases=True):
+    """
+    Completes a `prepare_rebuild()` once every `rebuild_partition()` is done:
+    restores the index settings and points the aliases at the new indices.
+    Raises a `ValueError` listing the partitions that aren't done otherwise.
+    """
+    es = es or get_client()
+    checkpoints = CheckpointStore(es)
+
+    created_indices, aliases, started = get_rebuilding_indices(es, indices)
+
+    pending = []
+    for type_class, index_alias, index_name in created_indices:
+        name = '{0}.{1}'.format(index_alias, type_class.get_type_name())
+        plan = checkpoints.get(partitions_key(type_class))
+        if plan is None:
+            pending.append(name)
+            continue
+        for partition in range(1, plan['count'] + 1):
+            checkpoint = checkpoints.get(rebuild_checkpoint_key(type_class, '{0}/{1}'.format(partition, plan['count'])))
+            if checkpoint is None or not checkpoint['done']:
+                pending.append('{0} {1}/{2}'.format(name, partition, plan['count']))
+    if pending:
+        raise ValueError('Partitions not done: {0}.'.format(', '.join(pending)))
+
+    for index_alias, index_name in aliases:
+        finish_bulk_indexing(es, index_name, checkpoints.get(rebuild_key(index_alias)))
+
+    complete_rebuild(es, created_indices, aliases, started, set_aliases)
+
+    # `aliases` is a list of (index alias, index timestamped-name) tuples
+    post_indices_rebuild.send(None, indices=aliases, aliases_set=set_aliases)
+
+    return created_indices, aliases
+
+
+def rebuild_indices(es=None, indices=[], set_aliases=True, processes=1, callback=None, jobs=1, dual_write=False,
+                    resume=False):
+    """
+    Creates new indices for `indices` and bulk indexes them, then points the
+    aliases at them. With `dual_write`, the new indices are registered for
+    live writes (see `get_dual_write_indices()`) while they are built, and the
+    changes made during the rebuild are delta reindexed into them (for type
+    classes with `get_changed_queryset`) before the aliases are swapped.
+
+    With `resume`, a previous rebuild that failed or was interrupted carries
+    on into the indices it created, from its last checkpoints.
+    """
+    if dual_write and not es_settings.ELASTICSEARCH_DUAL_WRITES:
+        # live writes wouldn't look for the new indices
+        raise ImproperlyConfigured('`dual_write` requires `ELASTICSEARCH_DUAL_WRITES` to be on in project `settings`.')
+
+    es = es or get_client()
+    checkpoints = CheckpointStore(es)
+
+    if resume:
+        created_indices, aliases, started = get_rebuilding_indices(es, indices)
+    else:
+        started = timezone.now()
+        created_indices, aliases = create_indices(es, indices, False)
+        for index_alias, index_name in aliases:
+            checkpoints.save(rebuild_key(index_alias), {'index': index_name, 'started': started.isoformat()})
+
+    if dual_write:
+        for index_alias, index_name in aliases:
+            checkpoints.save(dual_write_key(index_alias), {'index': index_name, 'started': started.isoformat()})
+        # give every process the chance to notice before bulk indexing starts
+        time.sleep(es_settings.ELASTICSEARCH_DUAL_WRITES_TTL)
+
+    try:
+        index_type_classes = collections.OrderedDict()
+        for type_class, index_alias, index_name in created_indices:
+            index_type_classes.setdefault(index_name, []).append(type_class)
+
+        tasks = [
+            (es, index_name, type_classes, processes, callback, resume)
+            for index_name, type_classes in index_type_classes.items()
+        ]
+
+        errors = []
+        if jobs > 1 and len(tasks) > 1:
+            # indices are independent of each other, so rebuild up to `jobs` of
+            # them at a time; the aliases are still swapped together at the end
+            pool = ThreadPool(min(jobs, len(tasks)))
+            try:
+                results = pool.map(_rebuild_index_job, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+            for task_errors, exc_info in results:
+                if exc_info:
+                    six.reraise(*exc_info)
+                errors.extend(task_errors)
+        else:
+            for task in tasks:
+                errors.extend(rebuild_index(*task))
+
+        if errors:
+            # leave the aliases pointing at the old indices; the new, incomplete
+            # ones can be removed with `delete_indices()`
+            raise BulkIndexError('{0} bulk index partition(s) or type(s) failed.'.format(len(errors)), errors)
+
+        if dual_write:
+            # rows read early on may have changed since; live writes alone
+            # can be overwritten by the stale bulk loaded documents
+            for index_name, type_classes in index_type_classes.items():
+                catch_up_index(es, index_name, type_classes, started, callback)
+
+        complete_rebuild(es, created_indices, aliases, started, set_aliases)
+    finally:
+        if dual_write:
+            for index_alias, index_name in aliases:
+                checkpoints.delete(dual_write_key(index_alias))
+
     # `aliases` is a list of (index alias, index timestamped-name) tuples
     post_indices_rebuild.send(None, indices=aliases, aliases_set=set_aliases)
 
     return created_indices, aliases
 
 
+def parse_since(value):
+    # parses a datetime or date string (ie. '2017-11-15T02:00' or
+    # '2017-11-15'), made timezone aware if `USE_TZ` is on
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('Invalid timestamp `{0}`.'.format(value))
+        since = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ and timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def reindex_indices(es=None, indices=[], since=None, callback=None):
+    """
+    Delta reindexes the type classes of `indices` with their `reindex()`
+    method, sending only the objects changed (and deleting those deleted)
+    since `since`, or by default since the type class's last successful
+    reindex (or rebuild). A checkpoint of the time each type class's run
+    started is saved unless any documents failed, so overlapping changes are
+    sent again rather than missed. Returns a list of `(type_class, stats)`.
+    """
+    es = es or get_client()
+    checkpoints = CheckpointStore(es)
+
+    results = []
+    for index_alias, type_classes in get_indices(indices).items():
+        for type_class in type_classes:
+            key = reindex_checkpoint_key(type_class)
+            type_since = since
+            if type_since is None:
+                checkpoint = checkpoints.get(key)
+                if checkpoint is None:
+                    sys.stderr.write('No reindex checkpoint for `{0}.{1}`; a `since` timestamp is required.\n'.format(
+                        index_alias, type_class.get_type_name()))
+                    continue
+                type_since = parse_since(checkpoint['since'])
+
+            started = timezone.now()
+            try:
+                stats = type_class.reindex(type_since, es)
+            except NotImplementedError:
+                sys.stderr.write('`get_changed_queryset` not implemented on `{0}.{1}`.\n'.format(
+                    index_alias, type_class.get_type_name()))
+                continue
+
+            if not stats.get('failed'):
+                checkpoints.save(key, {'since': started.isoformat()})
+            if callback:
+                callback(type_class, {'pid': os.getpid(), 'partition': None, 'stats': stats, 'error': None})
+            results.append((type_class, stats))
+
+    return results
+
+
 def delete_indices(es=None, indices=[], only_unaliased=True):
-    es = es or Elasticsearch(**es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
+    es = es or get_client()
     indices = indices or get_indices(indices=[]).keys()
     indices_to_remove = []
     for index, aliases in es.indices.get_alias().items():
@@ -204,9 +644,54 @@ def recursive_dict_update(d, u):
     return d
 
 
-def queryset_iterator(queryset, chunksize=1000, order_by='pk'):
-    if order_by:
-        queryset = queryset.order_by(order_by)
+def _normalize_ordering(order_by):
+    if not order_by:
+        return []
+    if isinstance(order_by, six.string_types):
+        return [order_by]
+    return list(order_by)
+
+
+def _keyset_ordering(queryset, order_by):
+    ordering = _normalize_ordering(order_by)
+    if '?' in ordering:
+        raise ValueError('Keyset iteration cannot be used with random ordering.')
+
+    # the ordering has to be unique for keyset pagination to be able to seek
+    # past the last row seen; use the primary key as a tie-breaker if it isn't
+    # already a part of the ordering.
+    pk_names = ('pk', queryset.model._meta.pk.name)
+    if not any(field.lstrip('-') in pk_names for field in ordering):
+        ordering.append('pk')
+    return ordering
+
+
+def _ordering_value(row, field):
+    name = field.lstrip('-')
+    if isinstance(row, dict):
+        return row[name]
+    for attr in name.split('__'):
+        row = getattr(row, attr)
+    return row
+
+
+def _keyset_filter(ordering, values):
+    # builds `(a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...`
+    # so that composite orderings seek past the last row seen.
+    result = Q()
+    for i, field in enumerate(ordering):
+        lookup = '{0}__{1}'.format(field.lstrip('-'), 'lt' if field.startswith('-') else 'gt')
+        condition = Q(**{lookup: values[i]})
+        for prev_field, prev_value in zip(ordering[:i], values[:i]):
+            condition &= Q(**{prev_field.lstrip('-'): prev_value})
+        result |= condition
+    return result
+
+
+def offset_queryset_iterator(queryset, chunksize=1000, order_by='pk'):
+    ordering = _normalize_ordering(order_by)
+    if ordering:
+        queryset = queryset.order_by(*ordering)
 
     chunk = 0
     while True:
@@ -220,12 +705,276 @@ def queryset_iterator(queryset, chunksize=1000, order_by='pk'):
         gc.collect()
 
 
-def get_from_es_or_None(index, type, id, **kwargs):
-    es = kwargs.pop('es', Elasticsearch(es_settings.ELASTICSEARCH_SERVER))
+def keyset_queryset_iterator(queryset, chunksize=1000, order_by='pk', after=None):
+    """
+    Iterates over `queryset` in chunks using keyset (seek) pagination, ie.
+    `WHERE (ordering) > (last row seen) ORDER BY ordering LIMIT chunksize`.
+    Unlike LIMIT/OFFSET, the cost of each chunk does not grow with the
+    position in the table. The primary key is appended to `order_by` as a
+    tie-breaker if required; the ordering fields must not be nullable.
+
+    `after` is an optional list of ordering values to start after.
+    """
+    ordering = _keyset_ordering(queryset, order_by)
+    queryset = queryset.order_by(*ordering)
+
+    last = after
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(_keyset_filter(ordering, last))
+
+        rows = list(chunk[:chunksize])
+        for row in rows:
+            yield row
+
+        if len(rows) < chunksize:
+            break
+        last = [_ordering_value(rows[-1], field) for field in ordering]
+        rows = None
+        gc.collect()
+
+
+def cursor_queryset_iterator(queryset, chunksize=1000, order_by='pk', after=None):
+    """
+    Streams the ordered `queryset` with a single query, fetching `chunksize`
+    rows at a time; on PostgreSQL this uses a server-side cursor, keeping
+    memory use bounded without paging queries (set `DISABLE_SERVER_SIDE_CURSORS`
+    on the database if it is behind a transaction pooler). As with keyset
+    iteration, the primary key is added to `order_by` as a tie-breaker and
+    `after` is an optional list of ordering values to start after.
+    """
+    ordering = _keyset_ordering(queryset, order_by)
+    queryset = queryset.order_by(*ordering)
+    if after is not None:
+        queryset = queryset.filter(_keyset_filter(ordering, after))
+
+    try:
+        return queryset.iterator(chunk_size=chunksize)
+    except TypeError:
+        # Django < 2.0 fetches a fixed number of rows at a time
+        return queryset.iterator()
+
+
+def partition_queryset(queryset, partitions):
+    """
+    Splits `queryset` into at most `partitions` contiguous primary key ranges
+    of roughly equal size. Returns a list of `(lower, upper)` tuples, where
+    `lower` is inclusive, `upper` is exclusive and `None` means unbounded.
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    count = pks.count()
+    partitions = max(1, min(partitions, count))
+
+    bounds = []
+    for i in range(1, partitions):
+        bound = pks[count * i // partitions]
+        if not bounds or bound != bounds[-1]:
+            bounds.append(bound)
+
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def filter_partition(queryset, lower, upper):
+    if lower is not None:
+        queryset = queryset.filter(pk__gte=lower)
+    if upper is not None:
+        queryset = queryset.filter(pk__lt=upper)
+    return queryset
+
+
+def _bulk_index_worker(args):
+    type_class, index_name, query, partition = args
+
+    result = {
+        'pid': os.getpid(),
+        'partition': partition,
+        'stats': {},
+        'error': None,
+    }
     try:
-        return Result(es.get(index=index, doc_type=type, id=id, **kwargs))
-    except NotFoundError:
-        return None
+        queryset = type_class.get_queryset()
+        if query is not None:
+            queryset = queryset.model._default_manager.all()
+            queryset.query = query
+        result['stats'] = type_class.bulk_index(
+            index_name=index_name,
+            queryset=filter_partition(queryset, *partition)
+        ) or {}
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        connections.close_all()
+    return result
+
+
+def parallel_bulk_index(type_class, index_name='', queryset=None, processes=None, partitions=None, callback=None):
+    """
+    Runs `type_class.bulk_index()` over primary key ranges of the bulk
+    queryset in a pool of `processes` worker processes (defaults to the number
+    of CPUs). The queryset is split into `partitions` ranges (defaults to four
+    per process) so that work is spread evenly and progress is reported
+    regularly: `callback(type_class, result)` is called in this process as each
+    range completes.
+
+    Returns the merged document counts along with a list of `errors`, one per
+    failed range; a failed range does not stop the others.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    partitions = partitions or processes * 4
+    index_name = index_name or type_class.get_index_name()
+
+    if queryset is None:
+        query = None
+        ranges = partition_queryset(type_class.get_queryset(), partitions)
+    else:
+        # querysets are evaluated when pickled; send the query instead
+        query = queryset.query
+        ranges = partition_queryset(queryset, partitions)
+
+    tasks = [(type_class, index_name, query, partition) for partition in ranges]
+
+    # forked children must not share the parent's database connections (nor
+    # its Elasticsearch clients, which `get_client()` replaces in each child)
+    connections.close_all()
+
+    stats = {'indexed': 0, 'deleted': 0, 'skipped': 0, 'errors': []}
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_bulk_index_worker, tasks):
+            for key, value in result['stats'].items():
+                stats[key] = stats.get(key, 0) + value
+            if result['error']:
+                stats['errors'].append(result)
+            if callback:
+                callback(type_class, result)
+        pool.close()
+    except BaseException:
+        # including KeyboardInterrupt, so the workers don't outlive us
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return stats
+
+
+QUERYSET_ITERATORS = {
+    'offset': offset_queryset_iterator,
+    'keyset': keyset_queryset_iterator,
+    'cursor': cursor_queryset_iterator,
+}
+
+# the strategies that can start after a position (see `keyset_position()`)
+RESUMABLE_STRATEGIES = ('keyset', 'cursor')
+
+
+def queryset_iterator(queryset, chunksize=1000, order_by='pk', strategy='offset', after=None):
+    try:
+        iterator = QUERYSET_ITERATORS[strategy]
+    except KeyError:
+        raise ValueError('Unknown queryset iteration strategy `{0}`.'.format(strategy))
+
+    if after is not None:
+        if strategy not in RESUMABLE_STRATEGIES:
+            raise ValueError('`after` is not supported by the `{0}` iteration strategy.'.format(strategy))
+        return iterator(queryset, chunksize, order_by, after=after)
+    return iterator(queryset, chunksize, order_by)
+
+
+def values_queryset(queryset, fields, order_by='pk'):
+    # `queryset` as dicts of `fields`, along with the primary key (as `pk`)
+    # and the `order_by` fields that queryset iterators page by
+    names = ['pk']
+    for field in list(fields) + [field.lstrip('-') for field in _normalize_ordering(order_by)]:
+        if field not in names:
+            names.append(field)
+    return queryset.values(*names)
+
+
+def keyset_position(queryset, order_by, obj):
+    # the ordering values of `obj`, to pass as `after` to resume iterating
+    # `queryset` after it
+    return [_ordering_value(obj, field) for field in _keyset_ordering(queryset, order_by)]
+
+
+def _document_cache_key(index, type, id, params):
+    return (index, type, six.text_type(id), repr(sorted(params.items())))
+
+
+_not_cached = object()
+
+
+def _cached_result(index, type, id, params):
+    # the `Result` (or `None`, for a missing document) of the lookup from the
+    # document cache, or `_not_cached`
+    document_cache = get_document_cache()
+    response = document_cache.get(index, type, id, params) if document_cache is not None else None
+    if response is None:
+        return _not_cached
+    return Result(copy.deepcopy(response)) if response.get('found') else None
+
+
+def _cache_result(index, type, id, params, response):
+    # the `Result` of a GET (or `_mget` document) `response`, which is added to
+    # the document cache first as `Result` takes its `_source`
+    document_cache = get_document_cache()
+    if document_cache is not None and 'error' not in response:
+        document_cache.set(index, type, id, params, copy.deepcopy(response))
+    return Result(response) if response.get('found') else None
+
+
+def get_from_es_or_None(index, type, id, **kwargs):
+    es = kwargs.pop('es', None) or get_client(hosts=es_settings.ELASTICSEARCH_SERVER)
+
+    cache = get_request_cache()
+    key = _document_cache_key(index, type, id, kwargs)
+    if cache is not None and key in cache:
+        return cache[key]
+
+    result = _cached_result(index, type, id, kwargs)
+    if result is _not_cached:
+        try:
+            response = es.get(index=index, doc_type=type, id=id, **kwargs)
+        except NotFoundError:
+            response = {'found': False}
+        result = _cache_result(index, type, id, kwargs, response)
+
+    if cache is not None:
+        cache[key] = result
+    return result
+
+
+def get_many_from_es(index, type, ids, **kwargs):
+    """
+    Fetches the documents with `ids` in a single `_mget` request, returning a
+    `Result` for each, in the order of `ids`, or `None` where a document is
+    missing. Documents already fetched in the active `request_cache()` block,
+    or held by the document cache, aren't requested again.
+    """
+    es = kwargs.pop('es', None) or get_client(hosts=es_settings.ELASTICSEARCH_SERVER)
+
+    cache = get_request_cache()
+    if cache is None:
+        cache = {}
+    keys = [_document_cache_key(index, type, id, kwargs) for id in ids]
+
+    missing = collections.OrderedDict()
+    for key, id in zip(keys, ids):
+        if key in cache:
+            continue
+        result = _cached_result(index, type, id, kwargs)
+        if result is _not_cached:
+            missing[key] = id
+        else:
+            cache[key] = result
+
+    if missing:
+        response = es.mget(body={'ids': list(missing.values())}, index=index, doc_type=type, **kwargs)
+        for (key, id), doc in zip(missing.items(), response['docs']):
+            cache[key] = _cache_result(index, type, id, kwargs, doc)
+
+    return [cache[key] for key in keys]
 
 
 def get_from_es_or_404(index, type, id, **kwargs):